@@ -5,13 +5,49 @@ import sys
 import logging
 import time
 import asyncio
+import bisect
+from collections import deque
 import psutil
 import gc
+import glob
+import hashlib
+import heapq
+import itertools
 import json
-from dataclasses import dataclass
-from typing import Dict
+import mimetypes
+import re
+import threading
+from datetime import datetime
+from urllib.parse import unquote
+import functools
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import Future, ProcessPoolExecutor, ThreadPoolExecutor
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Deque, Dict, List, Optional, Tuple
 from pyrogram import Client, filters
 from pyrogram.types import Message, InlineKeyboardButton, InlineKeyboardMarkup, CallbackQuery
+from pyrogram.errors import FloodWait, MessageNotModified, InternalServerError, ServiceUnavailable
+# سرور HTTP داخلی اختیاری است و فقط در صورت نصب aiohttp فعال می‌شود
+try:
+    import aiohttp
+    from aiohttp import web
+except ImportError:
+    aiohttp = None
+    web = None
+
+# ساخت تصویر کوچک از فایل‌های تصویری با Pillow اختیاری است
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# uvloop اختیاری است و در صورت نصب به جای event loop پیش‌فرض asyncio استفاده می‌شود
+try:
+    import uvloop
+except ImportError:
+    uvloop = None
 api_id = os.environ.get("API_ID")
 api_hash = os.environ.get("API_HASH")
 bot_token = os.environ.get("BOT_TOKEN")
@@ -45,121 +81,243 @@ class DownloadState:
     task: asyncio.Task = None
     progress: float = 0.0
     last_update: float = time.time()
+    queued: bool = False
+
+@dataclass
+class SharedTransfer:
+    """
+    دانلود مشترک یک فایل بین چند درخواست همزمان
+    اولین درخواست مالک انتقال است و بقیه به آن متصل می‌شوند
+    """
+    key: str
+    owner_id: str
+    task: asyncio.Task = None
+    subscribers: set = field(default_factory=set)
+    total_subscribers: int = 0
+    started_at: float = None
+    current: int = 0
+    total: int = 0
+    speed: float = 0.0
+    sample_time: float = 0.0
+    sample_bytes: int = 0
+    preallocated: bool = False
+    # اطلاعات لازم برای ارائه فایل پیش از پایان دانلود (stream-through)
+    file_name: str = None
+    file_size: int = 0
+    message: Message = None
+    client: Client = None
+    readable_path: str = None
+    sequential: bool = False
+    chunks_done: set = field(default_factory=set)
+    name_ready: asyncio.Event = field(default_factory=asyncio.Event)
 
 class MemoryManager:
     """
-    کلاس مدیریت حافظه و منابع
+    مدیریت فشار حافظه سرویس
+    - مصرف و حد حافظه از cgroup v2 سرویس (memory.current / memory.max) و فشار حافظه
+      از PSI (memory.pressure) خوانده می‌شود؛ بدون cgroup از psutil و /proc/pressure
+    - بافرهای در جریان ربات (قطعه‌های دانلود و ارائه فایل) شمرده می‌شوند
+    - با افزایش فشار، همزمانی دانلودها و جریان‌های موازی هر فایل کم و کش‌ها خالی
+      می‌شوند تا پیش از OOM killer فشار کاهش یابد؛ محدودیت‌ها پس از چند نمونه
+      متوالی با فشار کمتر برمی‌گردند
     """
-    def __init__(self, memory_threshold: float = 90.0):
+    LEVELS = ('normal', 'elevated', 'critical')
+
+    def __init__(self, memory_threshold: float = 90.0, interval: float = 5.0,
+                 psi_elevated: float = 10.0, psi_critical: float = 40.0,
+                 recovery_samples: int = 6, cgroup_path: str = ''):
         self.memory_threshold = memory_threshold
+        self.interval = interval
+        self.psi_elevated = psi_elevated
+        self.psi_critical = psi_critical
+        self.recovery_samples = max(1, recovery_samples)
         self.process = psutil.Process()
-        
+        self.cgroup_path = cgroup_path or self._detect_cgroup()
+        self.level = 'normal'
+        self.buffered_bytes = 0
+        self.last_sample: Dict[str, float] = {}
+        self._recovering = 0
+        self._base_limits: Optional[Tuple[int, int, int]] = None
+
+    @staticmethod
+    def _detect_cgroup() -> str:
+        """
+        مسیر cgroup v2 این پردازه (خط 0:: در /proc/self/cgroup)
+        """
+        try:
+            with open('/proc/self/cgroup', 'r') as f:
+                for line in f:
+                    if line.startswith('0::'):
+                        path = os.path.join('/sys/fs/cgroup', line[3:].strip().lstrip('/'))
+                        if os.path.exists(os.path.join(path, 'memory.current')):
+                            return path
+        except OSError:
+            pass
+        return ''
+
+    def _read_cgroup(self, name: str) -> Optional[str]:
+        try:
+            with open(os.path.join(self.cgroup_path, name), 'r') as f:
+                return f.read().strip()
+        except OSError:
+            return None
+
     def get_memory_usage(self) -> Dict[str, float]:
         """
-        دریافت آمار استفاده از حافظه
+        دریافت آمار استفاده از حافظه (MB)؛ در صورت وجود cgroup مصرف و حد سرویس نیز
         """
         memory = psutil.virtual_memory()
         process_memory = self.process.memory_info()
         
-        return {
+        usage = {
             'system_total': memory.total / (1024 ** 2),  # MB
             'system_used': memory.used / (1024 ** 2),    # MB
             'system_percent': memory.percent,
             'process_rss': process_memory.rss / (1024 ** 2),  # MB
             'process_vms': process_memory.vms / (1024 ** 2)   # MB
         }
-    
-    def cleanup_memory(self) -> None:
+        if self.cgroup_path:
+            current = self._read_cgroup('memory.current')
+            # حد سخت memory.max و در نبود آن حد نرم memory.high
+            limit = next(
+                (value for value in (self._read_cgroup('memory.max'), self._read_cgroup('memory.high'))
+                 if value and value != 'max'),
+                None
+            )
+            if current and current.isdigit():
+                usage['cgroup_current'] = int(current) / (1024 ** 2)
+                usage['cgroup_limit'] = int(limit) / (1024 ** 2) if limit and limit.isdigit() else 0
+        return usage
+
+    def read_pressure(self) -> Dict[str, float]:
         """
-        پاکسازی حافظه و اجرای garbage collector
+        avg10 خطوط some و full فایل PSI (درصد زمانی که پردازه‌ها منتظر حافظه بوده‌اند)
         """
-        # فراخوانی garbage collector
-        collected = gc.collect()
-        print(f"🧹 تعداد {collected} شیء از حافظه پاکسازی شد")
-        
-    def should_cleanup(self) -> bool:
+        text = self._read_cgroup('memory.pressure') if self.cgroup_path else None
+        if text is None:
+            try:
+                with open('/proc/pressure/memory', 'r') as f:
+                    text = f.read()
+            except OSError:
+                text = ''
+        pressure = {'some': 0.0, 'full': 0.0}
+        for line in text.splitlines():
+            kind, _, fields = line.partition(' ')
+            for item in fields.split():
+                key, _, value = item.partition('=')
+                if key == 'avg10' and kind in pressure:
+                    pressure[kind] = float(value)
+        return pressure
+
+    def sample(self) -> Dict[str, float]:
         """
-        بررسی نیاز به پاکسازی حافظه
+        یک نمونه از وضعیت حافظه (در thread ذخیره‌سازی اجرا می‌شود)
         """
-        memory_usage = self.get_memory_usage()
-        return memory_usage['system_percent'] > self.memory_threshold
-    
-    def log_memory_stats(self) -> None:
+        usage = self.get_memory_usage()
+        pressure = self.read_pressure()
+        if usage.get('cgroup_limit'):
+            percent = usage['cgroup_current'] * 100 / usage['cgroup_limit']
+        else:
+            percent = usage['system_percent']
+        return {
+            'percent': percent,
+            'psi_some': pressure['some'],
+            'psi_full': pressure['full'],
+            'rss': usage['process_rss'],
+            'cgroup_current': usage.get('cgroup_current', 0.0)
+        }
+
+    def classify(self, sample: Dict[str, float]) -> str:
         """
-        ثبت وضعیت حافظه در لاگ
+        تعیین سطح فشار از مصرف نسبت به حد و PSI
         """
-        stats = self.get_memory_usage()
-        if stats['system_percent'] > 90:
-            print(f"⚠️ هشدار: استفاده از حافظه بالاست ({stats['system_percent']:.1f}%)")
-    
-    async def monitor_memory(self, interval: int = 300) -> None:
+        if sample['percent'] >= self.memory_threshold or sample['psi_full'] >= self.psi_critical:
+            return 'critical'
+        if sample['percent'] >= self.memory_threshold - 10 or sample['psi_some'] >= self.psi_elevated:
+            return 'elevated'
+        return 'normal'
+
+    async def shed_caches(self) -> None:
         """
-        نظارت مستمر بر وضعیت حافظه
-        interval: فاصله زمانی بررسی به ثانیه (پیش‌فرض: 5 دقیقه)
+        خالی کردن کش‌های قابل بازسازی و آزادسازی پردازه‌های ساخت تصویر کوچک
+        (کش‌ها روی event loop خالی می‌شوند و gc در thread ذخیره‌سازی اجرا می‌شود)
+        """
+        access_tracker.clear_caches()
+        progress_reporter.clear_caches()
+        # کش پیام‌های pyrogram
+        store = getattr(getattr(bot, 'message_cache', None), 'store', None)
+        if isinstance(store, dict):
+            store.clear()
+        thumbnail_store.shutdown()
+        collected = await storage.run(gc.collect)
+        print(f"🧹 کش‌ها خالی شد و {collected} شیء از حافظه پاکسازی شد")
+
+    def apply_level(self, level: str) -> None:
+        """
+        تنظیم همزمانی دانلودها و جریان‌های موازی هر فایل براساس سطح فشار
+        (اندازه قطعه‌ها توسط تلگرام 1MB ثابت است؛ حافظه در جریان با تعداد جریان‌ها کم می‌شود)
+        """
+        scheduler = download_manager.scheduler
+        if self._base_limits is None:
+            self._base_limits = (scheduler.max_concurrent, scheduler.max_per_chat, parallel_downloader.configured_workers)
+        base_concurrent, base_per_chat, base_workers = self._base_limits
+        if level == 'critical':
+            concurrent, workers = 1, 1
+        elif level == 'elevated':
+            concurrent, workers = max(1, base_concurrent // 2), max(1, base_workers // 2)
+        else:
+            concurrent, workers = base_concurrent, None
+        scheduler.set_limits(max_concurrent=concurrent, max_per_chat=min(base_per_chat, concurrent))
+        parallel_downloader.set_workers(workers)
+        self.level = level
+
+    async def monitor_memory(self) -> None:
+        """
+        نظارت مستمر بر فشار حافظه؛ افزایش فشار فوراً و کاهش آن پس از
+        recovery_samples نمونه متوالی اعمال می‌شود
         """
         while True:
             try:
-                if self.should_cleanup():
-                    print("⚠️ مصرف حافظه بالاست، در حال پاکسازی...")
-                    self.cleanup_memory()
-                
-                self.log_memory_stats()
-                await asyncio.sleep(interval)
+                sample = await storage.run(self.sample)
+                self.last_sample = sample
+                level = self.classify(sample)
+                current, target = self.LEVELS.index(self.level), self.LEVELS.index(level)
+                if target > current:
+                    print(
+                        f"⚠️ فشار حافظه {level}: مصرف {sample['percent']:.1f}%، "
+                        f"PSI some={sample['psi_some']:.1f} full={sample['psi_full']:.1f}، "
+                        f"بافرها {self.buffered_bytes / (1024 * 1024):.0f} MB"
+                    )
+                    self.apply_level(level)
+                    self._recovering = 0
+                    await self.shed_caches()
+                elif target < current:
+                    self._recovering += 1
+                    if self._recovering >= self.recovery_samples:
+                        print(f"✅ فشار حافظه کاهش یافت ({level})، محدودیت‌ها بازگردانده شدند")
+                        self.apply_level(level)
+                        self._recovering = 0
+                else:
+                    self._recovering = 0
+                await asyncio.sleep(self.interval)
                 
             except Exception as e:
                 print(f"❌ خطا در نظارت بر حافظه: {e}")
                 await asyncio.sleep(60)  # انتظار 1 دقیقه در صورت خطا
 
-# ایجاد نمونه مدیر حافظه
-memory_manager = MemoryManager()
 
 # تابع پاکسازی خودکار فایل‌های قدیمی در صورت نیاز
 def cleanup_old_files():
     """
-    پاکسازی خودکار فایل‌های قدیمی در صورت پر شدن حافظه
-    پاکسازی براساس قدمت فایل‌ها انجام می‌شود
+    پاکسازی خودکار فایل‌های منقضی شده و در صورت پر شدن دیسک، فایل‌های کم‌ارزش‌تر
+    انتخاب فایل‌ها براساس سیاست تنظیم شده در موتور حذف انجام می‌شود
     """
     try:
-        # بررسی وضعیت فعلی
-        stats = get_file_stats()
-        if not stats['files']:
-            return
-
-        # بررسی فضای دیسک در لینوکس
-        st = os.statvfs(DOWNLOAD_PATH)
-        total_space = st.f_blocks * st.f_frsize
-        free_space = st.f_bavail * st.f_frsize
-        used_percent = ((total_space - free_space) / total_space) * 100 if total_space > 0 else 0
-
-        # اگر فضای استفاده شده بیشتر از 90% است
-        if used_percent > 90:
-            # مرتب‌سازی و حذف فایل‌های قدیمی
-            for file_info in sorted(stats['files'], key=lambda x: -x['age_hours']):
-                if used_percent <= 75:
-                    break
-                
-                file_path = os.path.join(DOWNLOAD_PATH, file_info['name'])
-                if os.path.exists(file_path):
-                    try:
-                        os.remove(file_path)
-                        print(f"🧹 حذف فایل قدیمی: {os.path.basename(file_path)}")
-
-                        # بروزرسانی درصد استفاده
-                        st = os.statvfs(DOWNLOAD_PATH)
-                        total_space = st.f_blocks * st.f_frsize
-                        free_space = st.f_bavail * st.f_frsize
-                        used_percent = ((total_space - free_space) / total_space) * 100 if total_space > 0 else 0
-
-                        # پس از حذف موفق، بروزرسانی config.json
-                        try:
-                            update_config_file_list()
-                        except Exception:
-                            pass
-                    except Exception as e:
-                        print(f"❌ خطا در حذف {os.path.basename(file_path)}: {e}")
-
+        lazy_registry.prune(eviction_engine.max_age_seconds)
+        return eviction_engine.run()
     except Exception as e:
         print(f"❌ خطا در پاکسازی: {e}")
+        return EvictionResult()
 
 # تعریف مسیر پایه برای ذخیره فایل‌ها
 BASE_STORAGE_PATH = "/var/www/html"
@@ -203,14 +361,468 @@ YOUR_DOMAIN = config.get('your_domain', '')
 DOWNLOAD_PATH = config.get('download_path', 'dl')
 ALLOWED_CHAT_IDS = config.get('allowed_chat_ids', [])
 PROXY_CONFIG = config.get('proxy', {})
+MAX_CONCURRENT_DOWNLOADS = config.get('max_concurrent_downloads', 4)
+MAX_DOWNLOADS_PER_CHAT = config.get('max_downloads_per_chat', 2)
+PROGRESS_EDITS_PER_MINUTE = config.get('progress_edits_per_minute', 20)
+OUTBOUND_CONFIG = config.get('outbound', {})
+PROGRESS_MIN_INTERVAL_SECONDS = config.get('progress_min_interval_seconds', 3)
+PARALLEL_DOWNLOAD_CONFIG = config.get('parallel_download', {})
+DOWNLOAD_JOURNAL_PATH = config.get('download_journal_path', 'downloads_journal.json')
+DEDUP_INDEX_PATH = config.get('dedup_index_path', 'dedup_index.jsonl')
+MANIFEST_DEBOUNCE_SECONDS = config.get('manifest_debounce_seconds', 2)
+MANIFEST_PAGE_SIZE = config.get('manifest_page_size', 100)
+WRITE_LEGACY_MANIFEST = config.get('write_legacy_manifest', True)
+STORAGE_WORKERS = config.get('storage_workers', 8)
+STORAGE_LAYOUT = config.get('storage_layout', 'flat')
+STREAM_THROUGH = config.get('stream_through', False)
+STAGING_PATH = config.get('staging_path', '')
+FSYNC_POLICY = config.get('fsync_policy', 'always')
+PREALLOCATE_DOWNLOADS = config.get('preallocate_downloads', True)
+EVICTION_CONFIG = config.get('eviction', {})
+ACCESS_LOG_CONFIG = config.get('access_log', {})
+ADMISSION_RETRY_SECONDS = config.get('admission_retry_seconds', 30)
+HTTP_SERVER_CONFIG = config.get('http_server', {})
+LAZY_FETCH_CONFIG = config.get('lazy_fetch', {})
+THUMBNAIL_CONFIG = config.get('thumbnails', {})
+METRICS_CONFIG = config.get('metrics', {})
+LAZY_REGISTRY_PATH = LAZY_FETCH_CONFIG.get('registry_path', 'lazy_files.json')
+ACCESS_STATS_PATH = ACCESS_LOG_CONFIG.get('stats_path', 'access_stats.json')
+LOOP_LAG_WARN_MS = config.get('loop_lag_warn_ms', 100)
+EVENT_LOOP_CONFIG = config.get('event_loop', {})
+WORKER_BOTS_CONFIG = config.get('worker_bots', {})
+# متغیر محیطی EVENT_LOOP برای مقایسه پیاده‌سازی‌ها در بنچمارک تنظیمات را بازنویسی می‌کند
+EVENT_LOOP_IMPL = os.environ.get('EVENT_LOOP') or EVENT_LOOP_CONFIG.get('implementation', 'uvloop')
+MEMORY_CONFIG = config.get('memory', {})
 
 # تبدیل مسیر نسبی به مطلق
 if not os.path.isabs(DOWNLOAD_PATH):
     DOWNLOAD_PATH = os.path.join(os.path.dirname(__file__), DOWNLOAD_PATH)
 
+if not os.path.isabs(DOWNLOAD_JOURNAL_PATH):
+    DOWNLOAD_JOURNAL_PATH = os.path.join(os.path.dirname(__file__), DOWNLOAD_JOURNAL_PATH)
+if not os.path.isabs(DEDUP_INDEX_PATH):
+    DEDUP_INDEX_PATH = os.path.join(os.path.dirname(__file__), DEDUP_INDEX_PATH)
+if not os.path.isabs(LAZY_REGISTRY_PATH):
+    LAZY_REGISTRY_PATH = os.path.join(os.path.dirname(__file__), LAZY_REGISTRY_PATH)
+# مسیر URL فایل‌های دانلود شده (هم‌راستا با build_public_url)
+DOWNLOAD_URL_PREFIX = '/' + config.get('download_path', 'dl').replace(BASE_STORAGE_PATH, '').strip('/') + '/'
+
+if not os.path.isabs(ACCESS_STATS_PATH):
+    ACCESS_STATS_PATH = os.path.join(os.path.dirname(__file__), ACCESS_STATS_PATH)
+
+if STORAGE_LAYOUT not in ('flat', 'hashed', 'date'):
+    print(f"⚠️ چیدمان ذخیره‌سازی نامعتبر '{STORAGE_LAYOUT}'، از flat استفاده می‌شود")
+    STORAGE_LAYOUT = 'flat'
+
 # ایجاد پوشه در صورت عدم وجود
 os.makedirs(DOWNLOAD_PATH, exist_ok=True)
 
+# شمارنده‌ها و هیستوگرام‌های داخلی برای برنامه‌ریزی ظرفیت
+class Histogram:
+    """
+    توزیع مقادیر با bucket های ثابت (مرز بالای هر bucket شامل همان مقدار است)
+    """
+    def __init__(self, buckets: Tuple[float, ...]):
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+class MetricsRegistry:
+    """
+    ثبت شمارنده‌ها، هیستوگرام‌ها و gauge ها با خروجی متنی سازگار با Prometheus
+    - inc و observe از event loop و thread های ذخیره‌سازی فراخوانی می‌شوند (با قفل)
+    - مقدار gauge ها در زمان هر scrape از تابع ثبت شده خوانده می‌شود
+    """
+    def __init__(self, prefix: str = 'tgfl'):
+        self.prefix = prefix
+        self._meta: Dict[str, Tuple[str, str]] = {}
+        self._buckets: Dict[str, Tuple[float, ...]] = {}
+        self._counters: Dict[str, Dict[Tuple, float]] = {}
+        self._histograms: Dict[str, Dict[Tuple, Histogram]] = {}
+        self._gauges: Dict[str, Callable] = {}
+        self._lock = threading.Lock()
+
+    def counter(self, name: str, help_text: str) -> None:
+        self._meta[name] = ('counter', help_text)
+        self._counters[name] = {}
+
+    def histogram(self, name: str, help_text: str, buckets: Tuple[float, ...]) -> None:
+        self._meta[name] = ('histogram', help_text)
+        self._buckets[name] = buckets
+        self._histograms[name] = {}
+
+    def gauge(self, name: str, help_text: str, func: Callable) -> None:
+        """
+        func یک عدد یا لیستی از (labels, value) برمی‌گرداند
+        """
+        self._meta[name] = ('gauge', help_text)
+        self._gauges[name] = func
+
+    def histogram_totals(self, name: str) -> Tuple[float, int]:
+        """
+        مجموع و تعداد مقادیر یک هیستوگرام در همه برچسب‌ها
+        """
+        with self._lock:
+            series = list(self._histograms[name].values())
+            return sum(h.sum for h in series), sum(h.count for h in series)
+
+    def inc(self, name: str, value: float = 1, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._counters[name]
+            series[key] = series.get(key, 0) + value
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = tuple(sorted(labels.items()))
+        with self._lock:
+            series = self._histograms[name]
+            histogram = series.get(key)
+            if histogram is None:
+                histogram = series[key] = Histogram(self._buckets[name])
+            histogram.observe(value)
+
+    @staticmethod
+    def _labels(labels, extra: Tuple = ()) -> str:
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ''
+        escaped = (
+            (key, str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+            for key, value in pairs
+        )
+        return '{' + ','.join(f'{key}="{value}"' for key, value in escaped) + '}'
+
+    def render(self) -> str:
+        """
+        خروجی متنی همه متریک‌ها (text exposition format 0.0.4)
+        """
+        lines = []
+        for name, (kind, help_text) in self._meta.items():
+            full_name = f"{self.prefix}_{name}"
+            lines.append(f"# HELP {full_name} {help_text}")
+            lines.append(f"# TYPE {full_name} {kind}")
+            if kind == 'gauge':
+                try:
+                    value = self._gauges[name]()
+                except Exception as e:
+                    print(f"⚠️ خطا در خواندن متریک {name}: {e}")
+                    continue
+                samples = value if isinstance(value, list) else [((), value)]
+                for labels, sample in samples:
+                    lines.append(f"{full_name}{self._labels(tuple(sorted(dict(labels).items())))} {sample}")
+                continue
+            with self._lock:
+                if kind == 'counter':
+                    for labels, sample in self._counters[name].items():
+                        lines.append(f"{full_name}{self._labels(labels)} {sample}")
+                    continue
+                for labels, histogram in self._histograms[name].items():
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets, histogram.counts):
+                        cumulative += count
+                        lines.append(f"{full_name}_bucket{self._labels(labels, (('le', bound),))} {cumulative}")
+                    lines.append(f"{full_name}_bucket{self._labels(labels, (('le', '+Inf'),))} {histogram.count}")
+                    lines.append(f"{full_name}_sum{self._labels(labels)} {histogram.sum}")
+                    lines.append(f"{full_name}_count{self._labels(labels)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+# ایجاد نمونه متریک‌ها و تعریف متریک‌های مسیرهای اصلی
+metrics = MetricsRegistry()
+metrics.counter('download_bytes_total', 'Bytes downloaded from Telegram by media type')
+metrics.counter('downloads_total', 'Finished transfers by media type and result')
+metrics.histogram('download_duration_seconds', 'Transfer duration after leaving the queue',
+                  (1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600))
+metrics.histogram('download_speed_mbps', 'Transfer speed in MB/s by media type',
+                  (0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50, 100))
+metrics.histogram('queue_wait_seconds', 'Time spent waiting for disk admission and a download slot',
+                  (0.01, 0.1, 0.5, 1, 5, 15, 60, 300, 900))
+metrics.histogram('telegram_call_seconds', 'Latency of outbound Telegram API calls by method',
+                  (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+metrics.counter('telegram_flood_waits_total', 'FloodWait errors received by source')
+metrics.counter('telegram_flood_wait_seconds_total', 'Seconds of FloodWait imposed by Telegram')
+metrics.histogram('manifest_rebuild_seconds', 'Time to serialize and publish the manifest',
+                  (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5))
+metrics.counter('cleanup_bytes_freed_total', 'Bytes freed by eviction by reason')
+metrics.counter('cleanup_files_removed_total', 'Files removed by eviction by reason')
+metrics.counter('event_loop_slow_callbacks_total', 'Callbacks slower than slow_callback_ms (debug mode only)')
+metrics.histogram('event_loop_lag_seconds', 'Event loop wake-up delay',
+                  (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 5))
+
+# اجرای عملیات فایل‌سیستم خارج از event loop
+class StorageExecutor:
+    """
+    thread pool محدود و اختصاصی برای عملیات ذخیره‌سازی (stat, remove, fsync, scandir, ...)
+    هندلرها به جای فراخوانی مستقیم توابع مسدودکننده از run استفاده می‌کنند
+    تا event loop در زمان پاکسازی یا نوشتن روی دیسک پاسخگو بماند
+    """
+    def __init__(self, max_workers: int = 8):
+        self.max_workers = max(1, max_workers)
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='storage')
+        self.pending = 0
+
+    async def run(self, func: Callable, *args, **kwargs):
+        """
+        اجرای تابع مسدودکننده در thread pool و انتظار برای نتیجه
+        """
+        loop = asyncio.get_running_loop()
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+        finally:
+            self.pending -= 1
+
+    def submit(self, func: Callable, *args, **kwargs) -> Future:
+        """
+        اجرای تابع بدون انتظار (برای فراخوانی از کدهای غیر async)
+        """
+        future = self._executor.submit(func, *args, **kwargs)
+        future.add_done_callback(self._log_error)
+        return future
+
+    @staticmethod
+    def _log_error(future: Future) -> None:
+        if not future.cancelled() and future.exception():
+            print(f"❌ خطا در عملیات ذخیره‌سازی: {future.exception()}")
+
+    def shutdown(self) -> None:
+        self._executor.shutdown(wait=True)
+
+# ایجاد نمونه اجراکننده عملیات ذخیره‌سازی
+storage = StorageExecutor(STORAGE_WORKERS)
+
+# اندازه‌گیری تأخیر event loop
+class LoopLagMonitor:
+    """
+    اندازه‌گیری تأخیر event loop با مقایسه زمان واقعی بیدار شدن و زمان مورد انتظار
+    تأخیر زیاد یعنی یک عملیات مسدودکننده روی loop اجرا شده است
+    """
+    def __init__(self, interval: float = 0.5, warn_ms: float = 100):
+        self.interval = interval
+        self.warn_ms = warn_ms
+        self.samples: Deque[float] = deque(maxlen=120)
+        self.last_ms = 0.0
+        self.max_ms = 0.0
+        self.warnings = 0
+
+    def stats(self) -> Dict[str, float]:
+        """
+        آمار تأخیر در بازه نمونه‌های اخیر (میلی‌ثانیه)
+        """
+        samples = sorted(self.samples)
+        if not samples:
+            return {'last': 0.0, 'avg': 0.0, 'p99': 0.0, 'max': 0.0}
+        return {
+            'last': self.last_ms,
+            'avg': sum(samples) / len(samples),
+            'p99': samples[min(len(samples) - 1, int(len(samples) * 0.99))],
+            'max': samples[-1]
+        }
+
+    async def run(self) -> None:
+        """
+        حلقه نمونه‌برداری تأخیر
+        """
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag_ms = max(0.0, (loop.time() - expected) * 1000)
+            self.last_ms = lag_ms
+            self.max_ms = max(self.max_ms, lag_ms)
+            self.samples.append(lag_ms)
+            metrics.observe('event_loop_lag_seconds', lag_ms / 1000)
+            if lag_ms > self.warn_ms:
+                self.warnings += 1
+                print(f"⚠️ تأخیر event loop: {lag_ms:.0f} میلی‌ثانیه")
+
+# ایجاد نمونه ناظر تأخیر event loop
+loop_lag_monitor = LoopLagMonitor(warn_ms=LOOP_LAG_WARN_MS)
+
+class SlowCallbackCounter(logging.Handler):
+    """
+    شمارش هشدارهای callback کند که asyncio/uvloop در حالت debug در لاگ asyncio ثبت می‌کنند
+    """
+    def emit(self, record: logging.LogRecord) -> None:
+        if isinstance(record.msg, str) and record.msg.startswith('Executing'):
+            metrics.inc('event_loop_slow_callbacks_total')
+
+def setup_event_loop(implementation: str = EVENT_LOOP_IMPL) -> asyncio.AbstractEventLoop:
+    """
+    ساخت event loop برنامه پیش از ایجاد Client (pyrogram هنگام ساخت، loop جاری را نگه می‌دارد)
+    - uvloop در صورت نصب و انتخاب در تنظیمات
+    - default executor با اندازه مشخص (resolve DNS اتصال‌ها و run_in_executor بدون executor)
+    - در حالت debug، گزارش callback هایی که بیش از slow_callback_ms طول می‌کشند
+    """
+    if implementation == 'uvloop' and uvloop is None:
+        print("⚠️ uvloop نصب نیست، از event loop پیش‌فرض asyncio استفاده می‌شود")
+        implementation = 'asyncio'
+    loop = uvloop.new_event_loop() if implementation == 'uvloop' else asyncio.new_event_loop()
+    asyncio.set_event_loop(loop)
+    loop.set_default_executor(ThreadPoolExecutor(
+        max_workers=EVENT_LOOP_CONFIG.get('default_executor_workers', 16),
+        thread_name_prefix='loop-default'
+    ))
+    if EVENT_LOOP_CONFIG.get('debug', False):
+        loop.set_debug(True)
+        loop.slow_callback_duration = EVENT_LOOP_CONFIG.get('slow_callback_ms', 100) / 1000
+        asyncio_logger = logging.getLogger('asyncio')
+        asyncio_logger.setLevel(logging.WARNING)
+        asyncio_logger.addHandler(SlowCallbackCounter())
+        print(f"🐞 حالت debug event loop فعال است (callback کندتر از {loop.slow_callback_duration * 1000:.0f} ms)")
+    print(f"🔁 event loop: {implementation}")
+    return loop
+
+def loop_implementation(loop: asyncio.AbstractEventLoop) -> str:
+    """
+    نام پیاده‌سازی event loop (uvloop یا asyncio)
+    """
+    return type(loop).__module__.split('.')[0]
+
+# ایجاد نمونه مدیر حافظه
+memory_manager = MemoryManager(
+    memory_threshold=MEMORY_CONFIG.get('threshold_percent', 90),
+    interval=MEMORY_CONFIG.get('check_interval_seconds', 5),
+    psi_elevated=MEMORY_CONFIG.get('psi_elevated_avg10', 10),
+    psi_critical=MEMORY_CONFIG.get('psi_critical_avg10', 40),
+    recovery_samples=MEMORY_CONFIG.get('recovery_samples', 6),
+    cgroup_path=MEMORY_CONFIG.get('cgroup_path', '')
+)
+
+# زمان‌بند دانلودها با محدودیت همزمانی و نوبت‌دهی عادلانه بین چت‌ها
+class DownloadScheduler:
+    """
+    زمان‌بند دانلودها
+    - محدودیت کلی تعداد دانلودهای همزمان
+    - محدودیت تعداد دانلودهای همزمان هر چت
+    - نوبت‌دهی round-robin بین چت‌ها تا ارسال انبوه یک کاربر بقیه را معطل نکند
+    """
+    def __init__(self, max_concurrent: int = 4, max_per_chat: int = 2):
+        self.max_concurrent = max(1, max_concurrent)
+        self.max_per_chat = max(1, max_per_chat)
+        self.queues: Dict[int, Deque[Tuple[str, asyncio.Future]]] = {}
+        self.chat_order: Deque[int] = deque()
+        self.running: Dict[int, int] = {}
+        self.running_total = 0
+
+    def _enqueue(self, chat_id: int, download_id: str) -> asyncio.Future:
+        future = asyncio.get_running_loop().create_future()
+        if chat_id not in self.queues:
+            self.queues[chat_id] = deque()
+            self.chat_order.append(chat_id)
+        self.queues[chat_id].append((download_id, future))
+        self._dispatch()
+        return future
+
+    def _dequeue(self, chat_id: int, download_id: str) -> None:
+        queue = self.queues.get(chat_id)
+        if not queue:
+            return
+        for item in list(queue):
+            if item[0] == download_id:
+                queue.remove(item)
+                break
+        if not queue:
+            del self.queues[chat_id]
+            self.chat_order.remove(chat_id)
+
+    def _dispatch(self) -> None:
+        """
+        اختصاص ظرفیت‌های آزاد به صف چت‌ها به صورت round-robin
+        """
+        skipped = 0
+        while self.running_total < self.max_concurrent and self.chat_order and skipped < len(self.chat_order):
+            chat_id = self.chat_order[0]
+            self.chat_order.rotate(-1)
+            if self.running.get(chat_id, 0) >= self.max_per_chat:
+                skipped += 1
+                continue
+
+            queue = self.queues[chat_id]
+            download_id, future = queue.popleft()
+            if not queue:
+                del self.queues[chat_id]
+                self.chat_order.remove(chat_id)
+            if future.done():
+                continue
+
+            self.running[chat_id] = self.running.get(chat_id, 0) + 1
+            self.running_total += 1
+            future.set_result(True)
+            skipped = 0
+
+    def release(self, chat_id: int) -> None:
+        """
+        آزادسازی ظرفیت پس از پایان دانلود و اجرای دانلود بعدی صف
+        """
+        count = self.running.get(chat_id, 0) - 1
+        if count > 0:
+            self.running[chat_id] = count
+        else:
+            self.running.pop(chat_id, None)
+        self.running_total = max(0, self.running_total - 1)
+        self._dispatch()
+
+    def set_limits(self, max_concurrent: int = None, max_per_chat: int = None) -> None:
+        """
+        تغییر محدودیت‌های همزمانی در زمان اجرا
+        """
+        if max_concurrent is not None:
+            self.max_concurrent = max(1, max_concurrent)
+        if max_per_chat is not None:
+            self.max_per_chat = max(1, max_per_chat)
+        self._dispatch()
+
+    def position(self, chat_id: int, download_id: str) -> int:
+        """
+        تخمین جایگاه یک دانلود در صف با توجه به نوبت‌دهی round-robin
+        """
+        queue = self.queues.get(chat_id)
+        if not queue:
+            return 0
+        index = next((i for i, item in enumerate(queue) if item[0] == download_id), None)
+        if index is None:
+            return 0
+
+        position = index + 1
+        own_turn = self.chat_order.index(chat_id)
+        for turn, other_chat in enumerate(self.chat_order):
+            if other_chat == chat_id:
+                continue
+            ahead = index + 1 if turn < own_turn else index
+            position += min(len(self.queues[other_chat]), ahead)
+        return position
+
+    @property
+    def queued_count(self) -> int:
+        return sum(len(queue) for queue in self.queues.values())
+
+    async def acquire(self, chat_id: int, download_id: str,
+                      on_queued: Optional[Callable[[int], Awaitable]] = None) -> None:
+        """
+        انتظار برای دریافت نوبت دانلود
+        on_queued: در صورت قرار گرفتن در صف با جایگاه فعلی فراخوانی می‌شود
+        """
+        future = self._enqueue(chat_id, download_id)
+        try:
+            if not future.done():
+                if on_queued:
+                    await on_queued(self.position(chat_id, download_id))
+                await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                # نوبت گرفته شده بود ولی دانلود لغو شد
+                self.release(chat_id)
+            else:
+                future.cancel()
+                self._dequeue(chat_id, download_id)
+            raise
+
 # مدیریت دانلودهای فعال
 class DownloadManager:
     """
@@ -220,6 +832,101 @@ class DownloadManager:
         self.active_downloads: Dict[str, DownloadState] = {}
         self.cleanup_interval = 3600  # پاکسازی هر 1 ساعت
         self._last_cleanup = time.time()
+        self.scheduler = DownloadScheduler(MAX_CONCURRENT_DOWNLOADS, MAX_DOWNLOADS_PER_CHAT)
+        self._slot_owners: Dict[str, int] = {}
+        self.transfers: Dict[str, SharedTransfer] = {}
+
+    def find_transfer_by_name(self, file_name: str) -> Optional[SharedTransfer]:
+        """
+        یافتن انتقال در حال انجامی که فایل را با این مسیر ذخیره می‌کند
+        """
+        for transfer in list(self.transfers.values()):
+            if transfer.file_name == file_name and transfer.task and not transfer.task.done():
+                return transfer
+        return None
+
+    def get_transfer(self, key: str) -> Optional[SharedTransfer]:
+        """
+        دریافت انتقال در حال انجام برای یک فایل
+        """
+        transfer = self.transfers.get(key)
+        if transfer and transfer.task and transfer.task.done():
+            return None
+        return transfer
+
+    def start_transfer(self, key: str, download_id: str, coro: Awaitable) -> SharedTransfer:
+        """
+        شروع انتقال جدید که مالک آن download_id است
+        """
+        transfer = SharedTransfer(key=key, owner_id=download_id)
+        transfer.task = asyncio.create_task(coro)
+        self.transfers[key] = transfer
+        self.join_transfer(transfer, download_id)
+
+        def on_done(_task):
+            if self.transfers.get(key) is transfer:
+                del self.transfers[key]
+        transfer.task.add_done_callback(on_done)
+        return transfer
+
+    def join_transfer(self, transfer: SharedTransfer, download_id: str) -> None:
+        """
+        اتصال یک درخواست به انتقال در حال انجام
+        """
+        transfer.subscribers.add(download_id)
+        transfer.total_subscribers += 1
+
+    def leave_transfer(self, transfer: SharedTransfer, download_id: str) -> int:
+        """
+        جدا شدن یک درخواست از انتقال
+        انتقال فقط زمانی لغو می‌شود که هیچ درخواستی به آن متصل نمانده باشد
+        """
+        transfer.subscribers.discard(download_id)
+        remaining = len(transfer.subscribers)
+        if remaining == 0 and transfer.task and not transfer.task.done():
+            transfer.task.cancel()
+        return remaining
+
+    async def wait_name_ready(self, transfer: SharedTransfer, task: Optional[asyncio.Future] = None) -> bool:
+        """
+        انتظار تا مشخص شدن نام فایل انتقال؛ در صورت پایان task پیش از آن False
+        """
+        if transfer.name_ready.is_set():
+            return True
+        task = task or transfer.task
+        ready = asyncio.ensure_future(transfer.name_ready.wait())
+        try:
+            await asyncio.wait([ready, task], return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            ready.cancel()
+        return transfer.name_ready.is_set()
+
+    async def wait_transfer(self, transfer: SharedTransfer):
+        """
+        انتظار برای نتیجه انتقال بدون لغو آن در صورت لغو این درخواست
+        """
+        return await asyncio.shield(transfer.task)
+
+    async def acquire_slot(self, download_id: str,
+                           on_queued: Optional[Callable[[int], Awaitable]] = None) -> None:
+        """
+        انتظار در صف تا آزاد شدن ظرفیت دانلود
+        """
+        download = self.active_downloads[download_id]
+        download.queued = True
+        try:
+            await self.scheduler.acquire(download.chat_id, download_id, on_queued)
+            self._slot_owners[download_id] = download.chat_id
+        finally:
+            download.queued = False
+
+    def release_slot(self, download_id: str) -> None:
+        """
+        آزادسازی ظرفیت دانلود
+        """
+        chat_id = self._slot_owners.pop(download_id, None)
+        if chat_id is not None:
+            self.scheduler.release(chat_id)
     
     def add_download(self, message: Message) -> str:
         """
@@ -251,19 +958,26 @@ class DownloadManager:
             download = self.active_downloads[download_id]
             # پاکسازی فایل‌های موقت در صورت لغو
             if download.cancelled and download.file_path:
-                try:
-                    if os.path.exists(download.file_path):
-                        os.remove(download.file_path)
-                        print(f"🗑️ فایل نیمه‌کاره حذف شد: {download.file_path}")
-                        try:
-                            update_config_file_list()
-                        except Exception:
-                            pass
-                except Exception as e:
-                    print(f"❌ خطا در حذف فایل نیمه‌کاره: {e}")
+                storage.submit(self._remove_partial, download.file_path)
             
             del self.active_downloads[download_id]
     
+    @staticmethod
+    def _remove_partial(file_path: str) -> None:
+        """
+        حذف فایل دانلود لغو شده (در thread ذخیره‌سازی اجرا می‌شود)
+        """
+        try:
+            if os.path.exists(file_path):
+                os.remove(file_path)
+                print(f"🗑️ فایل نیمه‌کاره حذف شد: {file_path}")
+                thumbnail_store.remove(os.path.relpath(file_path, DOWNLOAD_PATH))
+                prune_shard_dirs(os.path.relpath(file_path, DOWNLOAD_PATH))
+                if file_index.remove(os.path.relpath(file_path, DOWNLOAD_PATH)):
+                    update_config_file_list()
+        except Exception as e:
+            print(f"❌ خطا در حذف فایل نیمه‌کاره: {e}")
+
     def get_download(self, download_id: str) -> DownloadState:
         """
         دریافت وضعیت دانلود
@@ -299,7 +1013,10 @@ class DownloadManager:
                 # نمایش آمار دانلودهای فعال
                 active_count = len(self.active_downloads)
                 if active_count > 0:
-                    print(f"📥 دانلودهای فعال: {active_count}")
+                    print(
+                        f"📥 دانلودهای فعال: {active_count} "
+                        f"(در حال اجرا: {self.scheduler.running_total}، در صف: {self.scheduler.queued_count})"
+                    )
                 
                 await asyncio.sleep(300)  # بررسی هر 5 دقیقه
                 
@@ -310,150 +1027,2567 @@ class DownloadManager:
 # ایجاد نمونه مدیر دانلود
 download_manager = DownloadManager()
 
-# تابع برنامه‌ریز برای اجرای دوره‌ای پاکسازی
-async def cleanup_scheduler():
+def format_duration(seconds: float) -> str:
     """
-    برنامه‌ریز برای اجرای دوره‌ای پاکسازی هر 2 ساعت
+    فرمت کردن مدت زمان به متن فارسی
     """
-    while True:
-        try:
-            # اجرای پاکسازی
-            cleanup_old_files()
-            # انتظار 2 ساعت
-            await asyncio.sleep(2 * 60 * 60)  # تبدیل 2 ساعت به ثانیه
-        except Exception as e:
-            print(f"❌ خطا در برنامه‌ریز پاکسازی: {e}")
-            # در صورت خطا، 5 دقیقه صبر می‌کنیم و دوباره تلاش می‌کنیم
-            await asyncio.sleep(5 * 60)
+    if seconds < 60:
+        return f"{seconds:.1f} ثانیه"
+    if seconds < 3600:
+        return f"{int(seconds // 60)} دقیقه و {int(seconds % 60)} ثانیه"
+    return f"{int(seconds // 3600)} ساعت و {int((seconds % 3600) // 60)} دقیقه"
 
-# بررسی و تنظیم پروکسی
-def get_proxy_config():
+def build_cancel_keyboard(download_id: str) -> InlineKeyboardMarkup:
     """
-    بررسی تنظیمات پروکسی و برگرداندن کانفیگ مناسب
+    ساخت دکمه لغو دانلود
     """
-    if PROXY_CONFIG and PROXY_CONFIG.get("server") and PROXY_CONFIG.get("port"):
-        proxy = {
-            "scheme": PROXY_CONFIG.get("scheme", "socks5"),
-            "hostname": PROXY_CONFIG["server"],
-            "port": PROXY_CONFIG["port"]
-        }
-        # اضافه کردن احراز هویت در صورت وجود
-        if PROXY_CONFIG.get("user") and PROXY_CONFIG.get("pass"):
-            proxy["username"] = PROXY_CONFIG["user"]
-            proxy["password"] = PROXY_CONFIG["pass"]
-        return proxy
-    return None
+    cancel_button = InlineKeyboardButton("❌ لغو دانلود", callback_data=f"cancel_{download_id}")
+    return InlineKeyboardMarkup([[cancel_button]])
 
-# تابع کنترل دسترسی
-def is_allowed_chat(chat_id):
-    """
-    بررسی اینکه کاربر اجازه استفاده دارد یا خیر
-    در صورت خالی بودن لیست، همه کاربران مجاز هستند
-    """
-    try:
-        if chat_id is None:
-            return False
-        # اگر لیست خالی باشد، همه مجاز هستند
-        if not ALLOWED_CHAT_IDS:
-            return True
-        return int(chat_id) in ALLOWED_CHAT_IDS
-    except Exception:
-        return False
+# اولویت‌های صف پیام‌های خروجی (عدد کمتر = اولویت بیشتر)
+PRIORITY_HIGH = 0    # لینک نهایی و پیام‌های لغو
+PRIORITY_NORMAL = 1  # پاسخ دستورات و پیام‌های وضعیت
+PRIORITY_LOW = 2     # ویرایش‌های پیشرفت دانلود
 
-# تابع تولید لینک عمومی
-def build_public_url(file_name):
+class TokenBucket:
     """
-    تولید لینک عمومی برای فایل و حذف مسیر پایه از آن
+    سطل توکن برای محدودسازی نرخ درخواست‌ها
     """
-    if YOUR_DOMAIN.startswith('http://') or YOUR_DOMAIN.startswith('https://'):
-        base = YOUR_DOMAIN.rstrip('/')
-    else:
-        base = f"https://{YOUR_DOMAIN}".rstrip('/')
-    
-    # استفاده از مسیر نسبی برای URL
-    relative_path = config.get('download_path', 'dl').replace(BASE_STORAGE_PATH, '').lstrip('/')
-    return f"{base}/{relative_path}/{file_name}"
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(1.0, capacity)
+        self.tokens = self.capacity
+        self.last = time.monotonic()
 
-# تابع محاسبه آمار فایل‌ها
-def get_file_stats():
+    def refill(self, now: float) -> None:
+        self.tokens = min(self.capacity, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def wait_time(self) -> float:
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def consume(self) -> None:
+        self.tokens -= 1
+
+# صف مرکزی فراخوانی‌های خروجی API تلگرام
+class OutboundQueue:
     """
-    محاسبه آمار فایل‌های موجود
+    صف مرکزی پیام‌های خروجی به تلگرام
+    - سطل توکن کلی و سطل توکن جداگانه برای هر چت (گروه‌ها محدودیت سخت‌گیرانه‌تری دارند)
+    - در صورت FloodWait همه ارسال‌ها به اندازه زمان اعلام شده متوقف و سپس تکرار می‌شوند
+    - پیام‌ها براساس اولویت ارسال می‌شوند (لینک نهایی قبل از ویرایش‌های پیشرفت)
     """
-    try:
-        if not os.path.exists(DOWNLOAD_PATH):
-            return {
-                'total_files': 0,
-                'total_size_mb': 0,
-                'files': []
-            }
-        
-        files = []
-        total_size = 0
-        
-        for filename in os.listdir(DOWNLOAD_PATH):
-            file_path = os.path.join(DOWNLOAD_PATH, filename)
-            if os.path.isfile(file_path):
-                file_size = os.path.getsize(file_path)
-                file_age = time.time() - os.path.getmtime(file_path)
-                files.append({
-                    'name': filename,
-                    'size': file_size,
-                    'age_hours': file_age / 3600
-                })
-                total_size += file_size
-        
-        return {
-            'total_files': len(files),
-            'total_size_mb': total_size / (1024 * 1024),
-            'files': files
+    def __init__(self, global_rate: float = 25, chat_rate: float = 1, chat_burst: float = 3,
+                 group_rate_per_minute: float = 20, workers: int = 4):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate_per_minute / 60
+        self.workers = max(1, workers)
+        self.chat_buckets: Dict[int, TokenBucket] = {}
+        self.paused_until = 0.0
+        self.flood_waits = 0
+        self._items: List[list] = []
+        self._seq = itertools.count()
+        self._wakeup: Optional[asyncio.Event] = None
+        self._worker_tasks: List[asyncio.Task] = []
+
+    def _ensure_workers(self) -> None:
+        if self._worker_tasks:
+            return
+        self._wakeup = asyncio.Event()
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        background_tasks.update(self._worker_tasks)
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) > 10000:
+                # حذف سطل‌های پر و بلااستفاده
+                self.chat_buckets = {
+                    key: value for key, value in self.chat_buckets.items()
+                    if value.tokens < value.capacity
+                }
+            if chat_id < 0:
+                bucket = TokenBucket(self.group_rate, self.chat_burst)
+            else:
+                bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets[chat_id] = bucket
+        return bucket
+
+    def _select(self, now: float):
+        """
+        انتخاب پیام بعدی براساس اولویت و توکن‌های موجود
+        خروجی: (آیتم، زمان انتظار در صورت نبود آیتم قابل ارسال)
+        """
+        if not self._items:
+            return None, None
+        if now < self.paused_until:
+            return None, self.paused_until - now
+        self.global_bucket.refill(now)
+        if self.global_bucket.tokens < 1:
+            return None, self.global_bucket.wait_time()
+
+        min_wait = None
+        for item in sorted(self._items, key=lambda i: (i[0], i[1])):
+            chat_id = item[2]
+            bucket = self._chat_bucket(chat_id) if chat_id is not None else None
+            if bucket is not None:
+                bucket.refill(now)
+                if bucket.tokens < 1:
+                    wait = bucket.wait_time()
+                    min_wait = wait if min_wait is None else min(min_wait, wait)
+                    continue
+                bucket.consume()
+            self.global_bucket.consume()
+            self._items.remove(item)
+            return item, 0
+        return None, min_wait
+
+    async def _worker(self) -> None:
+        while True:
+            # انتخاب و برداشتن آیتم بدون await انجام می‌شود و نیازی به قفل ندارد
+            item, wait = self._select(time.monotonic())
+            if item is None:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=wait)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            _, _, chat_id, func, args, kwargs, future, drop_on_flood = item
+            if future.done():
+                continue
+            method = getattr(func, '__name__', 'call')
+            started = time.perf_counter()
+            try:
+                result = await func(*args, **kwargs)
+            except FloodWait as e:
+                metrics.inc('telegram_flood_waits_total', source='outbound')
+                metrics.inc('telegram_flood_wait_seconds_total', e.value)
+                self.flood_waits += 1
+                self.paused_until = max(self.paused_until, time.monotonic() + e.value)
+                print(f"⚠️ FloodWait: توقف ارسال‌ها به مدت {e.value} ثانیه")
+                if drop_on_flood:
+                    if not future.done():
+                        future.set_exception(e)
+                else:
+                    # تکرار همان درخواست پس از پایان توقف با حفظ ترتیب
+                    self._items.append(item)
+                    self._wakeup.set()
+                continue
+            except Exception as e:
+                metrics.observe('telegram_call_seconds', time.perf_counter() - started, method=method)
+                if not future.done():
+                    future.set_exception(e)
+                continue
+            metrics.observe('telegram_call_seconds', time.perf_counter() - started, method=method)
+            if not future.done():
+                future.set_result(result)
+
+    async def call(self, chat_id: Optional[int], func: Callable[..., Awaitable], *args,
+                   priority: int = PRIORITY_NORMAL, drop_on_flood: bool = False, **kwargs):
+        """
+        ارسال یک فراخوانی API از طریق صف و انتظار برای نتیجه آن
+        chat_id: شناسه چت برای محدودیت نرخ هر چت (None = فقط محدودیت کلی)
+        drop_on_flood: در صورت FloodWait به جای تکرار، خطا برگردانده شود
+        """
+        self._ensure_workers()
+        future = asyncio.get_running_loop().create_future()
+        self._items.append([priority, next(self._seq), chat_id, func, args, kwargs, future, drop_on_flood])
+        self._wakeup.set()
+        return await future
+
+    async def reply(self, message: Message, *args, priority: int = PRIORITY_NORMAL, **kwargs):
+        return await self.call(message.chat.id, message.reply_text, *args, priority=priority, **kwargs)
+
+    async def edit(self, message: Message, *args, priority: int = PRIORITY_NORMAL,
+                   drop_on_flood: bool = False, **kwargs):
+        return await self.call(message.chat.id, message.edit_text, *args,
+                               priority=priority, drop_on_flood=drop_on_flood, **kwargs)
+
+    async def delete(self, message: Message, priority: int = PRIORITY_NORMAL):
+        return await self.call(message.chat.id, message.delete, priority=priority)
+
+    async def send(self, client: Client, chat_id: int, text: str, priority: int = PRIORITY_NORMAL, **kwargs):
+        # chat_id به صورت موقعیتی ارسال می‌شود تا با پارامتر chat_id خود call تداخل نداشته باشد
+        return await self.call(chat_id, client.send_message, chat_id, text, priority=priority, **kwargs)
+
+    async def answer(self, callback_query: CallbackQuery, *args, **kwargs):
+        # پاسخ callback محدودیت نرخ چت ندارد ولی باید سریع ارسال شود
+        return await self.call(None, callback_query.answer, *args, priority=PRIORITY_HIGH, **kwargs)
+
+    async def edit_callback(self, callback_query: CallbackQuery, *args, **kwargs):
+        return await self.call(callback_query.message.chat.id, callback_query.edit_message_text, *args, **kwargs)
+
+# ایجاد نمونه صف پیام‌های خروجی
+outbound_queue = OutboundQueue(
+    global_rate=OUTBOUND_CONFIG.get('global_per_second', 25),
+    chat_rate=OUTBOUND_CONFIG.get('chat_per_second', 1),
+    chat_burst=OUTBOUND_CONFIG.get('chat_burst', 3),
+    group_rate_per_minute=OUTBOUND_CONFIG.get('group_per_minute', 20),
+    workers=OUTBOUND_CONFIG.get('workers', 4)
+)
+
+# گزارش پیشرفت دانلودها در پیام وضعیت
+class ProgressReporter:
+    """
+    گزارش زنده پیشرفت دانلودها با ویرایش پیام وضعیت
+    - سرعت با میانگین متحرک نمایی (EWMA) و زمان باقی‌مانده از روی آن محاسبه می‌شود
+    - تعداد کل ویرایش‌ها در دقیقه برای همه دانلودها محدود است و فاصله ویرایش
+      هر پیام با افزایش تعداد دانلودهای فعال بیشتر می‌شود تا به FloodWait نخوریم
+    """
+    # ضریب هموارسازی EWMA و حداقل فاصله نمونه‌برداری سرعت
+    SPEED_ALPHA = 0.3
+    SAMPLE_INTERVAL = 1.0
+
+    def __init__(self, edits_per_minute: int = 20, min_interval: float = 3.0):
+        self.edits_per_minute = max(1, edits_per_minute)
+        self.min_interval = min_interval
+        self._tokens = float(self.edits_per_minute)
+        self._last_refill = time.monotonic()
+        self._paused_until = 0.0
+        self._last_edit: Dict[str, float] = {}
+        self._last_text: Dict[str, str] = {}
+
+    def record(self, transfer: SharedTransfer, current: int, total: int) -> None:
+        """
+        ثبت پیشرفت از callback دانلود و بروزرسانی سرعت EWMA
+        """
+        now = time.monotonic()
+        transfer.current = current
+        transfer.total = total
+        if not transfer.sample_time:
+            transfer.sample_time = now
+            transfer.sample_bytes = current
+            return
+        elapsed = now - transfer.sample_time
+        if elapsed < self.SAMPLE_INTERVAL:
+            return
+        rate = (current - transfer.sample_bytes) / elapsed
+        if transfer.speed:
+            transfer.speed = self.SPEED_ALPHA * rate + (1 - self.SPEED_ALPHA) * transfer.speed
+        else:
+            transfer.speed = rate
+        transfer.sample_time = now
+        transfer.sample_bytes = current
+
+    def format_progress(self, transfer: SharedTransfer) -> str:
+        """
+        ساخت متن پیشرفت دانلود
+        """
+        percent = transfer.current * 100 / transfer.total if transfer.total else 0
+        filled = int(percent // 10)
+        bar = "■" * filled + "□" * (10 - filled)
+        speed_mb = transfer.speed / (1024 * 1024)
+        if transfer.speed > 0:
+            eta = format_duration((transfer.total - transfer.current) / transfer.speed)
+        else:
+            eta = "محاسبه..."
+        return (
+            "⏳ در حال دانلود فایل...\n"
+            f"📊 پیشرفت: [{bar}] {percent:.1f}%\n"
+            f"💾 {transfer.current / (1024 * 1024):.1f} / {transfer.total / (1024 * 1024):.1f} MB\n"
+            f"⚡ سرعت: {speed_mb:.2f} MB/s\n"
+            f"⏱️ زمان باقی‌مانده: {eta}"
+        )
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(
+            float(self.edits_per_minute),
+            self._tokens + (now - self._last_refill) * self.edits_per_minute / 60
+        )
+        self._last_refill = now
+
+    def current_interval(self, active_count: int) -> float:
+        """
+        فاصله ویرایش هر پیام با توجه به تعداد دانلودهای فعال و بودجه کلی
+        """
+        return max(self.min_interval, active_count * 60 / self.edits_per_minute)
+
+    async def tick(self) -> None:
+        """
+        یک دور ویرایش پیام‌های وضعیت در حد بودجه موجود
+        """
+        now = time.monotonic()
+        if now < self._paused_until:
+            return
+        self._refill()
+
+        candidates = []
+        for transfer in list(download_manager.transfers.values()):
+            if transfer.started_at is None or not transfer.total:
+                continue
+            for download_id in list(transfer.subscribers):
+                download = download_manager.get_download(download_id)
+                if download and download.status_msg and not download.cancelled:
+                    download.progress = transfer.current / transfer.total
+                    download.last_update = time.time()
+                    candidates.append((download_id, download, transfer))
+
+        interval = self.current_interval(len(candidates))
+        # قدیمی‌ترین پیام‌ها اولویت دارند
+        candidates.sort(key=lambda item: self._last_edit.get(item[0], 0))
+        edits = []
+        for download_id, download, transfer in candidates:
+            if self._tokens < 1:
+                break
+            if now - self._last_edit.get(download_id, 0) < interval:
+                continue
+            text = self.format_progress(transfer)
+            if self._last_text.get(download_id) == text:
+                continue
+
+            self._tokens -= 1
+            self._last_edit[download_id] = now
+            self._last_text[download_id] = text
+            edits.append(self._edit(download_id, download.status_msg, text))
+
+        # ویرایش‌ها با کمترین اولویت از صف خروجی ارسال می‌شوند
+        if edits:
+            await asyncio.gather(*edits)
+
+        # حذف اطلاعات دانلودهای پایان یافته
+        for download_id in list(self._last_edit):
+            if download_id not in download_manager.active_downloads:
+                self._last_edit.pop(download_id, None)
+                self._last_text.pop(download_id, None)
+
+    def clear_caches(self) -> None:
+        """
+        خالی کردن آخرین متن ارسال شده هر پیام وضعیت (هنگام فشار حافظه)
+        """
+        self._last_text.clear()
+
+    async def _edit(self, download_id: str, status_msg: Message, text: str) -> None:
+        try:
+            await outbound_queue.edit(
+                status_msg, text,
+                reply_markup=build_cancel_keyboard(download_id),
+                priority=PRIORITY_LOW,
+                drop_on_flood=True
+            )
+        except FloodWait as e:
+            # FloodWait یک بار در صف ارسال شمرده شده است
+            self._paused_until = time.monotonic() + e.value
+            print(f"⚠️ FloodWait در بروزرسانی پیشرفت: {e.value} ثانیه توقف")
+        except MessageNotModified:
+            pass
+        except Exception as e:
+            print(f"⚠️ خطا در بروزرسانی پیشرفت: {e}")
+
+    async def run(self) -> None:
+        """
+        حلقه گزارش پیشرفت
+        """
+        while True:
+            try:
+                await self.tick()
+            except Exception as e:
+                print(f"❌ خطا در گزارش پیشرفت: {e}")
+            await asyncio.sleep(1)
+
+# ایجاد نمونه گزارشگر پیشرفت
+progress_reporter = ProgressReporter(PROGRESS_EDITS_PER_MINUTE, PROGRESS_MIN_INTERVAL_SECONDS)
+
+# تابع برنامه‌ریز برای اجرای دوره‌ای پاکسازی
+async def cleanup_scheduler():
+    """
+    برنامه‌ریز برای اجرای دوره‌ای پاکسازی هر 2 ساعت
+    """
+    while True:
+        try:
+            # همگام‌سازی دوره‌ای ایندکس با دیسک برای تغییرات خارج از ربات
+            await storage.run(file_index.build)
+            update_config_file_list()
+            await storage.run(dedup_index.compact)
+            # اجرای پاکسازی
+            await storage.run(cleanup_old_files)
+            # انتظار 2 ساعت
+            await asyncio.sleep(2 * 60 * 60)  # تبدیل 2 ساعت به ثانیه
+        except Exception as e:
+            print(f"❌ خطا در برنامه‌ریز پاکسازی: {e}")
+            # در صورت خطا، 5 دقیقه صبر می‌کنیم و دوباره تلاش می‌کنیم
+            await asyncio.sleep(5 * 60)
+
+# بررسی و تنظیم پروکسی
+def get_proxy_config():
+    """
+    بررسی تنظیمات پروکسی و برگرداندن کانفیگ مناسب
+    """
+    if PROXY_CONFIG and PROXY_CONFIG.get("server") and PROXY_CONFIG.get("port"):
+        proxy = {
+            "scheme": PROXY_CONFIG.get("scheme", "socks5"),
+            "hostname": PROXY_CONFIG["server"],
+            "port": PROXY_CONFIG["port"]
         }
-    except Exception as e:
-        print(f"❌ خطا در محاسبه آمار: {e}")
+        # اضافه کردن احراز هویت در صورت وجود
+        if PROXY_CONFIG.get("user") and PROXY_CONFIG.get("pass"):
+            proxy["username"] = PROXY_CONFIG["user"]
+            proxy["password"] = PROXY_CONFIG["pass"]
+        return proxy
+    return None
+
+# تابع کنترل دسترسی
+def is_allowed_chat(chat_id):
+    """
+    بررسی اینکه کاربر اجازه استفاده دارد یا خیر
+    در صورت خالی بودن لیست، همه کاربران مجاز هستند
+    """
+    try:
+        if chat_id is None:
+            return False
+        # اگر لیست خالی باشد، همه مجاز هستند
+        if not ALLOWED_CHAT_IDS:
+            return True
+        return int(chat_id) in ALLOWED_CHAT_IDS
+    except Exception:
+        return False
+
+# تابع تولید لینک عمومی
+def build_public_url(file_name):
+    """
+    تولید لینک عمومی برای فایل و حذف مسیر پایه از آن
+    """
+    if YOUR_DOMAIN.startswith('http://') or YOUR_DOMAIN.startswith('https://'):
+        base = YOUR_DOMAIN.rstrip('/')
+    else:
+        base = f"https://{YOUR_DOMAIN}".rstrip('/')
+    
+    # استفاده از مسیر نسبی برای URL
+    relative_path = config.get('download_path', 'dl').replace(BASE_STORAGE_PATH, '').lstrip('/')
+    return f"{base}/{relative_path}/{file_name}"
+
+# پسوندهای هر نوع فایل (هم‌راستا با فیلترهای index.html)
+MEDIA_TYPE_EXTENSIONS = [
+    ('video', {'mp4', 'webm', 'ogg', 'm3u8', 'avi', 'mov', 'wmv', 'flv', 'mkv'}),
+    ('image', {'jpg', 'jpeg', 'png', 'gif', 'bmp', 'svg', 'webp'}),
+    ('audio', {'mp3', 'wav', 'ogg', 'flac', 'aac', 'm4a'}),
+    ('document', {'pdf', 'doc', 'docx', 'xls', 'xlsx', 'ppt', 'pptx', 'txt', 'rtf'}),
+]
+
+def get_media_type(file_name):
+    """
+    تعیین نوع فایل براساس پسوند آن (video, image, audio, document, other)
+    """
+    extension = os.path.splitext(file_name)[1].lstrip('.').lower()
+    for media_type, extensions in MEDIA_TYPE_EXTENSIONS:
+        if extension in extensions:
+            return media_type
+    return 'other'
+
+@dataclass
+class FileEntry:
+    """
+    مشخصات یک فایل ذخیره شده در ایندکس
+    """
+    name: str
+    size: int
+    mtime: float
+    public_url: str
+    media_type: str
+    last_access: float = 0.0
+    inode: int = 0
+    thumbnail_url: str = ''
+
+# پسوند فایل‌های نیمه‌کاره که نباید در ایندکس و manifest ظاهر شوند
+PARTIAL_SUFFIXES = ('.part', '.temp')
+# تصاویر کوچک در پوشه مخفی جداگانه با همان مسیر نسبی فایل ذخیره می‌شوند تا
+# با فایل‌های کاربران (مثلاً scan.thumb.jpg) تداخل نداشته باشند
+THUMBNAIL_DIR = '.thumbs'
+# پسوند تصاویر کوچک نسخه‌های قبلی که کنار خود فایل ذخیره می‌شدند
+LEGACY_THUMBNAIL_SUFFIX = '.thumb.jpg'
+
+def thumbnail_name(name: str) -> str:
+    """
+    مسیر نسبی تصویر کوچک یک فایل در مسیر دانلود
+    """
+    return f"{THUMBNAIL_DIR}/{name}.jpg"
+
+class FileIndex:
+    """
+    ایندکس درون‌حافظه‌ای فایل‌های مسیر دانلود
+    یکبار در شروع برنامه با یک پیمایش os.scandir ساخته می‌شود و
+    سپس با هر اضافه یا حذف فایل به‌صورت افزایشی بروزرسانی می‌شود
+    کلید هر فایل مسیر نسبی آن در مسیر دانلود است (در چیدمان flat همان نام فایل)
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, FileEntry] = {}
+        self.total_size = 0
+        self._lock = threading.Lock()
+
+    def _make_entry(self, name: str, st: os.stat_result, has_thumbnail: bool = False) -> FileEntry:
+        """
+        ساخت رکورد ایندکس از نتیجه stat
+        """
+        return FileEntry(
+            name=name,
+            size=st.st_size,
+            mtime=st.st_mtime,
+            public_url=build_public_url(name),
+            media_type=get_media_type(name),
+            last_access=max(st.st_atime, st.st_mtime),
+            inode=st.st_ino,
+            thumbnail_url=build_public_url(thumbnail_name(name)) if has_thumbnail else ''
+        )
+
+    def build(self) -> None:
+        """
+        ساخت کامل ایندکس با یک پیمایش os.scandir
+        """
+        entries = {}
+        total_size = 0
+        # پیمایش پوشه‌های shard (پوشه‌های مخفی مانند staging و تصاویر کوچک نادیده گرفته می‌شوند)
+        pending = ['']
+        while pending:
+            relative_dir = pending.pop()
+            try:
+                with os.scandir(os.path.join(self.path, relative_dir)) as it:
+                    for entry in it:
+                        name = f"{relative_dir}/{entry.name}" if relative_dir else entry.name
+                        try:
+                            if entry.is_dir(follow_symlinks=False):
+                                if not entry.name.startswith('.'):
+                                    pending.append(name)
+                                continue
+                            if not entry.is_file() or entry.name.endswith(PARTIAL_SUFFIXES):
+                                continue
+                            st = entry.stat()
+                        except OSError:
+                            continue
+                        entries[name] = self._make_entry(name, st)
+                        total_size += st.st_size
+            except FileNotFoundError:
+                pass
+
+        # انتقال تصاویر کوچک نسخه قبلی (کنار فایل تصویری یا ویدیویی خود) به پوشه تصاویر کوچک
+        for name in [name for name in entries if name.endswith(LEGACY_THUMBNAIL_SUFFIX)]:
+            source = entries.get(name[:-len(LEGACY_THUMBNAIL_SUFFIX)])
+            if not source or source.media_type not in ThumbnailStore.MEDIA_TYPES:
+                continue
+            target = os.path.join(self.path, thumbnail_name(source.name))
+            try:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                os.replace(os.path.join(self.path, name), target)
+            except OSError:
+                continue
+            total_size -= entries.pop(name).size
+
+        # اتصال تصاویر کوچک به فایل‌ها و حذف تصاویر کوچک بدون فایل
+        thumbnails_root = os.path.join(self.path, THUMBNAIL_DIR)
+        for directory, _, files in os.walk(thumbnails_root):
+            for file in files:
+                if file.endswith(PARTIAL_SUFFIXES):
+                    continue
+                path = os.path.join(directory, file)
+                source = entries.get(os.path.relpath(path, thumbnails_root)[:-len('.jpg')])
+                if source and file.endswith('.jpg'):
+                    source.thumbnail_url = build_public_url(thumbnail_name(source.name))
+                    continue
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+        with self._lock:
+            self.entries = entries
+            self.total_size = total_size
+        print(f"📇 ایندکس فایل‌ها ساخته شد: {len(entries)} فایل")
+
+    def add(self, name: str) -> Optional[FileEntry]:
+        """
+        اضافه یا بروزرسانی یک فایل در ایندکس با یک فراخوانی stat
+        """
+        try:
+            st = os.stat(os.path.join(self.path, name))
+        except OSError:
+            return None
+        file_entry = self._make_entry(
+            name, st, os.path.exists(os.path.join(self.path, thumbnail_name(name)))
+        )
+        with self._lock:
+            previous = self.entries.get(name)
+            if previous:
+                self.total_size -= previous.size
+            self.entries[name] = file_entry
+            self.total_size += file_entry.size
+        return file_entry
+
+    def remove(self, name: str) -> Optional[FileEntry]:
+        """
+        حذف یک فایل از ایندکس (بدون حذف از دیسک)
+        """
+        with self._lock:
+            file_entry = self.entries.pop(name, None)
+            if file_entry:
+                self.total_size -= file_entry.size
+        return file_entry
+
+    def get(self, name: str) -> Optional[FileEntry]:
+        """
+        دریافت رکورد یک فایل
+        """
+        return self.entries.get(name)
+
+    def snapshot(self) -> List[FileEntry]:
+        """
+        دریافت کپی از رکوردهای فعلی ایندکس
+        """
+        with self._lock:
+            return list(self.entries.values())
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+# ایجاد نمونه ایندکس فایل‌ها
+file_index = FileIndex(DOWNLOAD_PATH)
+
+# تابع محاسبه آمار فایل‌ها
+def get_file_stats():
+    """
+    محاسبه آمار فایل‌های موجود از روی ایندکس درون‌حافظه‌ای (بدون دسترسی به دیسک)
+    """
+    now = time.time()
+    files = [
+        {
+            'name': entry.name,
+            'size': entry.size,
+            'age_hours': (now - entry.mtime) / 3600
+        }
+        for entry in file_index.snapshot()
+    ]
+    return {
+        'total_files': len(files),
+        'total_size_mb': file_index.total_size / (1024 * 1024),
+        'files': files
+    }
+
+# ردیابی دسترسی به فایل‌ها از روی لاگ nginx
+class AccessTracker:
+    """
+    خواندن افزایشی لاگ دسترسی nginx و تجمیع تعداد بازدید و زمان آخرین دسترسی هر فایل
+    - موقعیت خواندن (offset) و inode لاگ ذخیره می‌شود تا پس از راه‌اندازی مجدد
+      درخواست‌ها دوباره شمرده نشوند
+    - چرخش لاگ (تغییر inode) و کوتاه شدن آن (copytruncate) تشخیص داده می‌شود
+    - درخواست‌های Range پشت سر هم یک کلاینت (مثلاً پخش ویدیو) در بازه
+      hit_window_seconds یک بازدید حساب می‌شوند
+    """
+    LINE_PATTERN = re.compile(
+        r'^(?P<ip>\S+) \S+ \S+ \[(?P<time>[^\]]+)\] "(?:GET|HEAD) (?P<path>[^ "]+)[^"]*" (?P<status>\d{3})'
+    )
+    COUNTED_STATUSES = ('200', '206', '304')
+
+    def __init__(self, log_path: str, stats_path: str, url_prefix: str,
+                 poll_seconds: float = 30, hit_window_seconds: float = 60):
+        self.log_path = log_path
+        self.stats_path = stats_path
+        self.url_prefix = url_prefix
+        self.poll_seconds = poll_seconds
+        self.hit_window_seconds = hit_window_seconds
+        # name -> [hits, last_access]
+        self.stats: Dict[str, List[float]] = {}
+        self.offset = 0
+        self.inode = None
+        self._file = None
+        self._recent: Dict[Tuple[str, str], float] = {}
+        self._time_cache: Dict[str, float] = {}
+        self._dirty = False
+        self._missing_logged = False
+        self._lock = threading.Lock()
+
+    def load(self) -> None:
+        """
+        خواندن آمار ذخیره شده و موقعیت قبلی لاگ
+        """
+        try:
+            with open(self.stats_path, 'r', encoding='utf-8') as f:
+                data = json.load(f)
+            self.stats = data.get('files', {})
+            self.offset = data.get('offset', 0)
+            self.inode = data.get('inode')
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"⚠️ خطا در خواندن آمار دسترسی: {e}")
+
+    def save(self) -> None:
+        """
+        ذخیره اتمیک آمار و موقعیت لاگ (فقط آمار فایل‌های موجود نگه داشته می‌شود)
+        """
+        with self._lock:
+            self.stats = {name: value for name, value in self.stats.items() if file_index.get(name)}
+            data = json.dumps(
+                {'offset': self.offset, 'inode': self.inode, 'files': self.stats},
+                ensure_ascii=False, separators=(',', ':')
+            )
+            self._dirty = False
+        try:
+            tmp_path = f"{self.stats_path}.tmp"
+            with open(tmp_path, 'w', encoding='utf-8') as f:
+                f.write(data)
+            os.replace(tmp_path, self.stats_path)
+        except Exception as e:
+            print(f"⚠️ خطا در ذخیره آمار دسترسی: {e}")
+
+    def clear_caches(self) -> None:
+        """
+        خالی کردن کش زمان‌های تجزیه شده و پنجره تشخیص بازدید تکراری (هنگام فشار حافظه)
+        """
+        with self._lock:
+            self._time_cache.clear()
+            self._recent.clear()
+
+    def _parse_time(self, value: str) -> float:
+        timestamp = self._time_cache.get(value)
+        if timestamp is None:
+            timestamp = datetime.strptime(value, '%d/%b/%Y:%H:%M:%S %z').timestamp()
+            if len(self._time_cache) > 1024:
+                self._time_cache.clear()
+            self._time_cache[value] = timestamp
+        return timestamp
+
+    def _process_line(self, line: str) -> None:
+        match = self.LINE_PATTERN.match(line)
+        if not match or match.group('status') not in self.COUNTED_STATUSES:
+            return
+        path = match.group('path').split('?', 1)[0]
+        if not path.startswith(self.url_prefix):
+            return
+        name = unquote(path[len(self.url_prefix):])
+        if not name or name.startswith('/') or '..' in name.split('/'):
+            return
+        try:
+            timestamp = self._parse_time(match.group('time'))
+        except ValueError:
+            return
+        self.record_hit(name, match.group('ip'), timestamp)
+
+    def record_hit(self, name: str, client_ip: str, timestamp: float) -> None:
+        """
+        ثبت یک دسترسی به فایل (از لاگ nginx یا سرور HTTP داخلی)
+        """
+        with self._lock:
+            entry = self.stats.setdefault(name, [0, 0.0])
+            key = (client_ip, name)
+            if timestamp - self._recent.get(key, float('-inf')) >= self.hit_window_seconds:
+                entry[0] += 1
+                self._recent[key] = timestamp
+            entry[1] = max(entry[1], timestamp)
+            self._dirty = True
+
+    def _read_available(self) -> None:
+        """
+        پردازش خطوط کامل جدید از موقعیت فعلی؛ خط نیمه‌نوشته برای دور بعد می‌ماند
+        """
+        self._file.seek(self.offset)
+        for raw_line in self._file:
+            if not raw_line.endswith(b'\n'):
+                break
+            self.offset += len(raw_line)
+            self._process_line(raw_line.decode('utf-8', errors='replace'))
+
+    def poll(self) -> None:
+        """
+        خواندن خطوط جدید لاگ و ذخیره آمار (در thread ذخیره‌سازی اجرا می‌شود)
+        """
+        if self.log_path:
+            self._read_log()
+
+        # حذف رکوردهای قدیمی پنجره تشخیص بازدید تکراری
+        horizon = time.time() - self.hit_window_seconds
+        with self._lock:
+            self._recent = {key: ts for key, ts in self._recent.items() if ts >= horizon}
+        if self._dirty:
+            self.save()
+
+    def _read_log(self) -> None:
+        try:
+            st = os.stat(self.log_path)
+        except FileNotFoundError:
+            if not self._missing_logged:
+                print(f"⚠️ لاگ دسترسی nginx یافت نشد: {self.log_path}")
+                self._missing_logged = True
+            return
+        self._missing_logged = False
+
+        if self._file is not None and os.fstat(self._file.fileno()).st_ino != st.st_ino:
+            # لاگ چرخیده است: باقیمانده فایل قبلی خوانده و فایل جدید از ابتدا باز می‌شود
+            self._read_available()
+            self._file.close()
+            self._file = None
+            self.offset = 0
+
+        if self._file is None:
+            self._file = open(self.log_path, 'rb')
+            if self.inode != st.st_ino:
+                self.offset = 0
+            self.inode = st.st_ino
+
+        if st.st_size < self.offset:
+            # لاگ کوتاه شده است (copytruncate)
+            self.offset = 0
+        self._read_available()
+
+    def hits(self, name: str) -> int:
+        entry = self.stats.get(name)
+        return int(entry[0]) if entry else 0
+
+    def last_access(self, name: str) -> float:
+        entry = self.stats.get(name)
+        return entry[1] if entry else 0.0
+
+    def hot_files(self, limit: int = 5) -> List[Tuple[str, int, float]]:
+        """
+        پربازدیدترین فایل‌های موجود: (name, hits, last_access)
+        """
+        items = [
+            (name, int(value[0]), value[1]) for name, value in list(self.stats.items())
+            if value[0] and file_index.get(name)
+        ]
+        return heapq.nlargest(limit, items, key=lambda item: (item[1], item[2]))
+
+    async def run(self) -> None:
+        """
+        حلقه خواندن دوره‌ای لاگ
+        """
+        while True:
+            try:
+                await storage.run(self.poll)
+            except Exception as e:
+                print(f"❌ خطا در خواندن لاگ دسترسی: {e}")
+            await asyncio.sleep(self.poll_seconds)
+
+# ایجاد نمونه ردیاب دسترسی
+access_tracker = AccessTracker(
+    ACCESS_LOG_CONFIG.get('path', '/var/log/nginx/access.log'),
+    ACCESS_STATS_PATH,
+    DOWNLOAD_URL_PREFIX,
+    poll_seconds=ACCESS_LOG_CONFIG.get('poll_seconds', 30),
+    hit_window_seconds=ACCESS_LOG_CONFIG.get('hit_window_seconds', 60)
+)
+
+@dataclass
+class EvictionResult:
+    """
+    نتیجه یک دور پاکسازی
+    """
+    files_removed: int = 0
+    bytes_freed: int = 0
+    expired: int = 0
+
+class EvictionEngine:
+    """
+    موتور حذف فایل‌ها براساس عمر، حجم و دسترسی
+    - فایل‌های قدیمی‌تر از file_max_age_hours همیشه حذف می‌شوند (TTL)
+    - اگر مصرف دیسک از high_watermark بیشتر باشد، حجم لازم برای رسیدن به
+      low_watermark یکبار محاسبه شده و فایل‌ها به ترتیب سیاست از heap انتخاب می‌شوند:
+      ttl (قدیمی‌ترین)، lru (دورترین دسترسی) یا size (حجم × زمان بیکاری ÷ تعداد بازدید)
+    - همه فایل‌های انتخاب شده یکجا حذف شده و manifest فقط یکبار بروزرسانی می‌شود
+    نام‌های hardlink یک داده با هم حذف می‌شوند چون فضا فقط با حذف همه آن‌ها آزاد می‌شود
+    """
+    POLICIES = ('ttl', 'lru', 'size')
+
+    def __init__(self, path: str, max_age_hours: float, policy: str = 'lru',
+                 high_watermark: float = 90.0, low_watermark: float = 75.0):
+        if policy not in self.POLICIES:
+            print(f"⚠️ سیاست حذف نامعتبر '{policy}'، از lru استفاده می‌شود")
+            policy = 'lru'
+        self.path = path
+        self.max_age_seconds = max_age_hours * 3600 if max_age_hours and max_age_hours > 0 else 0
+        self.policy = policy
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+
+    def disk_usage(self) -> Tuple[int, int]:
+        """
+        فضای کل و فضای استفاده شده دیسک مسیر دانلود (بایت)
+        """
+        st = os.statvfs(self.path)
+        total_space = st.f_blocks * st.f_frsize
+        free_space = st.f_bavail * st.f_frsize
+        return total_space, total_space - free_space
+
+    def bytes_to_free(self, extra_bytes: int = 0) -> int:
+        """
+        حجمی که باید آزاد شود تا مصرف دیسک به low_watermark برسد
+        extra_bytes: حجمی که به زودی نوشته می‌شود (دانلودهای در جریان و جدید)
+        """
+        total_space, used_space = self.disk_usage()
+        used_space += extra_bytes
+        if total_space <= 0 or used_space * 100 / total_space <= self.high_watermark:
+            return 0
+        return max(0, used_space - int(total_space * self.low_watermark / 100))
+
+    @staticmethod
+    def last_access(entry: FileEntry) -> float:
+        # آخرین دانلود از روی لاگ nginx در کنار زمان ذخیره فایل
+        return max(entry.mtime, entry.last_access, access_tracker.last_access(entry.name))
+
+    def score(self, entries: List[FileEntry], now: float) -> float:
+        """
+        امتیاز حذف یک داده؛ امتیاز کمتر زودتر حذف می‌شود
+        """
+        if self.policy == 'ttl':
+            return max(entry.mtime for entry in entries)
+        last_access = max(self.last_access(entry) for entry in entries)
+        if self.policy == 'size':
+            hits = sum(access_tracker.hits(entry.name) for entry in entries)
+            return -entries[0].size * (now - last_access) / (1 + hits)
+        return last_access
+
+    def plan(self, entries: List[FileEntry], bytes_needed: int, now: float,
+             protected: set) -> Tuple[List[List[FileEntry]], int]:
+        """
+        انتخاب داده‌های قابل حذف: ابتدا فایل‌های منقضی و سپس براساس heap سیاست
+        تا زمانی که bytes_needed آزاد شود
+        """
+        units: Dict = {}
+        for entry in entries:
+            units.setdefault(entry.inode or entry.name, []).append(entry)
+
+        victims = []
+        freed = 0
+        heap = []
+        for unit in units.values():
+            if any(entry.name in protected for entry in unit):
+                continue
+            if self.max_age_seconds and now - max(entry.mtime for entry in unit) > self.max_age_seconds:
+                victims.append(unit)
+                freed += unit[0].size
+                continue
+            heap.append((self.score(unit, now), unit[0].name, unit))
+
+        expired = len(victims)
+        heapq.heapify(heap)
+        while freed < bytes_needed and heap:
+            _, _, unit = heapq.heappop(heap)
+            victims.append(unit)
+            freed += unit[0].size
+        return victims, expired
+
+    def remove_units(self, units: List[List[FileEntry]], result: EvictionResult) -> EvictionResult:
+        """
+        حذف داده‌های انتخاب شده از دیسک و ایندکس و ثبت آن در نتیجه
+        """
+        for unit in units:
+            for entry in unit:
+                try:
+                    os.remove(os.path.join(self.path, entry.name))
+                except FileNotFoundError:
+                    pass
+                except Exception as e:
+                    print(f"❌ خطا در حذف {entry.name}: {e}")
+                    continue
+                thumbnail_store.remove(entry.name)
+                file_index.remove(entry.name)
+                prune_shard_dirs(entry.name)
+                result.files_removed += 1
+            result.bytes_freed += unit[0].size
+        return result
+
+    def run(self, extra_bytes: Optional[int] = None) -> EvictionResult:
+        """
+        اجرای یک دور پاکسازی (در thread ذخیره‌سازی اجرا می‌شود)
+        extra_bytes: حجم رزرو شده برای دانلودها؛ پیش‌فرض رزروهای فعلی کنترل پذیرش
+        """
+        now = time.time()
+        protected = {
+            download.file_name for download in list(download_manager.active_downloads.values())
+            if download.file_name
+        }
+        if extra_bytes is None:
+            extra_bytes = storage_admission.reserved_bytes()
+        bytes_needed = self.bytes_to_free(extra_bytes)
+        victims, expired = self.plan(file_index.snapshot(), bytes_needed, now, protected)
+
+        result = self.remove_units(victims, EvictionResult(expired=expired))
+        metrics.inc('cleanup_bytes_freed_total', result.bytes_freed, reason=self.policy)
+        metrics.inc('cleanup_files_removed_total', result.files_removed, reason=self.policy)
+        if result.files_removed:
+            update_config_file_list()
+            print(
+                f"🧹 پاکسازی ({self.policy}): {result.files_removed} فایل حذف شد، "
+                f"{result.bytes_freed / (1024 * 1024):.1f} MB آزاد شد ({result.expired} فایل منقضی)"
+            )
+        return result
+
+# ایجاد نمونه موتور حذف
+eviction_engine = EvictionEngine(
+    DOWNLOAD_PATH,
+    FILE_MAX_AGE_HOURS,
+    policy=EVICTION_CONFIG.get('policy', 'lru'),
+    high_watermark=EVICTION_CONFIG.get('high_watermark_percent', 90),
+    low_watermark=EVICTION_CONFIG.get('low_watermark_percent', 75)
+)
+
+class InsufficientStorageError(Exception):
+    """
+    فضای دیسک برای ذخیره فایل کافی نیست
+    """
+
+class StorageAdmission:
+    """
+    کنترل پذیرش دانلودها پیش از شروع انتقال براساس مصرف پیش‌بینی شده دیسک
+    - حجم هر فایل پیش از دانلود رزرو می‌شود؛ بخش دانلود نشده رزروهای در جریان
+      در محاسبه فضای آزاد لحاظ می‌شود
+    - اگر مصرف پیش‌بینی شده از high_watermark بیشتر شود، ابتدا موتور حذف اجرا می‌شود
+    - اگر باز هم جا نشود و دانلود دیگری در جریان باشد، دانلود تا آزاد شدن رزروها
+      منتظر می‌ماند؛ فایلی که حتی با حذف همه فایل‌های ربات جا نمی‌شود رد می‌شود
+    """
+    def __init__(self, retry_seconds: float = 30):
+        self.retry_seconds = retry_seconds
+        # key -> (file_size, transfer)
+        self.reservations: Dict[str, Tuple[int, SharedTransfer]] = {}
+        self.rejected = 0
+        self._lock = threading.Lock()
+        self._released: Optional[asyncio.Event] = None
+
+    def reserved_bytes(self) -> int:
+        """
+        حجم باقیمانده رزروها (بخشی که هنوز روی دیسک نوشته یا پیش‌تخصیص داده نشده است)
+        """
+        return sum(
+            0 if transfer and transfer.preallocated else max(0, size - (transfer.current if transfer else 0))
+            for size, transfer in list(self.reservations.values())
+        )
+
+    def _fits(self, extra_bytes: int) -> bool:
+        total_space, used_space = eviction_engine.disk_usage()
+        return used_space + extra_bytes <= total_space * eviction_engine.high_watermark / 100
+
+    def try_reserve(self, key: str, file_size: int, transfer: Optional[SharedTransfer]) -> str:
+        """
+        تلاش برای رزرو فضا (در thread ذخیره‌سازی اجرا می‌شود)
+        خروجی: ok (رزرو شد)، wait (انتظار برای رزروهای دیگر) یا reject
+        """
+        with self._lock:
+            extra_bytes = self.reserved_bytes() + file_size
+            if not self._fits(extra_bytes):
+                # حذف پیشاپیش فایل‌ها برای باز کردن فضای لازم
+                eviction_engine.run(extra_bytes)
+            if self._fits(extra_bytes):
+                self.reservations[key] = (file_size, transfer)
+                return 'ok'
+            # فایل حتی با حذف همه فایل‌های ربات هم جا نمی‌شود
+            total_space, used_space = eviction_engine.disk_usage()
+            foreign_bytes = max(0, used_space - file_index.total_size)
+            if self.reservations and foreign_bytes + file_size <= total_space * eviction_engine.high_watermark / 100:
+                return 'wait'
+            self.rejected += 1
+            return 'reject'
+
+    async def admit(self, key: str, file_size: int, transfer: Optional[SharedTransfer] = None,
+                    on_wait: Optional[Callable[[], Awaitable]] = None) -> None:
+        """
+        انتظار تا زمان رزرو فضای فایل یا خطای InsufficientStorageError
+        """
+        if not file_size:
+            return
+        if self._released is None:
+            self._released = asyncio.Event()
+        notified = False
+        while True:
+            # پاک کردن رویداد پیش از بررسی تا آزادسازی همزمان با try_reserve از دست نرود
+            self._released.clear()
+            decision = await storage.run(self.try_reserve, key, file_size, transfer)
+            if decision == 'ok':
+                return
+            if decision == 'reject':
+                raise InsufficientStorageError(
+                    f"فضای کافی روی دیسک برای این فایل وجود ندارد ({file_size / (1024 * 1024):.1f} MB)"
+                )
+            if on_wait and not notified:
+                notified = True
+                await on_wait()
+            # بررسی مجدد با آزاد شدن هر رزرو یا پس از retry_seconds (برای تغییرات خارجی دیسک)
+            try:
+                await asyncio.wait_for(self._released.wait(), self.retry_seconds)
+            except asyncio.TimeoutError:
+                pass
+
+    def release(self, key: str) -> None:
+        """
+        آزادسازی رزرو پس از پایان، لغو یا خطای دانلود
+        """
+        with self._lock:
+            if self.reservations.pop(key, None) is None:
+                return
+        if self._released is not None:
+            self._released.set()
+
+# ایجاد نمونه کنترل پذیرش
+storage_admission = StorageAdmission(ADMISSION_RETRY_SECONDS)
+
+# ترتیب تب‌های فیلتر در index.html
+MEDIA_TYPES = ['video', 'image', 'audio', 'document', 'other']
+
+class ManifestWriter:
+    """
+    نویسنده manifest فایل‌ها با تجمیع تغییرات پشت سر هم
+    تغییرات در یک بازه زمانی قابل تنظیم تجمیع شده و فقط یک بار نوشته می‌شوند؛
+    سریال‌سازی در thread جداگانه انجام شده و فایل‌ها با write-to-temp + os.replace
+    منتشر می‌شوند تا nginx هرگز فایل نیمه‌نوشته را ارائه ندهد
+
+    خروجی اصلی یک manifest صفحه‌بندی شده است:
+    - files/index.json: تعداد و لیست صفحات هر نوع فایل
+    - files/<type>-<hash>.json: صفحات تغییرناپذیر با نام وابسته به محتوا
+    files.json قدیمی در صورت فعال بودن write_legacy_manifest همچنان نوشته می‌شود
+    """
+    def __init__(self, path: str, pages_dir: str, debounce_seconds: float = 2.0,
+                 page_size: int = 100, write_legacy: bool = True):
+        self.path = path
+        self.pages_dir = pages_dir
+        self.debounce_seconds = debounce_seconds
+        self.page_size = max(1, page_size)
+        self.write_legacy = write_legacy
+        self._previous_pages = set()
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._write_lock = threading.Lock()
+
+    def start(self, loop: asyncio.AbstractEventLoop) -> None:
+        """
+        فعال‌سازی حالت تجمیع روی event loop اصلی
+        """
+        self._loop = loop
+
+    def schedule(self) -> None:
+        """
+        علامت‌گذاری manifest به عنوان تغییر یافته و زمان‌بندی نوشتن
+        قابل فراخوانی از event loop یا threadهای دیگر
+        """
+        loop = self._loop
+        if loop is None or loop.is_closed():
+            # قبل از راه‌اندازی loop مستقیماً می‌نویسیم
+            self.write_now()
+            return
+
+        self._dirty = True
+        try:
+            running_loop = asyncio.get_running_loop()
+        except RuntimeError:
+            running_loop = None
+        if running_loop is loop:
+            self._ensure_task()
+        else:
+            loop.call_soon_threadsafe(self._ensure_task)
+
+    def _ensure_task(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = self._loop.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        """
+        انتظار برای پایان بازه تجمیع و سپس نوشتن در thread جداگانه
+        """
+        while self._dirty:
+            await asyncio.sleep(self.debounce_seconds)
+            self._dirty = False
+            await storage.run(self.write_now)
+
+    async def flush(self) -> None:
+        """
+        نوشتن فوری تغییرات در انتظار (هنگام توقف برنامه)
+        """
+        if self._task and not self._task.done():
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+        if self._dirty:
+            self._dirty = False
+            await storage.run(self.write_now)
+
+    @staticmethod
+    def _serialize_entry(entry: FileEntry) -> Dict:
+        """
+        تبدیل رکورد ایندکس به آیتم manifest
+        هر آیتم شامل: name, size_bytes, public_url و در صورت وجود thumbnail_url
+        """
+        item = {
+            'name': os.path.basename(entry.name),
+            'size_bytes': entry.size,
+            'public_url': entry.public_url
+        }
+        if entry.thumbnail_url:
+            item['thumbnail_url'] = entry.thumbnail_url
+        return item
+
+    @staticmethod
+    def _atomic_write(path: str, data: str) -> None:
+        """
+        نوشتن در فایل موقت و جایگزینی اتمیک با os.replace
+        """
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(data)
+        os.replace(tmp_path, path)
+
+    def _write_pages(self, entries: List[FileEntry]) -> Dict:
+        """
+        نوشتن صفحات هر نوع فایل و برگرداندن محتوای index.json
+        صفحه‌ها از قدیمی‌ترین فایل شمرده می‌شوند تا با اضافه شدن فایل جدید فقط صفحه
+        ابتدایی (جدیدترین، ناقص) تغییر کند و صفحات کامل قدیمی‌تر همان محتوا و نام را حفظ کنند
+        صفحاتی که قبلاً با همان محتوا نوشته شده‌اند دوباره نوشته نمی‌شوند
+        """
+        os.makedirs(self.pages_dir, exist_ok=True)
+        by_type: Dict[str, List[Dict]] = {media_type: [] for media_type in MEDIA_TYPES}
+        for entry in entries:
+            by_type.setdefault(entry.media_type, []).append(self._serialize_entry(entry))
+
+        types = {}
+        current_pages = set()
+        for media_type, items in by_type.items():
+            pages = []
+            oldest_first = items[::-1]
+            for offset in range(0, len(oldest_first), self.page_size):
+                # ترتیب نمایش (جدیدترین اول) داخل صفحه و در لیست صفحات حفظ می‌شود
+                data = json.dumps(
+                    {'files': oldest_first[offset:offset + self.page_size][::-1]},
+                    ensure_ascii=False,
+                    separators=(',', ':')
+                )
+                digest = hashlib.sha1(data.encode('utf-8')).hexdigest()[:16]
+                page_name = f"{media_type}-{digest}.json"
+                page_path = os.path.join(self.pages_dir, page_name)
+                if not os.path.exists(page_path):
+                    self._atomic_write(page_path, data)
+                pages.append(page_name)
+                current_pages.add(page_name)
+            types[media_type] = {'count': len(items), 'pages': pages[::-1]}
+
+        # حذف صفحاتی که نه در نسخه فعلی و نه در نسخه قبلی استفاده می‌شوند
+        # (صفحات نسخه قبلی برای کلاینت‌هایی که index قبلی را دارند نگه داشته می‌شوند)
+        keep = current_pages | self._previous_pages
+        with os.scandir(self.pages_dir) as it:
+            for dir_entry in it:
+                if dir_entry.name.endswith('.json') and dir_entry.name != 'index.json' \
+                        and dir_entry.name not in keep:
+                    try:
+                        os.remove(dir_entry.path)
+                    except OSError:
+                        pass
+        self._previous_pages = current_pages
+
         return {
-            'total_files': 0,
-            'total_size_mb': 0,
-            'files': []
+            'generated_at': int(time.time()),
+            'total_files': len(entries),
+            'page_size': self.page_size,
+            'types': types
+        }
+
+    def write_now(self) -> None:
+        """
+        سریال‌سازی فشرده و انتشار اتمیک manifest صفحه‌بندی شده و files.json
+        """
+        started = time.perf_counter()
+        try:
+            with self._write_lock:
+                entries = sorted(file_index.snapshot(), key=lambda x: x.mtime, reverse=True)
+
+                index = self._write_pages(entries)
+                self._atomic_write(
+                    os.path.join(self.pages_dir, 'index.json'),
+                    json.dumps(index, ensure_ascii=False, separators=(',', ':'))
+                )
+
+                if self.write_legacy:
+                    out_files = [self._serialize_entry(entry) for entry in entries]
+                    self._atomic_write(
+                        self.path,
+                        json.dumps(out_files, ensure_ascii=False, separators=(',', ':'))
+                    )
+
+            metrics.observe('manifest_rebuild_seconds', time.perf_counter() - started)
+            print(f"✅ manifest updated with {len(entries)} files")
+        except Exception as e:
+            print(f"❌ خطا در بروزرسانی files.json: {e}")
+
+# Write files.json into the webroot (BASE_STORAGE_PATH) so the web server can serve it
+manifest_writer = ManifestWriter(
+    os.path.join(BASE_STORAGE_PATH, 'files.json'),
+    os.path.join(BASE_STORAGE_PATH, 'files'),
+    debounce_seconds=MANIFEST_DEBOUNCE_SECONDS,
+    page_size=MANIFEST_PAGE_SIZE,
+    write_legacy=WRITE_LEGACY_MANIFEST
+)
+
+def update_config_file_list():
+    """
+    درخواست بروزرسانی manifest فایل‌ها (files/index.json و files.json) در webroot
+    نوشتن واقعی توسط manifest_writer تجمیع و خارج از event loop انجام می‌شود
+    """
+    manifest_writer.schedule()
+
+# شمارنده‌های سرور HTTP داخلی
+class HttpStats:
+    """
+    آمار درخواست‌های سرور HTTP داخلی: تعداد براساس کد وضعیت و بایت‌های ارسالی
+    (توزیع تأخیر فقط در هیستوگرام http_request_seconds ثبت می‌شود)
+    """
+    def __init__(self):
+        self.requests: Dict[int, int] = {}
+        self.bytes_sent = 0
+        self.in_flight = 0
+
+    def observe(self, status: int, bytes_sent: int, latency: float) -> None:
+        metrics.inc('http_requests_total', status=status)
+        metrics.inc('http_bytes_sent_total', bytes_sent)
+        metrics.observe('http_request_seconds', latency)
+        self.requests[status] = self.requests.get(status, 0) + 1
+        self.bytes_sent += bytes_sent
+
+    def total_requests(self) -> int:
+        return sum(self.requests.values())
+
+metrics.counter('http_requests_total', 'Requests served by the built-in HTTP server by status')
+metrics.counter('http_bytes_sent_total', 'Bytes sent by the built-in HTTP server')
+metrics.histogram('http_request_seconds', 'Built-in HTTP server request latency',
+                  (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+
+if web is not None:
+    class MeteredFileResponse(web.FileResponse):
+        """
+        FileResponse با sendfile که در شروع و پایان ارسال، callback های آمار را فراخوانی می‌کند
+        (کد وضعیت 206/304 و حجم بازه فقط در prepare مشخص می‌شوند؛ پاسخی که هرگز
+        ارسال نشود در آمار درخواست‌های در جریان باقی نمی‌ماند)
+        """
+        def __init__(self, path, on_start: Callable, on_sent: Callable, **kwargs):
+            super().__init__(path, **kwargs)
+            self._on_start = on_start
+            self._on_sent = on_sent
+
+        async def prepare(self, request):
+            self._on_start()
+            try:
+                return await super().prepare(request)
+            finally:
+                self._on_sent(self)
+
+# سرور HTTP داخلی به عنوان جایگزین nginx
+class FileServer:
+    """
+    سرور فایل async داخلی برای اجرا بدون nginx (مثلاً در کانتینر)
+    - /dl/...: فایل‌های مسیر دانلود با sendfile، پشتیبانی از Range و ETag/If-None-Match
+    - /files.json و /files/...: manifest فایل‌ها با همان سیاست کش nginx
+    - /: صفحه index.html
+    هر درخواست در HttpStats ثبت شده و دانلودها در ردیاب دسترسی شمرده می‌شوند
+    """
+    def __init__(self, host: str = '0.0.0.0', port: int = 8080, url_prefix: str = '/dl/'):
+        self.host = host
+        self.port = port
+        self.url_prefix = url_prefix
+        self.stats = HttpStats()
+        self._runner = None
+
+    @property
+    def running(self) -> bool:
+        return self._runner is not None
+
+    @staticmethod
+    def _safe_path(base: str, relative_path: str) -> Optional[str]:
+        """
+        تبدیل مسیر درخواست به مسیر فایل بدون امکان خروج از پوشه پایه یا دسترسی به پوشه‌های مخفی
+        (به جز پوشه تصاویر کوچک)
+        """
+        parts = [part for part in relative_path.split('/') if part]
+        visible = parts[1:] if parts and parts[0] == THUMBNAIL_DIR else parts
+        if not visible or any(part.startswith('.') for part in visible):
+            return None
+        path = os.path.realpath(os.path.join(base, *parts))
+        if os.path.commonpath([path, os.path.realpath(base)]) != os.path.realpath(base):
+            return None
+        return path
+
+    def _file_started(self) -> None:
+        self.stats.in_flight += 1
+
+    def _file_sent(self, request, response) -> None:
+        """
+        ثبت آمار پس از ارسال کامل (یا قطع) یک فایل
+        """
+        self.stats.in_flight -= 1
+        bytes_sent = 0
+        if request.method == 'GET' and response.status in (200, 206):
+            bytes_sent = response.content_length or 0
+        self.stats.observe(response.status, bytes_sent, time.perf_counter() - request['started_at'])
+        if bytes_sent and request.get('download_name'):
+            access_tracker.record_hit(request['download_name'], request.remote or '-', time.time())
+
+    async def _send_file(self, request, path: Optional[str], cache_control: str):
+        if path is None or not await storage.run(os.path.isfile, path):
+            raise web.HTTPNotFound()
+        # آمار پس از پایان واقعی انتقال در prepare ثبت می‌شود
+        return MeteredFileResponse(
+            path,
+            on_start=self._file_started,
+            on_sent=lambda response: self._file_sent(request, response),
+            headers={'Cache-Control': cache_control}
+        )
+
+    async def _handle_download(self, request):
+        request['download_name'] = request.match_info['path']
+        path = self._safe_path(DOWNLOAD_PATH, request['download_name'])
+        lazy_enabled = LAZY_FETCH_CONFIG.get('enabled', False)
+        if (STREAM_THROUGH or lazy_enabled) and path is not None and not await storage.run(os.path.isfile, path):
+            transfer = download_manager.find_transfer_by_name(request['download_name'])
+            lazy_entry = lazy_registry.get(request['download_name']) if lazy_enabled else None
+            if transfer is None and lazy_entry is not None:
+                # همین داده ممکن است با نام دیگری در کش موجود باشد
+                cached_name = dedup_index.lookup(lazy_entry['dedup_key'])
+                if cached_name:
+                    return await self._send_file(
+                        request, self._safe_path(DOWNLOAD_PATH, cached_name), 'public, max-age=2592000'
+                    )
+                transfer = fetch_lazy_file(request['download_name'])
+            if transfer is not None:
+                if STREAM_THROUGH:
+                    return await self._stream_transfer(request, transfer)
+                # انتقال با قطع اتصال کلاینت لغو نمی‌شود و کش پر می‌شود
+                try:
+                    _, file_name = await download_manager.wait_transfer(transfer)
+                except Exception as e:
+                    print(f"⚠️ خطا در دریافت فایل {request['download_name']}: {e}")
+                    raise web.HTTPBadGateway()
+                path = self._safe_path(DOWNLOAD_PATH, file_name)
+        return await self._send_file(request, path, 'public, max-age=2592000')
+
+    @staticmethod
+    def _chunk_available(transfer: SharedTransfer, index: int) -> bool:
+        """
+        آیا قطعه index از فایل در حال دانلود روی دیسک نوشته شده است
+        """
+        if transfer.sequential:
+            # pyrogram ترتیبی می‌نویسد؛ یک قطعه فاصله تا خالی شدن بافر نوشتن
+            return (index + 2) * ParallelDownloader.CHUNK_SIZE <= transfer.current
+        return index in transfer.chunks_done
+
+    @staticmethod
+    def _open_readable(transfer: SharedTransfer) -> int:
+        """
+        باز کردن فایل در حال نوشتن؛ اگر در این فاصله منتشر شده باشد از مسیر نهایی
+        """
+        for path in (transfer.readable_path,
+                     staging_store.staging_file(transfer.file_name),
+                     os.path.join(DOWNLOAD_PATH, transfer.file_name)):
+            try:
+                return os.open(path, os.O_RDONLY)
+            except FileNotFoundError:
+                continue
+        raise FileNotFoundError(transfer.file_name)
+
+    async def _transfer_chunks(self, transfer: SharedTransfer, start: int, stop: int):
+        """
+        تولید بایت‌های بازه [start, stop) از فایل در حال دانلود؛ قطعه‌های نوشته شده
+        از دیسک و قطعه‌های باقیمانده مستقیماً از تلگرام خوانده می‌شوند
+        """
+        chunk_size = ParallelDownloader.CHUNK_SIZE
+        index = start // chunk_size
+        last = (stop - 1) // chunk_size
+        fd = None
+        try:
+            while index <= last:
+                chunk_start = index * chunk_size
+                if self._chunk_available(transfer, index):
+                    if fd is None:
+                        fd = await storage.run(self._open_readable, transfer)
+                    low = max(start, chunk_start)
+                    high = min(stop, chunk_start + chunk_size)
+                    yield await storage.run(os.pread, fd, high - low, low)
+                    index += 1
+                    continue
+
+                # دریافت پشت سر هم قطعه‌های موجود نبودن از تلگرام
+                run_end = index
+                while run_end < last and not self._chunk_available(transfer, run_end + 1):
+                    run_end += 1
+                async for chunk in transfer.client.stream_media(
+                        transfer.message, offset=index, limit=run_end - index + 1):
+                    chunk_start = index * chunk_size
+                    low = max(start, chunk_start) - chunk_start
+                    high = min(stop, chunk_start + len(chunk)) - chunk_start
+                    yield chunk[low:high]
+                    index += 1
+                    if index > run_end:
+                        break
+        finally:
+            if fd is not None:
+                os.close(fd)
+
+    async def _stream_transfer(self, request, transfer: SharedTransfer):
+        """
+        ارائه فایلی که هنوز در حال دانلود است با پشتیبانی از Range
+        """
+        if not await download_manager.wait_name_ready(transfer):
+            raise web.HTTPBadGateway()
+        file_size = transfer.file_size
+        try:
+            http_range = request.http_range
+        except ValueError:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f"bytes */{file_size}"})
+        partial = http_range.start is not None or http_range.stop is not None
+        start = http_range.start or 0
+        if start < 0:
+            start = max(0, file_size + start)
+        stop = file_size if http_range.stop is None else min(http_range.stop, file_size)
+        if start >= stop:
+            raise web.HTTPRequestRangeNotSatisfiable(headers={'Content-Range': f"bytes */{file_size}"})
+
+        headers = {
+            'Accept-Ranges': 'bytes',
+            'Cache-Control': 'no-store',
+            'Content-Type': mimetypes.guess_type(transfer.file_name)[0] or 'application/octet-stream'
         }
+        if partial:
+            headers['Content-Range'] = f"bytes {start}-{stop - 1}/{file_size}"
+        response = web.StreamResponse(status=206 if partial else 200, headers=headers)
+        response.content_length = stop - start
+        await response.prepare(request)
+        if request.method == 'HEAD':
+            return response
+
+        request['bytes_sent'] = 0
+        async for data in self._transfer_chunks(transfer, start, stop):
+            memory_manager.buffered_bytes += len(data)
+            try:
+                await response.write(data)
+            finally:
+                memory_manager.buffered_bytes -= len(data)
+            request['bytes_sent'] += len(data)
+        await response.write_eof()
+        access_tracker.record_hit(request['download_name'], request.remote or '-', time.time())
+        return response
+
+    async def _handle_manifest(self, request):
+        return await self._send_file(request, manifest_writer.path, 'no-cache')
+
+    async def _handle_manifest_page(self, request):
+        name = request.match_info['name']
+        cache_control = 'no-cache' if name == 'index.json' else 'public, max-age=31536000, immutable'
+        return await self._send_file(request, self._safe_path(manifest_writer.pages_dir, name), cache_control)
+
+    async def _handle_index(self, request):
+        path = os.path.join(BASE_STORAGE_PATH, 'index.html')
+        if not await storage.run(os.path.exists, path):
+            path = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'index.html')
+        return await self._send_file(request, path, 'no-cache')
+
+    def build_app(self):
+        @web.middleware
+        async def metrics_middleware(request, handler):
+            request['started_at'] = time.perf_counter()
+            self.stats.in_flight += 1
+            try:
+                response = await handler(request)
+            except web.HTTPException as e:
+                self.stats.observe(e.status, 0, time.perf_counter() - request['started_at'])
+                raise
+            except BaseException:
+                self.stats.observe(500, 0, time.perf_counter() - request['started_at'])
+                raise
+            finally:
+                # فایل‌ها از شروع prepare دوباره در جریان شمرده می‌شوند
+                self.stats.in_flight -= 1
+            if not isinstance(response, MeteredFileResponse):
+                self.stats.observe(
+                    response.status, request.get('bytes_sent', 0), time.perf_counter() - request['started_at']
+                )
+            return response
+
+        app = web.Application(middlewares=[metrics_middleware])
+        app.router.add_get(self.url_prefix + '{path:.+}', self._handle_download)
+        app.router.add_get('/files.json', self._handle_manifest)
+        app.router.add_get('/files/{name}', self._handle_manifest_page)
+        app.router.add_get('/', self._handle_index)
+        return app
+
+    async def start(self) -> None:
+        """
+        راه‌اندازی سرور روی host و port تنظیم شده
+        """
+        if web is None:
+            print("⚠️ aiohttp نصب نیست، سرور HTTP داخلی راه‌اندازی نشد (pip install aiohttp)")
+            return
+        runner = web.AppRunner(self.build_app(), access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, self.host, self.port).start()
+        self._runner = runner
+        print(f"🌍 سرور HTTP داخلی روی {self.host}:{self.port} راه‌اندازی شد")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+# ایجاد نمونه سرور HTTP داخلی
+file_server = FileServer(
+    HTTP_SERVER_CONFIG.get('host', '0.0.0.0'),
+    HTTP_SERVER_CONFIG.get('port', 8080),
+    DOWNLOAD_URL_PREFIX
+)
+
+# endpoint متریک‌ها
+class MetricsServer:
+    """
+    ارائه متریک‌ها روی /metrics برای Prometheus
+    جدا از سرور فایل و به طور پیش‌فرض فقط روی 127.0.0.1 تا عمومی نشود
+    """
+    CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+    def __init__(self, host: str = '127.0.0.1', port: int = 9105):
+        self.host = host
+        self.port = port
+        self._runner = None
+
+    @property
+    def running(self) -> bool:
+        return self._runner is not None
+
+    async def _handle_metrics(self, request):
+        return web.Response(body=metrics.render().encode('utf-8'), headers={'Content-Type': self.CONTENT_TYPE})
+
+    async def start(self) -> None:
+        if web is None:
+            print("⚠️ aiohttp نصب نیست، endpoint متریک‌ها راه‌اندازی نشد (pip install aiohttp)")
+            return
+        app = web.Application()
+        app.router.add_get('/metrics', self._handle_metrics)
+        runner = web.AppRunner(app, access_log=None)
+        await runner.setup()
+        await web.TCPSite(runner, self.host, self.port).start()
+        self._runner = runner
+        print(f"📈 متریک‌ها روی http://{self.host}:{self.port}/metrics در دسترس است")
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
+
+# ایجاد نمونه endpoint متریک‌ها
+metrics_server = MetricsServer(METRICS_CONFIG.get('host', '127.0.0.1'), METRICS_CONFIG.get('port', 9105))
+
+# gauge ها در زمان هر scrape از وضعیت فعلی خوانده می‌شوند
+metrics.gauge('process_rss_bytes', 'Resident memory of the bot process',
+              lambda: memory_manager.get_memory_usage()['process_rss'] * 1024 * 1024)
+metrics.gauge('system_memory_percent', 'System memory usage percent',
+              lambda: memory_manager.get_memory_usage()['system_percent'])
+metrics.gauge('memory_pressure_level', 'Memory pressure level (0 normal, 1 elevated, 2 critical)',
+              lambda: MemoryManager.LEVELS.index(memory_manager.level))
+metrics.gauge('memory_psi_avg10', 'Memory PSI avg10 of the service cgroup',
+              lambda: [({'kind': kind}, memory_manager.last_sample.get(f"psi_{kind}", 0.0)) for kind in ('some', 'full')])
+metrics.gauge('memory_cgroup_current_bytes', 'memory.current of the service cgroup',
+              lambda: memory_manager.last_sample.get('cgroup_current', 0.0) * 1024 * 1024)
+metrics.gauge('memory_buffered_bytes', 'Chunk buffers held by in-flight downloads and streams',
+              lambda: memory_manager.buffered_bytes)
+metrics.gauge('event_loop_info', 'Event loop implementation in use',
+              lambda: [({'implementation': loop_implementation(event_loop)}, 1)])
+metrics.gauge('event_loop_lag_max_seconds', 'Largest event loop lag since start',
+              lambda: loop_lag_monitor.max_ms / 1000)
+metrics.gauge('active_downloads', 'Download requests being tracked',
+              lambda: len(download_manager.active_downloads))
+metrics.gauge('running_downloads', 'Transfers holding a download slot',
+              lambda: download_manager.scheduler.running_total)
+metrics.gauge('queued_downloads', 'Transfers waiting for a download slot',
+              lambda: download_manager.scheduler.queued_count)
+metrics.gauge('storage_pending_operations', 'Storage operations queued or running in the thread pool',
+              lambda: storage.pending)
+metrics.gauge('reserved_bytes', 'Disk space reserved for in-flight downloads',
+              lambda: storage_admission.reserved_bytes())
+metrics.gauge('disk_bytes', 'Download volume size and usage',
+              lambda: [({'kind': kind}, value) for kind, value in zip(('total', 'used'), eviction_engine.disk_usage())])
+metrics.gauge('stored_files', 'Files in the download directory', lambda: len(file_index))
+metrics.gauge('stored_bytes', 'Total size of stored files', lambda: file_index.total_size)
+metrics.gauge('http_in_flight', 'Requests in progress on the built-in HTTP server',
+              lambda: file_server.stats.in_flight)
+
+# پوشه staging برای دانلودهای در حال انجام
+class StagingStore:
+    """
+    دانلودها ابتدا در پوشه staging (روی همان فایل‌سیستم مسیر عمومی) نوشته شده و فقط
+    پس از تکمیل با os.replace اتمیک به مسیر عمومی منتقل می‌شوند تا nginx هرگز فایل
+    نیمه‌کاره ارائه ندهد
+    پوشه staging به صورت پیش‌فرض کنار webroot (خارج از مسیر قابل ارائه) ساخته می‌شود
+    سیاست fsync:
+    - none: بدون fsync (سریع‌ترین، داده در صورت خاموشی سیستم ممکن است از دست برود)
+    - commit: fsync فایل و پوشه عمومی هنگام انتشار
+    - always: علاوه بر commit، fsync هر بازه پیش از ثبت در ژورنال دانلود
+    """
+    FSYNC_POLICIES = ('none', 'commit', 'always')
+
+    def __init__(self, public_path: str, staging_path: str = '', fsync_policy: str = 'always',
+                 preallocate: bool = True, web_root: str = BASE_STORAGE_PATH):
+        if fsync_policy not in self.FSYNC_POLICIES:
+            print(f"⚠️ سیاست fsync نامعتبر '{fsync_policy}'، از always استفاده می‌شود")
+            fsync_policy = 'always'
+        self.public_path = public_path
+        self.web_root = web_root
+        self.path = staging_path or os.path.join(os.path.dirname(web_root.rstrip('/')), '.tgfl-staging')
+        self.fsync_policy = fsync_policy
+        self.preallocate_enabled = preallocate
+
+    @property
+    def legacy_path(self) -> str:
+        # پوشه staging نسخه‌های قبلی که داخل webroot ساخته می‌شد
+        return os.path.join(os.path.dirname(self.public_path.rstrip('/')), '.staging')
+
+    def _is_served(self, path: str) -> bool:
+        web_root = os.path.realpath(self.web_root)
+        return os.path.commonpath([os.path.realpath(path), web_root]) == web_root
+
+    def _same_device_fallback(self, device: int) -> str:
+        """
+        نزدیک‌ترین پوشه خارج از webroot روی فایل‌سیستم مسیر عمومی؛ اگر webroot خود یک
+        فایل‌سیستم جدا باشد، ناچار پوشه مخفی داخل آن
+        """
+        directory = os.path.realpath(self.public_path)
+        while True:
+            parent = os.path.dirname(directory)
+            if parent == directory or os.stat(parent).st_dev != device:
+                return self.legacy_path
+            directory = parent
+            if not self._is_served(directory):
+                return os.path.join(directory, '.tgfl-staging')
+
+    def prepare(self) -> None:
+        """
+        ساخت پوشه staging روی همان فایل‌سیستم مسیر عمومی و محدود کردن دسترسی آن به مالک
+        تا وب‌سرور حتی در صورت قرار گرفتن پوشه داخل webroot فایل نیمه‌کاره ارائه ندهد
+        """
+        os.makedirs(self.path, exist_ok=True)
+        public_device = os.stat(self.public_path).st_dev
+        if os.stat(self.path).st_dev != public_device:
+            fallback = self._same_device_fallback(public_device)
+            print(f"⚠️ پوشه staging روی فایل‌سیستم دیگری است، از {fallback} استفاده می‌شود")
+            self.path = fallback
+            os.makedirs(self.path, exist_ok=True)
+        os.chmod(self.path, 0o700)
+        if self._is_served(self.path):
+            print(f"⚠️ پوشه staging داخل webroot است ({self.path})؛ فقط مالک به آن دسترسی دارد")
+        self._migrate_legacy()
+
+    def _migrate_legacy(self) -> None:
+        """
+        انتقال فایل‌های نیمه‌کاره پوشه staging قدیمی داخل webroot به پوشه فعلی تا
+        دانلودهای ژورنال شده ادامه یابند و فایلی در webroot باقی نماند
+        """
+        legacy_path = self.legacy_path
+        if os.path.realpath(legacy_path) == os.path.realpath(self.path) or not os.path.isdir(legacy_path):
+            return
+        moved = 0
+        with os.scandir(legacy_path) as it:
+            for entry in it:
+                try:
+                    os.replace(entry.path, os.path.join(self.path, entry.name))
+                    moved += 1
+                except OSError:
+                    try:
+                        os.remove(entry.path)
+                    except OSError:
+                        pass
+        try:
+            os.rmdir(legacy_path)
+        except OSError:
+            pass
+        print(f"🚚 پوشه staging قدیمی از webroot منتقل شد ({moved} فایل): {legacy_path} → {self.path}")
+
+    def staging_file(self, file_name: str) -> str:
+        # مسیرهای shard شده در staging به یک نام تخت تبدیل می‌شوند
+        return os.path.join(self.path, file_name.replace('/', '__'))
+
+    def preallocate(self, fd: int, size: int) -> bool:
+        """
+        رزرو فضای پیوسته فایل با fallocate؛ در صورت پشتیبانی نشدن فقط اندازه تنظیم می‌شود
+        """
+        if self.preallocate_enabled and size > 0 and hasattr(os, 'posix_fallocate'):
+            try:
+                os.posix_fallocate(fd, 0, size)
+                return True
+            except OSError:
+                pass
+        os.ftruncate(fd, size)
+        return False
+
+    @property
+    def sync_parts(self) -> bool:
+        return self.fsync_policy == 'always'
+
+    @staticmethod
+    def _fsync_path(path: str) -> None:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+
+    def commit(self, staging_file: str, file_name: str) -> str:
+        """
+        انتشار اتمیک فایل کامل شده در مسیر عمومی (در thread ذخیره‌سازی اجرا می‌شود)
+        """
+        public_file = os.path.join(self.public_path, file_name)
+        public_dir = os.path.dirname(public_file)
+        os.makedirs(public_dir, exist_ok=True)
+        if self.fsync_policy != 'none':
+            self._fsync_path(staging_file)
+        os.replace(staging_file, public_file)
+        if self.fsync_policy != 'none':
+            self._fsync_path(public_dir)
+        return public_file
+
+    def discard(self, file_name: str) -> None:
+        """
+        حذف فایل نیمه‌کاره و فایل‌های موقت مرتبط با یک دانلود لغو شده
+        """
+        staging_file = self.staging_file(file_name)
+        for partial_file in [staging_file] + glob.glob(f"{glob.escape(staging_file)}.*"):
+            try:
+                os.remove(partial_file)
+                print(f"🗑️ فایل نیمه‌کاره حذف شد: {partial_file}")
+            except FileNotFoundError:
+                pass
+            except PermissionError:
+                print(f"⚠️ خطای دسترسی در حذف فایل نیمه‌کاره: {partial_file}")
+            except Exception as e:
+                print(f"❌ خطا در حذف فایل نیمه‌کاره: {e}")
+
+    def cleanup_orphans(self, keep_names: set) -> None:
+        """
+        حذف فایل‌های staging بدون رکورد ژورنال و فایل‌های موقت قدیمی مسیر عمومی
+        """
+        removed = 0
+        keep_names = {name.replace('/', '__') for name in keep_names if name}
+        for directory, only_partials in ((self.path, False), (self.public_path, True)):
+            try:
+                with os.scandir(directory) as it:
+                    for entry in it:
+                        if not entry.is_file() or (only_partials and not entry.name.endswith(PARTIAL_SUFFIXES)):
+                            continue
+                        base_name = entry.name
+                        for suffix in PARTIAL_SUFFIXES:
+                            if base_name.endswith(suffix):
+                                base_name = base_name[:-len(suffix)]
+                        if not only_partials and base_name in keep_names:
+                            continue
+                        try:
+                            os.remove(entry.path)
+                            removed += 1
+                        except OSError:
+                            pass
+            except FileNotFoundError:
+                pass
+        if removed:
+            print(f"🧹 {removed} فایل نیمه‌کاره رها شده حذف شد")
+
+# ایجاد نمونه staging
+staging_store = StagingStore(
+    DOWNLOAD_PATH,
+    STAGING_PATH,
+    fsync_policy=FSYNC_POLICY,
+    preallocate=PREALLOCATE_DOWNLOADS
+)
+
+def render_thumbnail(source_path: str, target_path: str, media_type: str, size: int) -> bool:
+    """
+    ساخت تصویر کوچک از خود فایل (در process pool اجرا می‌شود)
+    - تصویر: کوچک کردن با Pillow
+    - ویدیو: استخراج یک فریم با ffmpeg
+    """
+    tmp_path = f"{target_path}.part"
+    try:
+        if media_type == 'image':
+            if Image is None:
+                return False
+            with Image.open(source_path) as image:
+                image.thumbnail((size, size))
+                image.convert('RGB').save(tmp_path, 'JPEG', quality=80)
+        elif media_type == 'video':
+            if not shutil.which('ffmpeg'):
+                return False
+            # فریم ثانیه اول و برای ویدیوهای خیلی کوتاه اولین فریم
+            for seek in ('1', '0'):
+                subprocess.run(
+                    ['ffmpeg', '-v', 'error', '-y', '-ss', seek, '-i', source_path, '-frames:v', '1',
+                     '-vf', f"scale='min({size},iw)':-2", '-c:v', 'mjpeg', '-f', 'image2', tmp_path],
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+                    timeout=60
+                )
+                if os.path.exists(tmp_path) and os.path.getsize(tmp_path) > 0:
+                    break
+            else:
+                return False
+        else:
+            return False
+        os.replace(tmp_path, target_path)
+        return True
+    except Exception as e:
+        print(f"⚠️ خطا در ساخت تصویر کوچک {source_path}: {e}")
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        return False
 
+class ThumbnailStore:
+    """
+    تصاویر کوچک (thumbnail / poster) فایل‌های تصویری و ویدیویی برای index.html
+    هر تصویر کوچک با همان مسیر نسبی فایل در پوشه مخفی .thumbs ذخیره می‌شود
+    - در صورت وجود، از thumbs خود پیام تلگرام (بدون پردازش)
+    - در غیر این صورت ساخت از فایل در یک process pool تا event loop و GIL درگیر نشوند
+    """
+    MEDIA_TYPES = ('image', 'video')
 
-def update_config_file_list():
+    def __init__(self, path: str, size: int = 320, workers: int = 2, enabled: bool = True):
+        self.path = path
+        self.size = size
+        self.workers = max(1, workers)
+        self.enabled = enabled
+        self._pool: Optional[ProcessPoolExecutor] = None
+
+    def thumbnail_path(self, name: str) -> str:
+        return os.path.join(self.path, thumbnail_name(name))
+
+    def _prepare_dir(self, name: str) -> None:
+        os.makedirs(os.path.dirname(self.thumbnail_path(name)), exist_ok=True)
+
+    def _get_pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def pick_telegram_thumb(self, media):
+        """
+        انتخاب کوچک‌ترین thumb تلگرام که از اندازه هدف کوچک‌تر نباشد
+        """
+        thumbs = [thumb for thumb in (getattr(media, 'thumbs', None) or []) if getattr(thumb, 'file_id', None)]
+        if not thumbs:
+            return None
+        large_enough = [thumb for thumb in thumbs if max(thumb.width or 0, thumb.height or 0) >= self.size]
+        if large_enough:
+            return min(large_enough, key=lambda thumb: max(thumb.width or 0, thumb.height or 0))
+        return max(thumbs, key=lambda thumb: max(thumb.width or 0, thumb.height or 0))
+
+    async def generate(self, client: Client, media, file_name: str) -> bool:
+        """
+        ساخت تصویر کوچک یک فایل و بروزرسانی ایندکس و manifest
+        """
+        if not self.enabled or get_media_type(file_name) not in self.MEDIA_TYPES:
+            return False
+        target_path = self.thumbnail_path(file_name)
+        created = False
+        await storage.run(self._prepare_dir, file_name)
+
+        thumb = self.pick_telegram_thumb(media)
+        if thumb is not None:
+            tmp_path = f"{target_path}.part"
+            try:
+                await client.download_media(thumb.file_id, file_name=tmp_path)
+                await storage.run(os.replace, tmp_path, target_path)
+                created = True
+            except Exception as e:
+                print(f"⚠️ خطا در دریافت thumb تلگرام {file_name}: {e}")
+
+        if not created:
+            loop = asyncio.get_running_loop()
+            created = await loop.run_in_executor(
+                self._get_pool(), render_thumbnail,
+                os.path.join(self.path, file_name), target_path, get_media_type(file_name), self.size
+            )
+
+        if created and await storage.run(file_index.add, file_name):
+            update_config_file_list()
+        return created
+
+    def schedule(self, client: Client, media, file_name: str) -> None:
+        """
+        ساخت تصویر کوچک در پس‌زمینه بدون تأخیر در ارسال لینک
+        """
+        if not self.enabled or get_media_type(file_name) not in self.MEDIA_TYPES:
+            return
+        task = asyncio.create_task(self.generate(client, media, file_name))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+    def remove(self, name: str) -> None:
+        """
+        حذف تصویر کوچک همراه با فایل
+        """
+        try:
+            os.remove(self.thumbnail_path(name))
+        except FileNotFoundError:
+            return
+        except Exception as e:
+            print(f"⚠️ خطا در حذف تصویر کوچک {name}: {e}")
+            return
+        # حذف پوشه‌های shard خالی شده در پوشه تصاویر کوچک
+        directory = os.path.dirname(name)
+        while directory:
+            try:
+                os.rmdir(os.path.join(self.path, THUMBNAIL_DIR, directory))
+            except OSError:
+                break
+            directory = os.path.dirname(directory)
+
+    def link(self, existing_name: str, name: str) -> None:
+        """
+        استفاده از تصویر کوچک موجود برای نام جدید (hardlink) یک داده
+        """
+        try:
+            self._prepare_dir(name)
+            os.link(self.thumbnail_path(existing_name), self.thumbnail_path(name))
+        except OSError:
+            pass
+
+    def move(self, old_name: str, new_name: str) -> None:
+        if not os.path.exists(self.thumbnail_path(old_name)):
+            return
+        try:
+            self._prepare_dir(new_name)
+            os.rename(self.thumbnail_path(old_name), self.thumbnail_path(new_name))
+        except OSError:
+            pass
+
+    def shutdown(self) -> None:
+        # در صورت نیاز بعدی دوباره ساخته می‌شود
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+# ایجاد نمونه تصاویر کوچک
+thumbnail_store = ThumbnailStore(
+    DOWNLOAD_PATH,
+    size=THUMBNAIL_CONFIG.get('size', 320),
+    workers=THUMBNAIL_CONFIG.get('workers', 2),
+    enabled=THUMBNAIL_CONFIG.get('enabled', True)
+)
+
+# دانلود موازی فایل‌های بزرگ
+class ParallelDownloader:
     """
-    نوشتن آرایه فایل‌ها در فایل `files.json` کنار اسکریپت.
-    هر آیتم شامل: name, size_bytes, public_url
+    دانلود فایل‌های بزرگ با تقسیم به بازه‌های بایتی و دریافت همزمان آن‌ها
+    هر بازه با stream_media از offset مربوطه خوانده شده و با pwrite در
+    جایگاه خود در فایل از پیش اندازه‌گذاری شده نوشته می‌شود
     """
-    try:
-        files = []
-        for filename in os.listdir(DOWNLOAD_PATH):
-            file_path = os.path.join(DOWNLOAD_PATH, filename)
-            if os.path.isfile(file_path):
-                size = os.path.getsize(file_path)
-                public_url = build_public_url(filename)
-                mtime = os.path.getmtime(file_path)
-                files.append({
-                    'name': filename,
-                    'size_bytes': size,
-                    'public_url': public_url,
-                    'mtime': mtime
-                })
+    # اندازه قطعه‌های stream_media در pyrogram
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, part_size_mb: int = 16, workers: int = 4, min_size_mb: int = 20):
+        self.part_chunks = max(1, int(part_size_mb))
+        self.configured_workers = max(1, int(workers))
+        self.workers = self.configured_workers
+        self.min_size = int(min_size_mb * 1024 * 1024)
+
+    def set_workers(self, workers: Optional[int] = None) -> None:
+        """
+        محدود کردن تعداد جریان‌های موازی دانلودهای بعدی (حداکثر مقدار تنظیم شده)
+        None مقدار تنظیم شده را بازمی‌گرداند
+        """
+        if workers is None:
+            self.workers = self.configured_workers
+        else:
+            self.workers = min(self.configured_workers, max(1, int(workers)))
+
+    def should_use(self, file_size: int) -> bool:
+        """
+        بررسی اینکه آیا دانلود موازی برای این حجم فایل ارزش دارد
+        """
+        return self.workers > 1 and file_size >= self.min_size
+
+    def part_size(self, first_chunk: int, file_size: int) -> int:
+        """
+        حجم بایتی بازه‌ای که از قطعه first_chunk شروع می‌شود
+        """
+        start = first_chunk * self.CHUNK_SIZE
+        return max(0, min(self.part_chunks * self.CHUNK_SIZE, file_size - start))
+
+    async def download(self, client: Client, message: Message, file_path: str, file_size: int,
+                       progress: Optional[Callable[[int, int], Awaitable]] = None,
+                       completed_parts: Optional[set] = None,
+                       on_part_done: Optional[Callable[[int, int], None]] = None,
+                       on_preallocated: Optional[Callable[[], None]] = None,
+                       on_chunk_written: Optional[Callable[[int], None]] = None) -> str:
+        """
+        دانلود موازی فایل در مسیر مشخص شده
+        داده ابتدا در file_path.part نوشته شده و پس از تکمیل جایگزین می‌شود
+        progress: تابع async با امضای (current, total) مشابه message.download
+        completed_parts: بازه‌هایی که قبلاً کامل شده‌اند (برای ادامه دانلود)
+        on_part_done: پس از ذخیره هر بازه با (first_chunk, size) فراخوانی می‌شود
+        on_preallocated: پس از پیش‌تخصیص موفق فضای کامل فایل فراخوانی می‌شود
+        on_chunk_written: پس از نوشتن هر قطعه 1MB با شماره قطعه فراخوانی می‌شود
+        """
+        completed_parts = completed_parts or set()
+        part_path = f"{file_path}.part"
+        if not await storage.run(os.path.exists, part_path):
+            completed_parts = set()
 
-        # Write files.json into the webroot (BASE_STORAGE_PATH) so the web server can serve it
-        web_files_path = os.path.join(BASE_STORAGE_PATH, 'files.json')
+        total_chunks = (file_size + self.CHUNK_SIZE - 1) // self.CHUNK_SIZE
+        parts = deque(
+            first_chunk for first_chunk in range(0, total_chunks, self.part_chunks)
+            if first_chunk not in completed_parts
+        )
+        written = sum(self.part_size(first_chunk, file_size) for first_chunk in completed_parts)
+
+        fd = await storage.run(os.open, part_path, os.O_WRONLY | os.O_CREAT, 0o644)
         try:
-            os.makedirs(BASE_STORAGE_PATH, exist_ok=True)
-        except Exception:
+            if await storage.run(staging_store.preallocate, fd, file_size) and on_preallocated:
+                on_preallocated()
+
+            async def worker():
+                nonlocal written
+                while parts:
+                    first_chunk = parts.popleft()
+                    limit = min(self.part_chunks, total_chunks - first_chunk)
+                    offset = first_chunk * self.CHUNK_SIZE
+                    async for chunk in client.stream_media(message, offset=first_chunk, limit=limit):
+                        memory_manager.buffered_bytes += len(chunk)
+                        try:
+                            await storage.run(os.pwrite, fd, chunk, offset)
+                        finally:
+                            memory_manager.buffered_bytes -= len(chunk)
+                        if on_chunk_written:
+                            on_chunk_written(offset // self.CHUNK_SIZE)
+                        offset += len(chunk)
+                        written += len(chunk)
+                        if progress:
+                            await progress(written, file_size)
+                    if on_part_done:
+                        # ثبت بازه فقط پس از ذخیره قطعی داده روی دیسک (سیاست always)
+                        if staging_store.sync_parts:
+                            await storage.run(os.fsync, fd)
+                        await storage.run(on_part_done, first_chunk, self.part_size(first_chunk, file_size))
+
+            tasks = [asyncio.create_task(worker()) for _ in range(min(self.workers, len(parts)))]
+            try:
+                await asyncio.gather(*tasks)
+            except BaseException:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                raise
+        finally:
+            # بستن descriptor باید حتی هنگام لغو قطعاً انجام شود
+            os.close(fd)
+
+        if written != file_size:
+            raise IOError(f"دانلود ناقص: {written} از {file_size} بایت دریافت شد")
+        await storage.run(os.replace, part_path, file_path)
+        return file_path
+
+# ایجاد نمونه دانلودر موازی
+parallel_downloader = ParallelDownloader(
+    part_size_mb=PARALLEL_DOWNLOAD_CONFIG.get('part_size_mb', 16),
+    workers=PARALLEL_DOWNLOAD_CONFIG.get('workers', 4),
+    min_size_mb=PARALLEL_DOWNLOAD_CONFIG.get('min_size_mb', 20)
+)
+
+# ژورنال دانلودهای نیمه‌کاره برای ادامه پس از راه‌اندازی مجدد
+class DownloadJournal:
+    """
+    نگهداری وضعیت دانلودهای در حال انجام روی دیسک
+    هر رکورد شامل: chat_id, message_id, file_id, file_unique_id, file_name,
+    target_path, file_size, bytes_committed و completed_parts
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, Dict] = {}
+        # تغییرات از thread های ذخیره‌سازی انجام می‌شوند
+        self._lock = threading.RLock()
+
+    def load(self) -> Dict[str, Dict]:
+        """
+        خواندن ژورنال از دیسک
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as e:
+            print(f"⚠️ خطا در خواندن ژورنال دانلود: {e}")
+            self.entries = {}
+        return dict(self.entries)
+
+    def _save(self) -> None:
+        """
+        نوشتن اتمیک ژورنال روی دیسک
+        """
+        try:
+            with self._lock:
+                data = json.dumps(self.entries, ensure_ascii=False, separators=(',', ':'))
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                    f.flush()
+                    os.fsync(f.fileno())
+                os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"⚠️ خطا در ذخیره ژورنال دانلود: {e}")
+
+    def get(self, download_id: str) -> Optional[Dict]:
+        return self.entries.get(download_id)
+
+    def record(self, download_id: str, **fields) -> Dict:
+        """
+        ثبت یا بروزرسانی رکورد یک دانلود
+        """
+        with self._lock:
+            entry = self.entries.setdefault(download_id, {'bytes_committed': 0, 'completed_parts': []})
+            entry.update(fields)
+            self._save()
+            return entry
+
+    def commit_part(self, download_id: str, first_chunk: int, size: int) -> None:
+        """
+        ثبت یک بازه ذخیره شده روی دیسک
+        """
+        with self._lock:
+            entry = self.entries.get(download_id)
+            if entry is None:
+                return
+            if first_chunk not in entry['completed_parts']:
+                entry['completed_parts'].append(first_chunk)
+                entry['bytes_committed'] += size
+                self._save()
+
+    def remove(self, download_id: str) -> None:
+        """
+        حذف رکورد دانلود پس از تکمیل، لغو یا خطا
+        """
+        with self._lock:
+            if self.entries.pop(download_id, None) is not None:
+                self._save()
+
+# ایجاد نمونه ژورنال دانلود
+download_journal = DownloadJournal(DOWNLOAD_JOURNAL_PATH)
+
+# ایندکس حذف تکرار فایل‌ها
+class DedupIndex:
+    """
+    ایندکس حذف تکرار براساس file_unique_id تلگرام و حجم فایل
+    هر کلید به نام فایل‌هایی اشاره می‌کند که لینک سخت (hardlink) یک داده هستند؛
+    هر نام یک ارجاع است و داده فقط با حذف آخرین نام از دیسک پاک می‌شود
+    تغییرات به صورت append-only در فایل ثبت و با compact فشرده می‌شوند
+    """
+    def __init__(self, path: str):
+        self.path = path
+        self.entries: Dict[str, List[str]] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def make_key(file_unique_id: str, file_size: int) -> str:
+        return f"{file_unique_id}:{file_size}"
+
+    def load(self) -> None:
+        """
+        بازخوانی لاگ ایندکس از دیسک
+        """
+        entries: Dict[str, List[str]] = {}
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    names = entries.setdefault(record['key'], [])
+                    if record['name'] not in names:
+                        names.append(record['name'])
+        except FileNotFoundError:
             pass
+        except Exception as e:
+            print(f"⚠️ خطا در خواندن ایندکس حذف تکرار: {e}")
+        self.entries = entries
+
+    def compact(self) -> None:
+        """
+        حذف ارجاع‌های فایل‌هایی که دیگر در ایندکس فایل‌ها نیستند و بازنویسی لاگ
+        """
+        with self._lock:
+            entries = {}
+            for key, names in self.entries.items():
+                alive = [name for name in names if file_index.get(name)]
+                if alive:
+                    entries[key] = alive
+            self.entries = entries
+            try:
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    for key, names in entries.items():
+                        for name in names:
+                            f.write(json.dumps({'key': key, 'name': name}, ensure_ascii=False) + '\n')
+                os.replace(tmp_path, self.path)
+            except Exception as e:
+                print(f"⚠️ خطا در فشرده‌سازی ایندکس حذف تکرار: {e}")
+
+    def add(self, key: str, name: str) -> None:
+        """
+        ثبت یک نام (ارجاع) برای داده
+        """
+        with self._lock:
+            names = self.entries.setdefault(key, [])
+            if name in names:
+                return
+            names.append(name)
+            try:
+                with open(self.path, 'a', encoding='utf-8') as f:
+                    f.write(json.dumps({'key': key, 'name': name}, ensure_ascii=False) + '\n')
+            except Exception as e:
+                print(f"⚠️ خطا در ثبت ایندکس حذف تکرار: {e}")
+
+    def lookup(self, key: str) -> Optional[str]:
+        """
+        یافتن یکی از نام‌های موجود روی دیسک برای داده
+        """
+        names = self.entries.get(key)
+        if not names:
+            return None
+        alive = [name for name in names if file_index.get(name)]
+        if len(alive) != len(names):
+            with self._lock:
+                if alive:
+                    self.entries[key] = alive
+                else:
+                    self.entries.pop(key, None)
+        return alive[0] if alive else None
+
+    def link(self, key: str, existing_name: str, desired_name: str) -> str:
+        """
+        ارائه داده موجود با نام درخواستی بدون دانلود مجدد
+        نام درخواستی با hardlink به همان داده ساخته می‌شود و زمان تغییر داده
+        تازه می‌شود تا عمر فایل از آخرین ارجاع محاسبه شود
+        """
+        existing_path = os.path.join(DOWNLOAD_PATH, existing_name)
+        name = existing_name
+        file_unique_id = key.split(':', 1)[0]
+        directory = shard_dir(file_unique_id)
+        desired_name = os.path.basename(desired_name)
+        if directory:
+            desired_name = f"{directory}/{desired_name}"
+        if desired_name != existing_name:
+            candidate = resolve_target_name(desired_name, file_unique_id)
+            candidate_path = os.path.join(DOWNLOAD_PATH, candidate)
+            try:
+                if os.path.exists(candidate_path) and os.path.samefile(candidate_path, existing_path):
+                    name = candidate
+                else:
+                    os.makedirs(os.path.dirname(candidate_path), exist_ok=True)
+                    os.link(existing_path, candidate_path)
+                    thumbnail_store.link(existing_name, candidate)
+                    name = candidate
+            except OSError as e:
+                print(f"⚠️ امکان ساخت hardlink وجود ندارد، از نام موجود استفاده می‌شود: {e}")
 
-        # sort by mtime descending (newest first)
-        files.sort(key=lambda x: x.get('mtime', 0), reverse=True)
+        os.utime(existing_path)
+        for linked_name in self.entries.get(key, []):
+            file_index.add(linked_name)
+        file_index.add(name)
+        self.add(key, name)
+        update_config_file_list()
+        return name
 
-        # remove mtime from output
-        out_files = [{k: v for k, v in f.items() if k != 'mtime'} for f in files]
-        with open(web_files_path, 'w', encoding='utf-8') as f:
-            json.dump(out_files, f, ensure_ascii=False, indent=4)
+# ایجاد نمونه ایندکس حذف تکرار
+dedup_index = DedupIndex(DEDUP_INDEX_PATH)
 
-        print(f"✅ {web_files_path} updated with {len(files)} files")
-    except Exception as e:
-        print(f"❌ خطا در بروزرسانی files.json: {e}")
+class LazyRegistry:
+    """
+    فایل‌هایی که فقط لینک آن‌ها ساخته شده و در اولین درخواست HTTP از تلگرام دریافت می‌شوند
+    هر رکورد شامل: chat_id, message_id, file_unique_id, file_size, dedup_key و created_at
+    نسخه‌های دریافت شده در یک کش LRU با حجم محدود زیر مسیر دانلود نگهداری می‌شوند
+    """
+    def __init__(self, path: str, cache_size_mb: float = 10240):
+        self.path = path
+        self.cache_bytes = int(cache_size_mb * 1024 * 1024)
+        self.entries: Dict[str, Dict] = {}
+        self.keys: Dict[str, str] = {}
+        self._lock = threading.RLock()
+
+    def load(self) -> None:
+        """
+        خواندن رکوردها از دیسک
+        """
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            self.entries = {}
+        except Exception as e:
+            print(f"⚠️ خطا در خواندن فهرست فایل‌های lazy: {e}")
+            self.entries = {}
+        self._rebuild_keys()
+
+    def _rebuild_keys(self) -> None:
+        """
+        ساخت نگاشت dedup_key به نام فایل (اولین نام ثبت شده برای هر داده)
+        """
+        with self._lock:
+            keys: Dict[str, str] = {}
+            for name, entry in self.entries.items():
+                dedup_key = entry.get('dedup_key')
+                if dedup_key:
+                    keys.setdefault(dedup_key, name)
+            self.keys = keys
+
+    def _save(self) -> None:
+        """
+        نوشتن اتمیک رکوردها روی دیسک
+        """
+        try:
+            with self._lock:
+                data = json.dumps(self.entries, ensure_ascii=False, separators=(',', ':'))
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, 'w', encoding='utf-8') as f:
+                    f.write(data)
+                os.replace(tmp_path, self.path)
+        except Exception as e:
+            print(f"⚠️ خطا در ذخیره فهرست فایل‌های lazy: {e}")
+
+    def get(self, name: str) -> Optional[Dict]:
+        return self.entries.get(name)
+
+    def lookup(self, dedup_key: str) -> Optional[str]:
+        """
+        یافتن نام ثبت شده برای یک داده
+        """
+        return self.keys.get(dedup_key)
+
+    def add(self, name: str, **fields) -> Dict:
+        """
+        ثبت یا بروزرسانی رکورد یک فایل
+        """
+        with self._lock:
+            entry = self.entries.setdefault(name, {})
+            old_key = entry.get('dedup_key')
+            entry.update(fields)
+            new_key = entry.get('dedup_key')
+            if old_key != new_key:
+                if old_key and self.keys.get(old_key) == name:
+                    self._rebuild_keys()
+                elif new_key:
+                    self.keys.setdefault(new_key, name)
+            self._save()
+            return entry
+
+    def prune(self, max_age_seconds: float) -> None:
+        """
+        حذف لینک‌هایی که عمر آن‌ها از file_max_age_hours گذشته است
+        """
+        if not max_age_seconds:
+            return
+        now = time.time()
+        with self._lock:
+            expired = [
+                name for name, entry in self.entries.items()
+                if now - entry.get('created_at', now) > max_age_seconds
+            ]
+            for name in expired:
+                del self.entries[name]
+            if expired:
+                self._rebuild_keys()
+                self._save()
+                print(f"🧹 {len(expired)} لینک lazy منقضی شد")
+
+    def trim_cache(self) -> EvictionResult:
+        """
+        حذف کم‌استفاده‌ترین فایل‌های دریافت شده تا رسیدن حجم کش به حد مجاز
+        (در thread ذخیره‌سازی اجرا می‌شود)؛ لینک‌ها باقی می‌مانند و در درخواست بعدی
+        فایل دوباره دریافت می‌شود
+        """
+        result = EvictionResult()
+        if self.cache_bytes <= 0:
+            return result
+        units: Dict = {}
+        for name in list(self.entries):
+            entry = file_index.get(name)
+            if entry:
+                units.setdefault(entry.inode or name, []).append(entry)
+        cached_bytes = sum(unit[0].size for unit in units.values())
+        if cached_bytes <= self.cache_bytes:
+            return result
+
+        protected = {
+            download.file_name for download in list(download_manager.active_downloads.values())
+            if download.file_name
+        }
+        heap = [
+            (max(eviction_engine.last_access(entry) for entry in unit), unit[0].name, unit)
+            for unit in units.values()
+            if not any(entry.name in protected for entry in unit)
+        ]
+        heapq.heapify(heap)
+        victims = []
+        while cached_bytes > self.cache_bytes and heap:
+            _, _, unit = heapq.heappop(heap)
+            victims.append(unit)
+            cached_bytes -= unit[0].size
+
+        eviction_engine.remove_units(victims, result)
+        metrics.inc('cleanup_bytes_freed_total', result.bytes_freed, reason='lazy_cache')
+        metrics.inc('cleanup_files_removed_total', result.files_removed, reason='lazy_cache')
+        if result.files_removed:
+            update_config_file_list()
+            print(
+                f"🧹 کش lazy: {result.files_removed} فایل حذف شد، "
+                f"{result.bytes_freed / (1024 * 1024):.1f} MB آزاد شد"
+            )
+        return result
+
+# ایجاد نمونه فهرست فایل‌های lazy
+lazy_registry = LazyRegistry(LAZY_REGISTRY_PATH, LAZY_FETCH_CONFIG.get('cache_size_mb', 10240))
+
+def shard_dir(file_id: str, timestamp: float = None) -> str:
+    """
+    پوشه shard یک فایل براساس storage_layout
+    - flat: بدون پوشه (همه فایل‌ها در ریشه مسیر دانلود)
+    - hashed: ab/cd/<id> براساس sha1 شناسه فایل
+    - date: YYYY/MM/DD/<id> براساس زمان ذخیره
+    """
+    if STORAGE_LAYOUT == 'hashed':
+        digest = hashlib.sha1(file_id.encode('utf-8')).hexdigest()
+        return f"{digest[:2]}/{digest[2:4]}/{file_id}"
+    if STORAGE_LAYOUT == 'date':
+        t = time.gmtime(timestamp if timestamp is not None else time.time())
+        return f"{t.tm_year:04d}/{t.tm_mon:02d}/{t.tm_mday:02d}/{file_id}"
+    return ''
+
+def prune_shard_dirs(file_name: str) -> None:
+    """
+    حذف پوشه‌های shard خالی شده پس از حذف یک فایل
+    """
+    directory = os.path.dirname(file_name)
+    while directory:
+        try:
+            os.rmdir(os.path.join(DOWNLOAD_PATH, directory))
+        except OSError:
+            break
+        directory = os.path.dirname(directory)
+
+def resolve_target_name(file_name: str, file_unique_id: str) -> str:
+    """
+    انتخاب مسیر نسبی ذخیره‌سازی بدون بازنویسی فایل دیگری با همان نام
+    در چیدمان shard شده فایل در پوشه مخصوص file_unique_id قرار می‌گیرد؛
+    در صورت تداخل، file_unique_id به نام فایل اضافه می‌شود
+    """
+    file_name = os.path.basename(file_name)
+    directory = shard_dir(file_unique_id)
+    if directory:
+        file_name = f"{directory}/{file_name}"
+    in_use = (
+        file_name == THUMBNAIL_DIR
+        or file_index.get(file_name)
+        or os.path.exists(os.path.join(DOWNLOAD_PATH, file_name))
+        or any(d.file_name == file_name for d in list(download_manager.active_downloads.values()))
+        or lazy_registry.get(file_name)
+    )
+    if not in_use:
+        return file_name
+    stem, ext = os.path.splitext(file_name)
+    return f"{stem}_{file_unique_id}{ext}"
+
+# ایجاد event loop برنامه پیش از کلاینت ربات
+event_loop = setup_event_loop()
 
 # ایجاد کلاینت ربات با پشتیبانی پروکسی
 proxy_config = get_proxy_config()
@@ -475,35 +3609,256 @@ else:
         bot_token=BOT_TOKEN
     )
 
+@dataclass
+class WorkerBot:
+    """
+    وضعیت یک کلاینت ربات در مجموعه دانلود
+    """
+    name: str
+    client: Client
+    is_front: bool = False
+    active: int = 0
+    assigned: int = 0
+    healthy: bool = True
+    flood_until: float = 0.0
+    failures: int = 0
+
+class WorkerPool:
+    """
+    مجموعه کلاینت‌های ربات برای افزایش توان دانلود و سهمیه API
+    - ربات اصلی پیام‌ها را دریافت می‌کند و هر دانلود به کم‌بارترین ربات سالم سپرده می‌شود
+    - file reference هر فایل به ربات دریافت کننده تعلق دارد؛ برای ربات‌های کمکی پیام در
+      کانال bin_channel_id کپی و توسط همان ربات از کانال خوانده می‌شود
+    - ربات دچار FloodWait تا پایان مهلت و ربات قطع شده تا موفقیت بررسی سلامت کنار
+      گذاشته می‌شوند و دانلود با ربات دیگر از بازه‌های ذخیره شده ادامه می‌یابد
+    """
+    def __init__(self, front: Client, bots: List[Dict], bin_channel_id: int = 0,
+                 front_downloads: bool = True, health_interval: float = 30):
+        self.bin_channel_id = bin_channel_id
+        self.front_downloads = front_downloads
+        self.health_interval = health_interval
+        self.front = WorkerBot('front', front, is_front=True)
+        self.workers = [self.front]
+        for index, bot_config in enumerate(bots, start=1):
+            if not bot_config.get('bot_token'):
+                continue
+            session_name = bot_config.get('session_name') or f"file_saver_worker_{index}"
+            client = Client(
+                session_name,
+                api_id=API_ID,
+                api_hash=API_HASH,
+                bot_token=bot_config['bot_token'],
+                no_updates=True,
+                **({'proxy': proxy_config} if proxy_config else {})
+            )
+            self.workers.append(WorkerBot(session_name, client))
+
+    @property
+    def enabled(self) -> bool:
+        return len(self.workers) > 1 and bool(self.bin_channel_id)
+
+    def pick(self, exclude: set) -> Optional[WorkerBot]:
+        """
+        انتخاب کم‌بارترین ربات سالم؛ در صورت FloodWait همه، رباتی که زودتر آزاد می‌شود
+        """
+        now = time.monotonic()
+        candidates = [
+            worker for worker in self.workers
+            if worker.healthy and worker.name not in exclude and (self.front_downloads or not worker.is_front)
+        ]
+        # اگر هیچ ربات دیگری آماده نباشد، ربات اصلی حتی اگر برای دانلود در نظر گرفته نشده باشد استفاده می‌شود
+        if not any(worker.flood_until <= now for worker in candidates) \
+                and self.front.name not in exclude and self.front not in candidates:
+            candidates.append(self.front)
+        if not candidates:
+            return None
+        return min(candidates, key=lambda worker: (max(0.0, worker.flood_until - now), worker.active, worker.assigned))
+
+    async def run(self, client: Client, message: Message,
+                  func: Callable[[Client, Message], Awaitable]):
+        """
+        اجرای func(client, message) با ربات انتخاب شده و انتقال به ربات دیگر هنگام
+        FloodWait یا قطع اتصال
+        """
+        if not self.enabled:
+            return await func(client, message)
+
+        # فقط ربات‌های قطع شده کنار گذاشته می‌شوند؛ ربات دچار FloodWait نامزد می‌ماند
+        # تا در صورت FloodWait همه، برای رباتی که زودتر آزاد می‌شود صبر شود
+        disconnected = set()
+        copied = None
+        last_error: Optional[Exception] = None
+        try:
+            while True:
+                worker = self.pick(disconnected)
+                if worker is None:
+                    raise last_error or ConnectionError("هیچ ربات سالمی برای دانلود وجود ندارد")
+                wait = worker.flood_until - time.monotonic()
+                if wait > 0:
+                    print(f"⏳ همه ربات‌ها در FloodWait هستند، انتظار {wait:.0f} ثانیه برای {worker.name}")
+                    await asyncio.sleep(wait)
+                worker.active += 1
+                worker.assigned += 1
+                try:
+                    if worker.is_front:
+                        return await func(client, message)
+                    if copied is None:
+                        copied = await outbound_queue.call(None, message.copy, self.bin_channel_id)
+                    worker_message = await worker.client.get_messages(self.bin_channel_id, copied.id)
+                    return await func(worker.client, worker_message)
+                except FloodWait as e:
+                    worker.flood_until = time.monotonic() + e.value
+                    metrics.inc('worker_failovers_total', worker=worker.name, reason='flood_wait')
+                    print(f"⏳ ربات {worker.name} به مدت {e.value} ثانیه دچار FloodWait شد، انتقال به ربات دیگر")
+                    last_error = e
+                except (OSError, asyncio.TimeoutError, InternalServerError, ServiceUnavailable) as e:
+                    disconnected.add(worker.name)
+                    worker.healthy = False
+                    worker.failures += 1
+                    metrics.inc('worker_failovers_total', worker=worker.name, reason='disconnected')
+                    print(f"🔌 اتصال ربات {worker.name} قطع شد ({e})، انتقال به ربات دیگر")
+                    last_error = e
+                finally:
+                    worker.active -= 1
+        finally:
+            if copied is not None:
+                try:
+                    await outbound_queue.call(None, self.front.client.delete_messages, self.bin_channel_id, copied.id)
+                except Exception as e:
+                    print(f"⚠️ خطا در حذف پیام کپی شده از کانال: {e}")
+
+    async def start(self) -> None:
+        """
+        راه‌اندازی ربات‌های کمکی و بررسی دسترسی آن‌ها به کانال
+        """
+        if len(self.workers) == 1:
+            return
+        if not self.bin_channel_id:
+            print("⚠️ برای ربات‌های کمکی، bin_channel_id تنظیم نشده است؛ فقط ربات اصلی دانلود می‌کند")
+            return
+        for worker in self.workers[1:]:
+            try:
+                await worker.client.start()
+                await worker.client.get_chat(self.bin_channel_id)
+                print(f"🤖 ربات کمکی {worker.name} آماده است")
+            except Exception as e:
+                worker.healthy = False
+                print(f"❌ خطا در راه‌اندازی ربات کمکی {worker.name}: {e}")
+        health_task = asyncio.create_task(self.monitor())
+        background_tasks.add(health_task)
+
+    async def monitor(self) -> None:
+        """
+        بررسی دوره‌ای ربات‌های ناسالم و بازگرداندن آن‌ها پس از پاسخ موفق
+        """
+        while True:
+            await asyncio.sleep(self.health_interval)
+            for worker in self.workers:
+                if worker.healthy:
+                    continue
+                try:
+                    if not worker.is_front and not worker.client.is_connected:
+                        await worker.client.start()
+                    await worker.client.get_me()
+                    worker.healthy = True
+                    print(f"✅ ربات {worker.name} دوباره در دسترس است")
+                except Exception as e:
+                    worker.failures += 1
+                    print(f"⚠️ ربات {worker.name} هنوز در دسترس نیست: {e}")
+
+    async def stop(self) -> None:
+        for worker in self.workers[1:]:
+            try:
+                if worker.client.is_connected:
+                    await worker.client.stop()
+            except Exception as e:
+                print(f"⚠️ خطا در توقف ربات {worker.name}: {e}")
+
+# ایجاد نمونه مجموعه ربات‌های دانلود
+worker_pool = WorkerPool(
+    bot,
+    WORKER_BOTS_CONFIG.get('bots', []),
+    bin_channel_id=WORKER_BOTS_CONFIG.get('bin_channel_id', 0),
+    front_downloads=WORKER_BOTS_CONFIG.get('front_downloads', True),
+    health_interval=WORKER_BOTS_CONFIG.get('health_check_seconds', 30)
+)
+metrics.counter('worker_failovers_total', 'Downloads moved to another bot by worker and reason')
+metrics.gauge('worker_active_downloads', 'Downloads currently assigned to each bot',
+              lambda: [({'worker': worker.name}, worker.active) for worker in worker_pool.workers])
+metrics.gauge('worker_healthy', 'Whether each bot is available for downloads',
+              lambda: [({'worker': worker.name}, int(worker.healthy and worker.flood_until <= time.monotonic()))
+                       for worker in worker_pool.workers])
+
+def get_media_info(message: Message):
+    """
+    استخراج شیء رسانه و نام فایل ذخیره‌سازی از پیام
+    """
+    if message.document:
+        return message.document, message.document.file_name
+    if message.photo:
+        return message.photo, f"photo_{message.photo.file_unique_id}.jpg"
+    if message.video:
+        return message.video, message.video.file_name or f"video_{message.video.file_unique_id}.mp4"
+    if message.audio:
+        return message.audio, message.audio.file_name or f"audio_{message.audio.file_unique_id}.mp3"
+    if message.voice:
+        return message.voice, f"voice_{message.voice.file_unique_id}.ogg"
+    raise ValueError("نوع فایل پشتیبانی نمی‌شود")
+
 @bot.on_message(filters.document | filters.photo | filters.video | filters.audio | filters.voice)
 async def handle_file(client: Client, message: Message):
     """
     دریافت و ذخیره فایل‌های فوروارد شده به ربات
+    تسک انتظار برای پایان دانلود برگردانده می‌شود (برای بنچمارک‌ها؛ pyrogram آن را نادیده می‌گیرد)
     """
     # کنترل دسترسی
     if not is_allowed_chat(message.chat.id):
         return
     
+    # بررسی تکراری بودن فایل - در صورت وجود، لینک بدون دانلود مجدد ارسال می‌شود
+    media, file_name = get_media_info(message)
+    file_size = getattr(media, 'file_size', 0) or 0
+    dedup_key = DedupIndex.make_key(media.file_unique_id, file_size)
+    existing_name = dedup_index.lookup(dedup_key)
+    if existing_name:
+        try:
+            stored_name = await storage.run(dedup_index.link, dedup_key, existing_name, file_name)
+            public_url = build_public_url(stored_name)
+            await outbound_queue.reply(
+                message,
+                f"✅ این فایل قبلاً ذخیره شده است!\n\n"
+                f"📁 نام فایل: `{os.path.basename(stored_name)}`\n"
+                f"📊 حجم: {file_size / (1024 * 1024):.2f} MB\n\n"
+                f"🌐 لینک: {public_url}\n\n"
+                f"🔗 کپی لینک: `{public_url}`",
+                reply_to_message_id=message.id,
+                priority=PRIORITY_HIGH
+            )
+            return
+        except Exception as e:
+            print(f"⚠️ خطا در استفاده از فایل تکراری، دانلود مجدد: {e}")
+    
+    # در حالت lazy فقط لینک ساخته می‌شود و فایل در اولین درخواست HTTP دریافت می‌شود
+    if LAZY_FETCH_CONFIG.get('enabled', False) and file_server.running:
+        await register_lazy_file(message, media, file_name, file_size, dedup_key)
+        return
+    
     # ایجاد وضعیت دانلود جدید
     download_id = download_manager.add_download(message)
-    
-    # شروع زمان‌سنج
-    start_time = time.time()
+    transfer = None
     
     try:
-        # بررسی وضعیت حافظه قبل از شروع دانلود
-        if memory_manager.should_cleanup():
-            print("⚠️ حافظه در وضعیت بحرانی است، پاکسازی خودکار...")
-            memory_manager.cleanup_memory()
-        
         # ایجاد دکمه لغو دانلود
-        cancel_button = InlineKeyboardButton("❌ لغو دانلود", callback_data=f"cancel_{download_id}")
-        keyboard = InlineKeyboardMarkup([[cancel_button]])
+        keyboard = build_cancel_keyboard(download_id)
+        
+        # اگر همین فایل برای درخواست دیگری در حال دانلود است، به همان انتقال متصل می‌شویم
+        transfer = download_manager.get_transfer(dedup_key)
         
         # نمایش پیام در حال دانلود با دکمه لغو
-        status_message = await message.reply_text(
+        status_message = await outbound_queue.reply(
+            message,
             "⏳ در حال دانلود فایل...\n"
-            "📊 وضعیت: شروع دانلود\n"
+            "📊 وضعیت: " + ("اتصال به دانلود در حال انجام" if transfer else "شروع دانلود") + "\n"
             "⏱️ زمان: محاسبه...",
             reply_markup=keyboard,
             reply_to_message_id=message.id
@@ -516,110 +3871,81 @@ async def handle_file(client: Client, message: Message):
             status_msg=status_message
         )
         
-        # تعیین نوع فایل و دانلود آن
-        file_path = None
-        file_name = None
-        
-        # تابع دانلود که در Task جداگانه اجرا می‌شود
-        async def do_download():
-            nonlocal file_path, file_name
-            try:
-                if message.document:
-                    file_name = message.document.file_name
-                    file_path = await message.download(
-                        file_name=os.path.join(DOWNLOAD_PATH, file_name)
-                    )
-                elif message.photo:
-                    file_name = f"photo_{message.photo.file_unique_id}.jpg"
-                    file_path = await message.download(
-                        file_name=os.path.join(DOWNLOAD_PATH, file_name)
-                    )
-                elif message.video:
-                    file_name = message.video.file_name or f"video_{message.video.file_unique_id}.mp4"
-                    file_path = await message.download(
-                        file_name=os.path.join(DOWNLOAD_PATH, file_name)
-                    )
-                elif message.audio:
-                    file_name = message.audio.file_name or f"audio_{message.audio.file_unique_id}.mp3"
-                    file_path = await message.download(
-                        file_name=os.path.join(DOWNLOAD_PATH, file_name)
-                    )
-                elif message.voice:
-                    file_name = f"voice_{message.voice.file_unique_id}.ogg"
-                    file_path = await message.download(
-                        file_name=os.path.join(DOWNLOAD_PATH, file_name)
-                    )
-                
-                return file_path, file_name
-            except asyncio.CancelledError:
-                raise
-            except Exception as e:
-                raise e
+        if transfer is None:
+            transfer = download_manager.get_transfer(dedup_key)
+        if transfer is not None:
+            download_manager.join_transfer(transfer, download_id)
+        else:
+            transfer = download_manager.start_transfer(
+                dedup_key,
+                download_id,
+                run_transfer(client, message, media, file_name, file_size, dedup_key, download_id, keyboard)
+            )
         
-        # اجرای دانلود در Task جداگانه
-        download_task = asyncio.create_task(do_download())
+        # هر درخواست Task انتظار جداگانه دارد تا لغو آن انتقال مشترک را متوقف نکند
+        download_task = asyncio.create_task(download_manager.wait_transfer(transfer))
         download_manager.update_download(download_id, task=download_task)
         
-        try:
-            # منتظر تکمیل دانلود یا لغو آن
-            file_path, file_name = await download_task
-            download_manager.update_download(download_id, file_path=file_path, file_name=file_name)
-            
-        except asyncio.CancelledError:
-            # دانلود لغو شد - پاکسازی فایل نیمه‌کاره
-            if file_path and os.path.exists(file_path):
-                try:
-                    # بررسی اینکه آیا فایل در حال نوشتن است
-                    if os.access(file_path, os.W_OK):
-                        os.remove(file_path)
-                        print(f"🗑️ فایل نیمه‌کاره حذف شد: {file_path}")
-                    else:
-                        print(f"⚠️ امکان حذف فایل نیمه‌کاره وجود ندارد: {file_path}")
-                except PermissionError:
-                    print(f"⚠️ خطای دسترسی در حذف فایل نیمه‌کاره: {file_path}")
-                except Exception as e:
-                    print(f"❌ خطا در حذف فایل نیمه‌کاره: {e}")
-            
-            # پاکسازی فایل‌های موقت مرتبط
-            temp_pattern = f"{file_path}.*" if file_path else os.path.join(DOWNLOAD_PATH, f"*{message.id}*")
-            for temp_file in glob.glob(temp_pattern):
-                try:
-                    if os.path.exists(temp_file):
-                        os.remove(temp_file)
-                        print(f"🗑️ فایل موقت حذف شد: {temp_file}")
-                        try:
-                            update_config_file_list()
-                        except Exception:
-                            pass
-                except Exception as e:
-                    print(f"❌ خطا در حذف فایل موقت: {e}")
+    except Exception as e:
+        await report_download_error(message, download_id, transfer, e)
+        return None
+    
+    # انتظار برای پایان دانلود در تسک جداگانه انجام می‌شود تا handler فوراً آزاد شود؛
+    # در غیر این صورت دانلودهای صف شده همه workerهای pyrogram را اشغال می‌کنند و
+    # پیام‌های چت‌های دیگر، دکمه لغو و /status تا آزاد شدن نوبت دانلود پردازش نمی‌شوند
+    task = asyncio.create_task(finish_download(message, download_id, transfer, download_task))
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
+async def finish_download(message: Message, download_id: str, transfer: SharedTransfer,
+                          download_task: asyncio.Task) -> None:
+    """
+    انتظار برای پایان انتقال مشترک و ارسال لینک، پیام لغو یا پیام خطا به کاربر
+    """
+    file_path = None
+    try:
+        try:
+            # در حالت stream-through لینک پیش از پایان دانلود ارسال می‌شود
+            if STREAM_THROUGH and file_server.running:
+                await send_stream_link(message, transfer, download_task)
+            
+            # منتظر تکمیل دانلود یا لغو آن
+            file_path, file_name = await download_task
+            download_manager.update_download(download_id, file_path=file_path, file_name=file_name)
             
+        except asyncio.CancelledError:
+            # جدا شدن از انتقال مشترک؛ انتقال فقط با لغو آخرین درخواست متوقف می‌شود
+            # و پاکسازی فایل نیمه‌کاره توسط خود انتقال انجام می‌شود
+            download_manager.leave_transfer(transfer, download_id)
+            if not running:
+                print(f"💾 دانلود نیمه‌کاره برای ادامه پس از راه‌اندازی مجدد حفظ شد: {download_id}")
             download_manager.remove_download(download_id)
             return
         
+        download_manager.leave_transfer(transfer, download_id)
+        
         # بررسی اینکه آیا در حین دانلود لغو شده
         download_state = download_manager.get_download(download_id)
         if download_state and download_state.cancelled:
-            if file_path and os.path.exists(file_path):
-                try:
-                    os.remove(file_path)
-                    try:
-                        update_config_file_list()
-                    except Exception:
-                        pass
-                except Exception:
-                    pass
+            # فایل مشترک با درخواست‌های دیگر حذف نمی‌شود
+            if transfer.total_subscribers > 1:
+                download_state.file_path = None
+            elif file_path:
+                await storage.run(DownloadManager._remove_partial, file_path)
             
             # حذف پیام وضعیت در صورت وجود
             if download_state.status_msg:
                 try:
-                    await download_state.status_msg.delete()
+                    await outbound_queue.delete(download_state.status_msg)
                 except Exception as e:
                     print(f"⚠️ خطا در حذف پیام وضعیت: {e}")
 
-            await message.reply_text(
+            await outbound_queue.reply(
+                message,
                 "🚫 دانلود لغو شد",
-                reply_to_message_id=message.id
+                reply_to_message_id=message.id,
+                priority=PRIORITY_HIGH
             )
             
             download_manager.remove_download(download_id)
@@ -627,22 +3953,14 @@ async def handle_file(client: Client, message: Message):
         
         # محاسبه مدت زمان دانلود
         end_time = time.time()
-        download_duration = end_time - start_time
+        download_duration = end_time - (transfer.started_at or end_time)
         
         # فرمت کردن مدت زمان
-        if download_duration < 60:
-            duration_str = f"{download_duration:.1f} ثانیه"
-        elif download_duration < 3600:
-            minutes = int(download_duration // 60)
-            seconds = int(download_duration % 60)
-            duration_str = f"{minutes} دقیقه و {seconds} ثانیه"
-        else:
-            hours = int(download_duration // 3600)
-            minutes = int((download_duration % 3600) // 60)
-            duration_str = f"{hours} ساعت و {minutes} دقیقه"
+        duration_str = format_duration(download_duration)
         
         # محاسبه حجم فایل و سرعت دانلود
-        file_size = os.path.getsize(file_path) / (1024 * 1024)  # تبدیل به مگابایت
+        indexed_file = file_index.get(file_name)
+        file_size = (indexed_file.size if indexed_file else await storage.run(os.path.getsize, file_path)) / (1024 * 1024)  # تبدیل به مگابایت
         speed_mbps = (file_size / download_duration) if download_duration > 0 else 0
         
         # تولید لینک عمومی
@@ -652,27 +3970,29 @@ async def handle_file(client: Client, message: Message):
         try:
             # حذف پیام وضعیت قبلی
             if download_state and download_state.status_msg:
-                await download_state.status_msg.delete()
+                await outbound_queue.delete(download_state.status_msg)
         except Exception as e:
             print(f"⚠️ خطا در حذف پیام وضعیت: {e}")
 
-        await message.reply_text(
+        await outbound_queue.reply(
+            message,
             f"✅ فایل با موفقیت ذخیره شد!\n\n"
-            f"📁 نام فایل: `{file_name}`\n"
+            f"📁 نام فایل: `{os.path.basename(file_name)}`\n"
             f"📊 حجم: {file_size:.2f} MB\n"
             f"⏱️ مدت زمان: {duration_str}\n"
             f"⚡ سرعت: {speed_mbps:.2f} MB/s\n\n"
             f"🌐 لینک: {public_url}\n\n"
             f"🔗 کپی لینک: `{public_url}`\n\n"
             f"📂 مسیر: `{file_path}`",
-            reply_to_message_id=message.id
+            reply_to_message_id=message.id,
+            priority=PRIORITY_HIGH
         )
         
         # پاک کردن از لیست دانلودهای فعال
         download_manager.remove_download(download_id)
             
         # بررسی و پاکسازی خودکار در صورت نیاز
-        cleanup_old_files()
+        await storage.run(cleanup_old_files)
         # بروزرسانی لیست فایل‌ها در config.json پس از دانلود و احتمالی حذف
         try:
             update_config_file_list()
@@ -680,33 +4000,323 @@ async def handle_file(client: Client, message: Message):
             print(f"⚠️ خطا در بروزرسانی لیست فایل‌ها پس از دانلود: {e}")
         
     except Exception as e:
-        # حذف فایل نیمه‌کاره در صورت خطا
-        if 'file_path' in locals() and file_path and os.path.exists(file_path):
+        await report_download_error(message, download_id, transfer, e)
+
+async def report_download_error(message: Message, download_id: str,
+                                transfer: Optional[SharedTransfer], error: Exception) -> None:
+    """
+    اعلام خطای ذخیره فایل به کاربر و پاکسازی وضعیت دانلود
+    """
+    # فایل نیمه‌کاره توسط خود انتقال پاکسازی می‌شود؛ فایل کامل شده حذف نمی‌شود
+    if transfer is not None:
+        download_manager.leave_transfer(transfer, download_id)
+    
+    # حذف پیام وضعیت در صورت وجود
+    if download_id in download_manager.active_downloads:
+        download_state = download_manager.get_download(download_id)
+        if download_state and download_state.status_msg:
             try:
-                os.remove(file_path)
-                try:
-                    update_config_file_list()
-                except Exception:
-                    pass
-            except Exception:
-                pass
+                await outbound_queue.delete(download_state.status_msg)
+            except Exception as e:
+                print(f"⚠️ خطا در حذف پیام وضعیت: {e}")
+    
+    await outbound_queue.reply(
+        message,
+        f"❌ خطا در ذخیره فایل: {str(error)}",
+        reply_to_message_id=message.id,
+        priority=PRIORITY_HIGH
+    )
+    
+    # پاک کردن از لیست دانلودهای فعال در صورت خطا
+    download_manager.remove_download(download_id)
+
+async def send_stream_link(message: Message, transfer: SharedTransfer, download_task: asyncio.Task) -> None:
+    """
+    ارسال لینک فایل به محض مشخص شدن نام آن؛ سرور HTTP داخلی بایت‌ها را
+    همزمان با دانلود ارائه می‌دهد
+    """
+    if not await download_manager.wait_name_ready(transfer, download_task) or download_task.done():
+        return
+    public_url = build_public_url(transfer.file_name)
+    try:
+        await outbound_queue.reply(
+            message,
+            f"🎬 لینک آماده پخش است (دانلود در حال انجام):\n\n"
+            f"🌐 لینک: {public_url}\n\n"
+            f"🔗 کپی لینک: `{public_url}`",
+            reply_to_message_id=message.id,
+            priority=PRIORITY_HIGH
+        )
+    except Exception as e:
+        print(f"⚠️ خطا در ارسال لینک پخش: {e}")
+
+async def register_lazy_file(message: Message, media, file_name: str, file_size: int, dedup_key: str) -> None:
+    """
+    ثبت مرجع پیام و ارسال لینک بدون دانلود فایل
+    """
+    try:
+        name = lazy_registry.lookup(dedup_key)
+        if name is None:
+            name = await storage.run(resolve_target_name, file_name, media.file_unique_id)
+        # ارسال مجدد همان فایل عمر لینک را تمدید می‌کند
+        await storage.run(
+            lazy_registry.add,
+            name,
+            chat_id=message.chat.id,
+            message_id=message.id,
+            file_unique_id=media.file_unique_id,
+            file_size=file_size,
+            dedup_key=dedup_key,
+            created_at=time.time()
+        )
+        public_url = build_public_url(name)
+        await outbound_queue.reply(
+            message,
+            f"🔗 لینک فایل ساخته شد!\n\n"
+            f"📁 نام فایل: `{os.path.basename(name)}`\n"
+            f"📊 حجم: {file_size / (1024 * 1024):.2f} MB\n\n"
+            f"🌐 لینک: {public_url}\n\n"
+            f"🔗 کپی لینک: `{public_url}`\n\n"
+            f"☁️ فایل در اولین دریافت از تلگرام خوانده می‌شود",
+            reply_to_message_id=message.id,
+            priority=PRIORITY_HIGH
+        )
+    except Exception as e:
+        await outbound_queue.reply(
+            message,
+            f"❌ خطا در ساخت لینک: {str(e)}",
+            reply_to_message_id=message.id,
+            priority=PRIORITY_HIGH
+        )
+
+def fetch_lazy_file(file_name: str) -> Optional[SharedTransfer]:
+    """
+    شروع دریافت یک فایل lazy از تلگرام یا اتصال به دریافت در حال انجام آن
+    درخواست‌های همزمان یک فایل همگی از یک انتقال مشترک استفاده می‌کنند
+    """
+    entry = lazy_registry.get(file_name)
+    if entry is None:
+        return None
+    transfer = download_manager.get_transfer(entry['dedup_key'])
+    if transfer is not None:
+        return transfer
+
+    download_id = f"{entry['chat_id']}_{entry['message_id']}"
+    download_manager.active_downloads[download_id] = DownloadState(
+        message_id=entry['message_id'],
+        chat_id=entry['chat_id'],
+        start_time=time.time(),
+        file_name=file_name
+    )
+    transfer = download_manager.start_transfer(
+        entry['dedup_key'], download_id, run_lazy_transfer(file_name, entry, download_id)
+    )
+    # توقف برنامه این انتقال را نیز لغو می‌کند
+    download_manager.update_download(download_id, task=transfer.task)
+    return transfer
+
+async def run_lazy_transfer(file_name: str, entry: Dict, download_id: str):
+    """
+    دریافت فایل lazy از پیام ثبت شده و اعمال محدودیت حجم کش
+    """
+    try:
+        message = await bot.get_messages(entry['chat_id'], entry['message_id'])
+        if not message or message.empty or not message.media:
+            raise ValueError("پیام یا فایل آن دیگر در دسترس نیست")
+        media, _ = get_media_info(message)
+        print(f"☁️ دریافت فایل lazy از تلگرام: {file_name}")
+        result = await run_transfer(
+            bot, message, media, file_name, entry['file_size'], entry['dedup_key'], download_id, None,
+            target_name=file_name
+        )
+        await storage.run(lazy_registry.trim_cache)
+        return result
+    finally:
+        download_manager.remove_download(download_id)
+
+async def run_transfer(client: Client, message: Message, media, file_name: str, file_size: int,
+                       dedup_key: str, download_id: str, keyboard: InlineKeyboardMarkup,
+                       target_name: Optional[str] = None):
+    """
+    انتقال مشترک یک فایل از تلگرام که بین همه درخواست‌های همان فایل به اشتراک گذاشته می‌شود
+    شامل انتظار در صف، دانلود، ثبت در ایندکس‌ها و پاکسازی فایل نیمه‌کاره در صورت لغو یا خطا
+    target_name: نام از پیش تعیین شده (فایل‌های lazy که لینک آن‌ها قبلاً ارسال شده است)
+    """
+    transfer = download_manager.transfers[dedup_key]
+    download_state = download_manager.get_download(download_id)
+    status_message = download_state.status_msg if download_state else None
+    
+    # تعیین نام ذخیره‌سازی فایل
+    journal_entry = download_journal.get(download_id)
+    if journal_entry and (journal_entry.get('file_unique_id') != media.file_unique_id
+                          or journal_entry.get('part_chunks') != parallel_downloader.part_chunks):
+        await storage.run(download_journal.remove, download_id)
+        journal_entry = None
+    if journal_entry:
+        # ادامه دانلود با همان نام قبلی
+        file_name = journal_entry['file_name']
+    elif target_name:
+        file_name = target_name
+    else:
+        file_name = await storage.run(resolve_target_name, file_name, media.file_unique_id)
+    target_path = os.path.join(DOWNLOAD_PATH, file_name)
+    # دانلود در پوشه staging انجام و پس از تکمیل به مسیر عمومی منتقل می‌شود
+    staging_path = staging_store.staging_file(file_name)
+    download_manager.update_download(download_id, file_name=file_name)
+    completed_parts = set(journal_entry['completed_parts']) if journal_entry else set()
+    use_parallel = not message.photo and not message.voice and parallel_downloader.should_use(file_size)
+    
+    # اطلاعات لازم برای ارائه فایل پیش از پایان دانلود؛ pyrogram در حین دانلود در
+    # فایل .temp و دانلود موازی در فایل .part می‌نویسد
+    transfer.file_name = file_name
+    transfer.file_size = file_size
+    transfer.message = message
+    transfer.client = client
+    transfer.sequential = not use_parallel
+    transfer.readable_path = f"{staging_path}.part" if use_parallel else f"{staging_path}.temp"
+    if use_parallel and completed_parts and await storage.run(os.path.exists, transfer.readable_path):
+        for first_chunk in completed_parts:
+            transfer.chunks_done.update(range(first_chunk, first_chunk + parallel_downloader.part_chunks))
+    transfer.name_ready.set()
+    
+    # ثبت دانلود در ژورنال تا پس از راه‌اندازی مجدد ادامه یابد
+    await storage.run(
+        download_journal.record,
+        download_id,
+        chat_id=message.chat.id,
+        message_id=message.id,
+        file_id=media.file_id,
+        file_unique_id=media.file_unique_id,
+        file_name=file_name,
+        target_path=target_path,
+        file_size=file_size,
+        part_chunks=parallel_downloader.part_chunks,
+        lazy=target_name is not None
+    )
+    
+    was_queued = False
+    
+    # نمایش جایگاه در صف در صورت پر بودن ظرفیت دانلود
+    async def on_queued(position: int):
+        nonlocal was_queued
+        was_queued = True
+        if not status_message:
+            return
+        try:
+            await outbound_queue.edit(
+                status_message,
+                "⏳ فایل در صف دانلود قرار گرفت\n"
+                f"🔢 نوبت شما: {position}",
+                reply_markup=keyboard
+            )
+        except Exception as e:
+            print(f"⚠️ خطا در بروزرسانی پیام صف: {e}")
+    
+    # نمایش انتظار برای فضای دیسک
+    async def on_disk_wait():
+        nonlocal was_queued
+        was_queued = True
+        if not status_message:
+            return
+        try:
+            await outbound_queue.edit(
+                status_message,
+                "💾 در انتظار آزاد شدن فضای دیسک...\n"
+                f"📊 حجم فایل: {file_size / (1024 * 1024):.2f} MB",
+                reply_markup=keyboard
+            )
+        except Exception as e:
+            print(f"⚠️ خطا در بروزرسانی پیام وضعیت: {e}")
+    
+    async def on_progress(current: int, total: int):
+        progress_reporter.record(transfer, current, total)
+    
+    media_type = get_media_type(file_name)
+    queued_at = time.monotonic()
+    try:
+        # رزرو فضای دیسک پیش از شروع دانلود (با حذف پیشاپیش فایل‌ها در صورت نیاز)
+        await storage_admission.admit(dedup_key, file_size, transfer, on_disk_wait)
         
-        # حذف پیام وضعیت در صورت وجود
-        if download_id in download_manager.active_downloads:
-            download_state = download_manager.get_download(download_id)
-            if download_state and download_state.status_msg:
+        # انتظار برای نوبت در زمان‌بند دانلودها
+        await download_manager.acquire_slot(download_id, on_queued)
+        try:
+            # زمان دانلود از لحظه گرفتن نوبت محاسبه می‌شود
+            metrics.observe('queue_wait_seconds', time.monotonic() - queued_at)
+            transfer.started_at = time.time()
+            if was_queued and status_message:
                 try:
-                    await download_state.status_msg.delete()
+                    await outbound_queue.edit(
+                        status_message,
+                        "⏳ در حال دانلود فایل...\n"
+                        "📊 وضعیت: شروع دانلود\n"
+                        "⏱️ زمان: محاسبه...",
+                        reply_markup=keyboard
+                    )
                 except Exception as e:
-                    print(f"⚠️ خطا در حذف پیام وضعیت: {e}")
-        
-        await message.reply_text(
-            f"❌ خطا در ذخیره فایل: {str(e)}",
-            reply_to_message_id=message.id
-        )
+                    print(f"⚠️ خطا در بروزرسانی پیام وضعیت: {e}")
+            
+            # دانلود با کم‌بارترین ربات مجموعه؛ پس از انتقال به ربات دیگر، بازه‌های
+            # ثبت شده در ژورنال دوباره دانلود نمی‌شوند
+            async def download_with(worker_client: Client, worker_message: Message) -> str:
+                transfer.client = worker_client
+                transfer.message = worker_message
+                # فایل‌های بزرگ به صورت موازی و بازه‌ای دانلود می‌شوند
+                if use_parallel:
+                    parts = completed_parts | set((download_journal.get(download_id) or {}).get('completed_parts', []))
+                    if parts:
+                        print(f"♻️ ادامه دانلود {file_name} از {len(parts)} بازه ذخیره شده")
+                    return await parallel_downloader.download(
+                        worker_client, worker_message, staging_path, file_size,
+                        progress=on_progress,
+                        completed_parts=parts,
+                        on_part_done=lambda first_chunk, size: download_journal.commit_part(
+                            download_id, first_chunk, size
+                        ),
+                        on_preallocated=lambda: setattr(transfer, 'preallocated', True),
+                        on_chunk_written=transfer.chunks_done.add
+                    )
+                return await worker_message.download(file_name=staging_path, progress=on_progress)
+            
+            staged_path = await worker_pool.run(client, message, download_with)
+        finally:
+            download_manager.release_slot(download_id)
         
-        # پاک کردن از لیست دانلودهای فعال در صورت خطا
-        download_manager.remove_download(download_id)
+        # انتقال اتمیک فایل کامل شده از staging به مسیر عمومی
+        file_path = await storage.run(staging_store.commit, staged_path, file_name)
+    except asyncio.CancelledError:
+        metrics.inc('downloads_total', media_type=media_type, result='cancelled')
+        # توقف برنامه - فایل نیمه‌کاره و رکورد ژورنال برای ادامه پس از راه‌اندازی مجدد حفظ می‌شوند
+        if running:
+            await storage.run(download_journal.remove, download_id)
+            await storage.run(staging_store.discard, file_name)
+        raise
+    except Exception:
+        metrics.inc('downloads_total', media_type=media_type, result='failed')
+        await storage.run(download_journal.remove, download_id)
+        await storage.run(staging_store.discard, file_name)
+        raise
+    finally:
+        storage_admission.release(dedup_key)
+    
+    # آمار دانلود (در ادامه دانلود، فقط بایت‌های دریافت شده در این اجرا)
+    duration = time.time() - transfer.started_at
+    downloaded_bytes = max(0, file_size - (journal_entry or {}).get('bytes_committed', 0))
+    metrics.inc('downloads_total', media_type=media_type, result='completed')
+    metrics.inc('download_bytes_total', downloaded_bytes, media_type=media_type)
+    metrics.observe('download_duration_seconds', duration, media_type=media_type)
+    if duration > 0:
+        metrics.observe('download_speed_mbps', downloaded_bytes / (1024 * 1024) / duration, media_type=media_type)
+    
+    # دانلود به پایان رسیده و دیگر نیازی به ادامه ندارد
+    await storage.run(download_journal.remove, download_id)
+    
+    # ثبت فایل جدید در ایندکس و ایندکس حذف تکرار
+    await storage.run(file_index.add, file_name)
+    await storage.run(dedup_index.add, dedup_key, file_name)
+    
+    # ساخت تصویر کوچک برای نمایش در index.html در پس‌زمینه
+    thumbnail_store.schedule(client, media, file_name)
+    return file_path, file_name
 
 @bot.on_callback_query()
 async def handle_callback_query(client: Client, callback_query: CallbackQuery):
@@ -733,22 +4343,24 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
                 
                 # حذف پیام وضعیت دانلود
                 try:
-                    await callback_query.message.delete()
+                    await outbound_queue.delete(callback_query.message)
                 except Exception as e:
                     print(f"⚠️ خطا در حذف پیام وضعیت: {e}")
 
                 # اعلان به کاربر
-                await callback_query.answer("⏹️ دانلود لغو شد", show_alert=False)
+                await outbound_queue.answer(callback_query, "⏹️ دانلود لغو شد", show_alert=False)
                 
                 # ارسال پیام لغو به عنوان reply به پیام اصلی
-                await client.send_message(
+                await outbound_queue.send(
+                    client,
                     chat_id=callback_query.message.chat.id,
                     text="🚫 دانلود لغو شد",
-                    reply_to_message_id=download_state.message_id
+                    reply_to_message_id=download_state.message_id,
+                    priority=PRIORITY_HIGH
                 )
                 
             else:
-                await callback_query.answer("⚠️ این دانلود قبلاً تکمیل یا لغو شده است", show_alert=True)
+                await outbound_queue.answer(callback_query, "⚠️ این دانلود قبلاً تکمیل یا لغو شده است", show_alert=True)
         
         elif callback_query.data == "help_info":
             # نمایش راهنمای کامل
@@ -774,8 +4386,8 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
 • تولید لینک عمومی
 • لغو دانلود در حین انجام
             """
-            await callback_query.edit_message_text(help_text)
-            await callback_query.answer("📖 راهنمای کامل نمایش داده شد")
+            await outbound_queue.edit_callback(callback_query, help_text)
+            await outbound_queue.answer(callback_query, "📖 راهنمای کامل نمایش داده شد")
             
         elif callback_query.data == "status_info":
             # نمایش وضعیت سیستم
@@ -796,15 +4408,15 @@ async def handle_callback_query(client: Client, callback_query: CallbackQuery):
 🔒 **کاربران مجاز:** {len(ALLOWED_CHAT_IDS)} نفر
 🌐 **پروکسی:** {'فعال' if get_proxy_config() else 'غیرفعال'}
                 """
-                await callback_query.edit_message_text(status_text)
-                await callback_query.answer("📊 وضعیت سیستم نمایش داده شد")
+                await outbound_queue.edit_callback(callback_query, status_text)
+                await outbound_queue.answer(callback_query, "📊 وضعیت سیستم نمایش داده شد")
             except Exception as e:
-                await callback_query.answer(f"❌ خطا در دریافت وضعیت: {str(e)}", show_alert=True)
+                await outbound_queue.answer(callback_query, f"❌ خطا در دریافت وضعیت: {str(e)}", show_alert=True)
                 
     except Exception as e:
         print(f"❌ خطا در هندلر callback: {e}")
         try:
-            await callback_query.answer("❌ خطا در لغو دانلود", show_alert=True)
+            await outbound_queue.answer(callback_query, "❌ خطا در لغو دانلود", show_alert=True)
         except Exception:
             pass
 
@@ -827,7 +4439,8 @@ async def start_command(client: Client, message: Message):
     # ایجاد متن دستورات
     commands_text = "\n".join([f"/{cmd} - {desc}" for cmd, desc in BOT_COMMANDS])
     
-    await message.reply_text(
+    await outbound_queue.reply(
+        message,
         "👋 سلام! به ربات ذخیره‌ساز فایل خوش آمدید.\n\n"
         "📤 هر فایلی که به این ربات فوروارد کنید، "
         f"در مسیر `{DOWNLOAD_PATH}` ذخیره می‌شود.\n\n"
@@ -856,7 +4469,8 @@ async def help_command(client: Client, message: Message):
     # ایجاد متن دستورات
     commands_text = "\n".join([f"• /{cmd} - {desc}" for cmd, desc in BOT_COMMANDS])
     
-    await message.reply_text(
+    await outbound_queue.reply(
+        message,
         "📖 راهنمای استفاده:\n\n"
         "1️⃣ هر فایلی را که می‌خواهید ذخیره کنید، به این ربات فوروارد کنید\n"
         "2️⃣ ربات فایل را دانلود کرده و در سرور ذخیره می‌کند\n"
@@ -910,7 +4524,7 @@ async def proxy_command(client: Client, message: Message):
 ```
         """
     
-    await message.reply_text(proxy_info)
+    await outbound_queue.reply(message, proxy_info)
 
 @bot.on_message(filters.command("status"))
 async def status_command(client: Client, message: Message):
@@ -927,6 +4541,40 @@ async def status_command(client: Client, message: Message):
         
         # شمارش فایل‌های قدیمی
         old_files = sum(1 for f in stats['files'] if f['age_hours'] > FILE_MAX_AGE_HOURS)
+        lag = loop_lag_monitor.stats()
+        
+        # پربازدیدترین فایل‌ها براساس لاگ nginx
+        now = time.time()
+        hot_files = access_tracker.hot_files()
+        hot_text = "\n".join(
+            f"• `{os.path.basename(name)}` - {hits} بازدید، آخرین: {format_duration(max(0, now - last_access))} پیش"
+            for name, hits, last_access in hot_files
+        ) or "• هنوز بازدیدی ثبت نشده است"
+        
+        # آمار سرور HTTP داخلی در صورت فعال بودن
+        http_text = ""
+        if file_server.running:
+            http_stats = file_server.stats
+            latency_sum, latency_count = metrics.histogram_totals('http_request_seconds')
+            avg_latency = latency_sum / latency_count * 1000 if latency_count else 0
+            http_text = (
+                f"\n🌍 **سرور HTTP داخلی:** {http_stats.total_requests()} درخواست، "
+                f"{http_stats.bytes_sent / (1024 * 1024):.1f} MB ارسال، "
+                f"میانگین {avg_latency:.1f} ms، {http_stats.in_flight} در جریان\n"
+            )
+            if LAZY_FETCH_CONFIG.get('enabled', False):
+                cached = sum(1 for name in list(lazy_registry.entries) if file_index.get(name))
+                http_text += f"☁️ **لینک‌های lazy:** {len(lazy_registry.entries)} (در کش: {cached})\n"
+        
+        # وضعیت ربات‌های دانلود در صورت فعال بودن مجموعه
+        workers_text = ""
+        if worker_pool.enabled:
+            workers_text = "🤖 **ربات‌های دانلود:** " + "، ".join(
+                f"{worker.name}: {worker.active} دانلود"
+                + ("" if worker.healthy else " (قطع)")
+                + (" (FloodWait)" if worker.flood_until > time.monotonic() else "")
+                for worker in worker_pool.workers
+            ) + "\n"
         
         # نمایش وضعیت سیستم
         status_msg = f"""
@@ -941,7 +4589,14 @@ async def status_command(client: Client, message: Message):
 
 🔒 **کاربران مجاز:** {len(ALLOWED_CHAT_IDS)} نفر
 🌐 **پروکسی:** {'فعال' if get_proxy_config() else 'غیرفعال'}
+⏱️ **تأخیر event loop ({loop_implementation(asyncio.get_running_loop())}):** {lag['avg']:.1f} ms (p99: {lag['p99']:.1f} ms، حداکثر: {loop_lag_monitor.max_ms:.0f} ms)
+🗄️ **عملیات ذخیره‌سازی در جریان:** {storage.pending}
+📦 **فضای رزرو شده برای دانلودها:** {storage_admission.reserved_bytes() / (1024 * 1024):.1f} MB
+{workers_text}🧠 **فشار حافظه:** {memory_manager.level} (مصرف {memory_manager.last_sample.get('percent', 0):.1f}%، PSI: {memory_manager.last_sample.get('psi_some', 0):.1f}، بافرها: {memory_manager.buffered_bytes / (1024 * 1024):.0f} MB)
 
+🔥 **فایل‌های پربازدید:**
+{hot_text}
+{http_text}
 📋 **دستورات موجود:**
 • /start - شروع و معرفی ربات
 • /help - راهنمای استفاده  
@@ -952,10 +4607,10 @@ async def status_command(client: Client, message: Message):
 🚫 **قابلیت لغو دانلود:** در حین دانلود می‌توانید با دکمه لغو، دانلود را متوقف کنید
         """
         
-        await message.reply_text(status_msg)
+        await outbound_queue.reply(message, status_msg)
         
     except Exception as e:
-        await message.reply_text(f"❌ خطا در دریافت وضعیت: {str(e)}")
+        await outbound_queue.reply(message, f"❌ خطا در دریافت وضعیت: {str(e)}")
 
 @bot.on_message(filters.command("config"))
 async def config_command(client: Client, message: Message):
@@ -998,10 +4653,10 @@ async def config_command(client: Client, message: Message):
 برای تغییر تنظیمات، فایل config.json را ویرایش کنید و ربات را مجدداً راه‌اندازی کنید.
         """
         
-        await message.reply_text(config_text)
+        await outbound_queue.reply(message, config_text)
         
     except Exception as e:
-        await message.reply_text(f"❌ خطا در نمایش تنظیمات: {str(e)}")
+        await outbound_queue.reply(message, f"❌ خطا در نمایش تنظیمات: {str(e)}")
 
 @bot.on_message(filters.command([cmd for cmd, _ in BOT_COMMANDS]))
 async def handle_commands(client: Client, message: Message):
@@ -1019,33 +4674,31 @@ async def handle_commands(client: Client, message: Message):
         try:
             stats_before = get_file_stats()
             if stats_before['total_files'] == 0:
-                await message.reply_text("📂 پوشه خالی است - نیازی به پاکسازی نیست")
+                await outbound_queue.reply(message, "📂 پوشه خالی است - نیازی به پاکسازی نیست")
                 return
                 
-            status_msg = await message.reply_text(
+            status_msg = await outbound_queue.reply(
+                message,
                 f"🔍 بررسی {stats_before['total_files']} فایل...",
                 reply_to_message_id=message.id
             )
             
-            cleanup_old_files()
-            stats_after = get_file_stats()
+            result = await storage.run(cleanup_old_files)
             
-            if stats_before['total_files'] == stats_after['total_files']:
-                await status_msg.edit_text("✅ نیازی به پاکسازی نیست، فضای کافی موجود است")
+            if not result.files_removed:
+                await outbound_queue.edit(status_msg, "✅ نیازی به پاکسازی نیست، فضای کافی موجود است")
                 return
-                
-            files_removed = stats_before['total_files'] - stats_after['total_files']
-            space_freed = stats_before['total_size_mb'] - stats_after['total_size_mb']
             
-            await status_msg.edit_text(
+            await outbound_queue.edit(
+                status_msg,
                 f"♻️ پاکسازی انجام شد:\n"
-                f"🗑️ {files_removed} فایل حذف شد\n"
-                f"💾 {space_freed:.1f} MB فضا آزاد شد"
+                f"🗑️ {result.files_removed} فایل حذف شد ({result.expired} فایل منقضی)\n"
+                f"💾 {result.bytes_freed / (1024 * 1024):.1f} MB فضا آزاد شد"
             )
             return
             
         except Exception as e:
-            await message.reply_text(f"❌ خطا در پاکسازی: {str(e)}")
+            await outbound_queue.reply(message, f"❌ خطا در پاکسازی: {str(e)}")
             return
 
     # برای سایر دستورات ناشناخته
@@ -1053,7 +4706,8 @@ async def handle_commands(client: Client, message: Message):
     help_button = InlineKeyboardButton("📖 راهنما", callback_data="help_info")
     keyboard = InlineKeyboardMarkup([[help_button]])
     
-    await message.reply_text(
+    await outbound_queue.reply(
+        message,
         f"❓ دستور `{command}` شناخته نشده است.\n\n"
         "برای مشاهده لیست دستورات موجود، از /help استفاده کنید یا "
         "روی دکمه راهنما کلیک کنید.",
@@ -1087,14 +4741,589 @@ async def graceful_cleanup():
     if background_tasks:
         await asyncio.gather(*background_tasks, return_exceptions=True)
     
-    # توقف ربات
+    # نوشتن تغییرات در انتظار files.json
+    try:
+        await manifest_writer.flush()
+    except Exception as e:
+        print(f"⚠️ خطا در نوشتن files.json: {e}")
+    
+    # توقف سرور HTTP داخلی
+    try:
+        await file_server.stop()
+    except Exception as e:
+        print(f"⚠️ خطا در توقف سرور HTTP: {e}")
+    try:
+        await metrics_server.stop()
+    except Exception as e:
+        print(f"⚠️ خطا در توقف endpoint متریک‌ها: {e}")
+    
+    # توقف ربات‌های کمکی و ربات اصلی
+    await worker_pool.stop()
     try:
         await bot.stop()
     except Exception as e:
         print(f"⚠️ خطا در توقف ربات: {e}")
     
+    # انتظار برای پایان عملیات ذخیره‌سازی در جریان
+    storage.shutdown()
+    thumbnail_store.shutdown()
+    
     print("✅ ربات با موفقیت متوقف شد")
 
+async def resume_journaled_downloads():
+    """
+    صف‌بندی مجدد دانلودهای نیمه‌کاره ثبت شده در ژورنال پس از راه‌اندازی
+    """
+    entries = await storage.run(download_journal.load)
+    for download_id, entry in entries.items():
+        # دریافت‌های lazy با درخواست HTTP بعدی از همان نقطه ادامه می‌یابند
+        if entry.get('lazy'):
+            continue
+        try:
+            message = await bot.get_messages(entry['chat_id'], entry['message_id'])
+            if not message or message.empty or not message.media:
+                raise ValueError("پیام یا فایل آن دیگر در دسترس نیست")
+        except Exception as e:
+            print(f"⚠️ امکان ادامه دانلود {download_id} وجود ندارد: {e}")
+            await storage.run(download_journal.remove, download_id)
+            continue
+
+        print(f"♻️ صف‌بندی مجدد دانلود نیمه‌کاره: {entry.get('file_name')}")
+        task = asyncio.create_task(handle_file(bot, message))
+        background_tasks.add(task)
+        task.add_done_callback(background_tasks.discard)
+
+async def benchmark_download(chat_id: int, message_id: int):
+    """
+    مقایسه سرعت دانلود معمولی (message.download) با دانلود موازی روی یک پیام واقعی
+    استفاده: python bot.py --benchmark-download CHAT_ID MESSAGE_ID
+    """
+    await bot.start()
+    try:
+        message = await bot.get_messages(chat_id, message_id)
+        media, file_name = get_media_info(message)
+        file_size = getattr(media, 'file_size', 0) or 0
+        bench_dir = os.path.join(DOWNLOAD_PATH, '.benchmark')
+        os.makedirs(bench_dir, exist_ok=True)
+        print(f"📏 فایل: {file_name} - {file_size / (1024 * 1024):.2f} MB")
+
+        results = []
+        for label in ('sequential', 'parallel'):
+            target_path = os.path.join(bench_dir, f"{label}_{file_name}")
+            started = time.perf_counter()
+            if label == 'sequential':
+                await message.download(file_name=target_path)
+            else:
+                await parallel_downloader.download(bot, message, target_path, file_size)
+            elapsed = time.perf_counter() - started
+            speed = (file_size / (1024 * 1024)) / elapsed if elapsed > 0 else 0
+            results.append((label, elapsed, speed))
+            os.remove(target_path)
+
+        for label, elapsed, speed in results:
+            print(f"⚡ {label}: {elapsed:.2f} s - {speed:.2f} MB/s")
+        print(
+            f"🔧 part_size_mb={parallel_downloader.part_chunks} "
+            f"workers={parallel_downloader.workers}"
+        )
+    finally:
+        await bot.stop()
+
+async def benchmark_cleanup(file_count: int):
+    """
+    اندازه‌گیری تأخیر event loop هنگام ایندکس و حذف تعداد زیادی فایل
+    یکبار مستقیم روی event loop و یکبار از طریق thread pool ذخیره‌سازی
+    استفاده: python bot.py --benchmark-cleanup 10000
+    """
+    bench_dir = os.path.join(DOWNLOAD_PATH, '.benchmark-cleanup')
+
+    def create_files():
+        os.makedirs(bench_dir, exist_ok=True)
+        for i in range(file_count):
+            with open(os.path.join(bench_dir, f"file_{i:06d}.bin"), 'wb') as f:
+                f.write(b'\0' * 1024)
+
+    def remove_files(index: FileIndex):
+        for entry in index.snapshot():
+            os.remove(os.path.join(bench_dir, entry.name))
+            index.remove(entry.name)
+
+    loop_lag_monitor.interval = 0.01
+    monitor_task = asyncio.create_task(loop_lag_monitor.run())
+    try:
+        results = []
+        for label in ('event_loop', 'storage_executor'):
+            await storage.run(create_files)
+            bench_index = FileIndex(bench_dir)
+            await asyncio.sleep(0.1)
+            loop_lag_monitor.samples.clear()
+            loop_lag_monitor.max_ms = 0.0
+
+            started = time.perf_counter()
+            if label == 'event_loop':
+                bench_index.build()
+                remove_files(bench_index)
+            else:
+                await storage.run(bench_index.build)
+                await storage.run(remove_files, bench_index)
+            elapsed = time.perf_counter() - started
+            # نمونه آخر پس از پایان عملیات ثبت شود
+            await asyncio.sleep(loop_lag_monitor.interval * 3)
+            results.append((label, elapsed, loop_lag_monitor.stats()))
+
+        print(f"📏 تعداد فایل: {file_count}")
+        for label, elapsed, lag in results:
+            print(
+                f"⏱️ {label}: {elapsed:.2f} s - "
+                f"loop lag avg={lag['avg']:.1f} ms p99={lag['p99']:.1f} ms max={lag['max']:.1f} ms"
+            )
+    finally:
+        monitor_task.cancel()
+        try:
+            os.rmdir(bench_dir)
+        except OSError:
+            pass
+        storage.shutdown()
+
+async def benchmark_http(url: str, total_requests: int = 200, concurrency: int = 16):
+    """
+    اندازه‌گیری توان و تأخیر ارائه یک فایل (برای مقایسه nginx با سرور HTTP داخلی)
+    استفاده: python bot.py --benchmark-http URL [REQUESTS] [CONCURRENCY]
+    """
+    if aiohttp is None:
+        print("❌ برای بنچمارک HTTP نصب aiohttp لازم است (pip install aiohttp)")
+        return
+    latencies = []
+    received = 0
+    remaining = itertools.count()
+
+    async def worker(session):
+        nonlocal received
+        while next(remaining) < total_requests:
+            started = time.perf_counter()
+            async with session.get(url) as response:
+                async for chunk in response.content.iter_chunked(1 << 16):
+                    received += len(chunk)
+            latencies.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as session:
+        await asyncio.gather(*(worker(session) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    print(f"📏 {url} - {len(latencies)} درخواست با همزمانی {concurrency}")
+    print(f"⚡ {len(latencies) / elapsed:.1f} req/s - {received / (1024 * 1024) / elapsed:.2f} MB/s")
+    print(
+        f"⏱️ p50={latencies[len(latencies) // 2] * 1000:.1f} ms "
+        f"p99={latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000:.1f} ms"
+    )
+
+# جایگزین‌های محلی تلگرام برای بنچمارک آفلاین
+@dataclass
+class BenchmarkMedia:
+    """
+    رسانه مصنوعی با همان فیلدهایی که از شیء رسانه pyrogram خوانده می‌شوند
+    """
+    file_id: str
+    file_unique_id: str
+    file_size: int
+    file_name: str = None
+    thumbs: list = None
+
+@dataclass
+class BenchmarkChat:
+    id: int
+
+class BenchmarkClient:
+    """
+    Client مصنوعی که داده را با پهنای باند و تأخیر تنظیم شده ارائه می‌دهد
+    و زمان ارسال لینک هر پیام را ثبت می‌کند
+    """
+    CHUNK_SIZE = 1024 * 1024
+
+    def __init__(self, bandwidth_mbps: float = 50, latency_ms: float = 50):
+        self.bandwidth = bandwidth_mbps * 1024 * 1024
+        self.latency = latency_ms / 1000
+        self.link_times: Dict[Tuple[int, int], float] = {}
+        self._chunk = bytes(self.CHUNK_SIZE)
+        self._message_ids = itertools.count(1_000_000)
+
+    async def api_call(self) -> None:
+        await asyncio.sleep(self.latency)
+
+    async def stream_media(self, message, offset: int = 0, limit: int = 0):
+        """
+        ارائه قطعه‌های 1 مگابایتی با سرعت bandwidth برای هر جریان
+        """
+        await self.api_call()
+        media = message.document or message.video
+        total_chunks = (media.file_size + self.CHUNK_SIZE - 1) // self.CHUNK_SIZE
+        last = total_chunks if not limit else min(total_chunks, offset + limit)
+        for index in range(offset, last):
+            size = min(self.CHUNK_SIZE, media.file_size - index * self.CHUNK_SIZE)
+            await asyncio.sleep(size / self.bandwidth)
+            yield self._chunk[:size]
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        await self.api_call()
+        return BenchmarkMessage(self, chat_id, next(self._message_ids), text=text)
+
+    async def get_messages(self, chat_id: int, message_id: int):
+        raise ValueError("پیام در بنچمارک آفلاین وجود ندارد")
+
+    async def download_media(self, file_id: str, file_name: str = None):
+        raise ValueError("thumb در بنچمارک آفلاین وجود ندارد")
+
+class BenchmarkMessage:
+    """
+    پیام مصنوعی؛ دانلود مانند pyrogram در فایل .temp نوشته و سپس جابجا می‌شود
+    """
+    def __init__(self, client: BenchmarkClient, chat_id: int, message_id: int,
+                 media: BenchmarkMedia = None, kind: str = 'document', text: str = ''):
+        self._client = client
+        self.chat = BenchmarkChat(chat_id)
+        self.id = message_id
+        self.text = text
+        self.empty = False
+        self.document = self.photo = self.video = self.audio = self.voice = None
+        self.media = kind if media else None
+        if media:
+            setattr(self, kind, media)
+        self.started_at = time.perf_counter()
+
+    async def reply_text(self, text: str, **kwargs):
+        await self._client.api_call()
+        if '🌐' in text:
+            self._client.link_times[(self.chat.id, self.id)] = time.perf_counter() - self.started_at
+        return BenchmarkMessage(self._client, self.chat.id, next(self._client._message_ids), text=text)
+
+    async def edit_text(self, text: str, **kwargs):
+        await self._client.api_call()
+        self.text = text
+        return self
+
+    async def delete(self):
+        await self._client.api_call()
+
+    async def download(self, file_name: str = None, progress: Callable = None, **kwargs):
+        media = self.document or self.video or self.audio or self.photo or self.voice
+        temp_path = f"{file_name}.temp"
+        written = 0
+        with open(temp_path, 'wb') as f:
+            async for chunk in self._client.stream_media(self):
+                f.write(chunk)
+                written += len(chunk)
+                if progress:
+                    await progress(written, media.file_size)
+        os.replace(temp_path, file_name)
+        return file_name
+
+class BenchmarkCallbackQuery:
+    """
+    callback مصنوعی دکمه لغو
+    """
+    def __init__(self, client: BenchmarkClient, data: str, message: BenchmarkMessage):
+        self._client = client
+        self.data = data
+        self.message = message
+
+    async def answer(self, *args, **kwargs):
+        await self._client.api_call()
+
+    async def edit_message_text(self, *args, **kwargs):
+        await self._client.api_call()
+
+def use_benchmark_root(root: str) -> None:
+    """
+    هدایت همه مسیرهای ذخیره‌سازی به یک پوشه موقت تا بنچمارک به فایل‌های واقعی دست نزند
+    و حذف فهرست کاربران مجاز تا پیام‌های چت‌های مصنوعی رد نشوند
+    """
+    global DOWNLOAD_PATH, ALLOWED_CHAT_IDS
+    ALLOWED_CHAT_IDS = []
+    DOWNLOAD_PATH = os.path.join(root, 'dl')
+    os.makedirs(DOWNLOAD_PATH, exist_ok=True)
+    file_index.path = eviction_engine.path = thumbnail_store.path = DOWNLOAD_PATH
+    staging_store.public_path = DOWNLOAD_PATH
+    staging_store.path = os.path.join(root, '.staging')
+    staging_store.prepare()
+    manifest_writer.path = os.path.join(root, 'files.json')
+    manifest_writer.pages_dir = os.path.join(root, 'files')
+    dedup_index.path = os.path.join(root, 'dedup_index.jsonl')
+    download_journal.path = os.path.join(root, 'downloads_journal.json')
+    lazy_registry.path = os.path.join(root, 'lazy_files.json')
+    access_tracker.stats_path = os.path.join(root, 'access_stats.json')
+    access_tracker.log_path = ''
+    thumbnail_store.enabled = False
+
+async def benchmark_offline(uploads: int = 100, file_size_mb: float = 2, bandwidth_mbps: float = 50,
+                            latency_ms: float = 50, concurrency_levels: Tuple[int, ...] = (1, 8, 32),
+                            directory_sizes: Tuple[int, ...] = (0, 10000), cancel_ratio: float = 0.05):
+    """
+    بنچمارک بدون حساب تلگرام: handle_file، هندلر لغو، پاکسازی و manifest با یک Client
+    مصنوعی با پهنای باند و تأخیر قابل تنظیم، برای اندازه‌های مختلف پوشه و همزمانی
+    گزارش: فایل بر ثانیه، MB/s، p50/p99 زمان تا ارسال لینک، تأخیر event loop،
+    تعداد syscall های خواندن/نوشتن هر آپلود و زمان بازسازی manifest و پاکسازی
+    استفاده: python bot.py --benchmark-offline [UPLOADS] [FILE_SIZE_MB] [BANDWIDTH_MBPS] [LATENCY_MS]
+    """
+    root = tempfile.mkdtemp(prefix='tgfl-bench-')
+    use_benchmark_root(root)
+    manifest_writer.start(asyncio.get_running_loop())
+    process = psutil.Process()
+    file_size = int(file_size_mb * 1024 * 1024)
+
+    def reset(directory_size: int) -> None:
+        shutil.rmtree(DOWNLOAD_PATH, ignore_errors=True)
+        os.makedirs(DOWNLOAD_PATH)
+        for i in range(directory_size):
+            with open(os.path.join(DOWNLOAD_PATH, f"existing_{i:06d}.bin"), 'wb') as f:
+                f.write(b'\0' * 1024)
+        dedup_index.entries = {}
+        download_journal.entries = {}
+        file_index.build()
+
+    async def upload(client: BenchmarkClient, n: int, cancel: bool) -> None:
+        media = BenchmarkMedia(f"bench{n}", f"BENCH{n:06d}", file_size, f"bench_{n:06d}.mp4")
+        message = BenchmarkMessage(client, 10_000 + n, n, media, kind='video')
+        if cancel:
+            asyncio.create_task(cancel_later(client, message))
+        task = await handle_file(client, message)
+        if task:
+            await task
+
+    async def cancel_later(client: BenchmarkClient, message: BenchmarkMessage) -> None:
+        download_id = f"{message.chat.id}_{message.id}"
+        while True:
+            await asyncio.sleep(0.01)
+            download = download_manager.get_download(download_id)
+            if download is None:
+                return
+            if download.status_msg and download.file_name:
+                break
+        await asyncio.sleep(file_size / client.bandwidth / 2)
+        await handle_callback_query(client, BenchmarkCallbackQuery(client, f"cancel_{download_id}", download.status_msg))
+
+    progress_task = asyncio.create_task(progress_reporter.run())
+    monitor = LoopLagMonitor(interval=0.01, warn_ms=float('inf'))
+    monitor_task = asyncio.create_task(monitor.run())
+    rows = []
+    try:
+        for directory_size in directory_sizes:
+            for concurrency in concurrency_levels:
+                await storage.run(reset, directory_size)
+                client = BenchmarkClient(bandwidth_mbps, latency_ms)
+                semaphore = asyncio.Semaphore(concurrency)
+                cancel_every = int(1 / cancel_ratio) if cancel_ratio > 0 else 0
+
+                async def limited(n: int) -> None:
+                    async with semaphore:
+                        await upload(client, n, bool(cancel_every) and n % cancel_every == cancel_every - 1)
+
+                monitor.samples.clear()
+                monitor.max_ms = 0.0
+                io_before = process.io_counters()
+                started = time.perf_counter()
+                await asyncio.gather(*(limited(n) for n in range(uploads)))
+                elapsed = time.perf_counter() - started
+                io_after = process.io_counters()
+
+                # هزینه مسیرهای manifest و پاکسازی با اندازه فعلی پوشه
+                manifest_started = time.perf_counter()
+                await storage.run(manifest_writer.write_now)
+                manifest_ms = (time.perf_counter() - manifest_started) * 1000
+                cleanup_started = time.perf_counter()
+                await storage.run(eviction_engine.run)
+                cleanup_ms = (time.perf_counter() - cleanup_started) * 1000
+
+                completed = len(client.link_times)
+                if not completed:
+                    raise RuntimeError(
+                        f"هیچ آپلودی کامل نشد (پوشه {directory_size} فایل، همزمانی {concurrency})؛ نتایج معتبر نیستند"
+                    )
+                link_times = sorted(client.link_times.values())
+                syscalls = (io_after.read_count - io_before.read_count) + (io_after.write_count - io_before.write_count)
+                rows.append({
+                    'files': directory_size,
+                    'concurrency': concurrency,
+                    'files_per_sec': completed / elapsed,
+                    'mb_per_sec': completed * file_size / (1024 * 1024) / elapsed,
+                    'p50': link_times[len(link_times) // 2] * 1000,
+                    'p99': link_times[min(len(link_times) - 1, int(len(link_times) * 0.99))] * 1000,
+                    'lag': monitor.stats(),
+                    'syscalls': syscalls / max(1, uploads),
+                    'manifest_ms': manifest_ms,
+                    'cleanup_ms': cleanup_ms
+                })
+    finally:
+        progress_task.cancel()
+        monitor_task.cancel()
+        await manifest_writer.flush()
+        shutil.rmtree(root, ignore_errors=True)
+        storage.shutdown()
+
+    print(
+        f"📏 {uploads} آپلود {file_size_mb} MB - پهنای باند {bandwidth_mbps} MB/s - "
+        f"تأخیر {latency_ms} ms - لغو {cancel_ratio * 100:.0f}%"
+    )
+    for row in rows:
+        print(
+            f"📂 {row['files']:>6} فایل | همزمانی {row['concurrency']:>3} | "
+            f"{row['files_per_sec']:.2f} فایل/s | {row['mb_per_sec']:.2f} MB/s | "
+            f"لینک p50={row['p50']:.0f} ms p99={row['p99']:.0f} ms | "
+            f"loop lag p99={row['lag']['p99']:.1f} ms max={row['lag']['max']:.1f} ms | "
+            f"{row['syscalls']:.0f} syscall/آپلود | manifest {row['manifest_ms']:.1f} ms | "
+            f"پاکسازی {row['cleanup_ms']:.1f} ms"
+        )
+
+async def benchmark_loop_worker(messages: int, concurrency: int):
+    """
+    اجرای بار پیام‌ها با handle_file روی event loop جاری و چاپ نتیجه به صورت JSON
+    (توسط benchmark_loop در یک پردازه جداگانه برای هر پیاده‌سازی اجرا می‌شود)
+    """
+    root = tempfile.mkdtemp(prefix='tgfl-loop-bench-')
+    # شامل حذف فهرست کاربران مجاز برای چت‌های مصنوعی
+    use_benchmark_root(root)
+    manifest_writer.start(asyncio.get_running_loop())
+    # محدودیت نرخ ارسال، پهنای باند و تأخیر شبکه حذف می‌شوند تا هزینه خود event loop سنجیده شود
+    outbound_queue.global_bucket = TokenBucket(1e9, 1e9)
+    outbound_queue.chat_rate = outbound_queue.chat_burst = outbound_queue.group_rate = 1e9
+    client = BenchmarkClient(bandwidth_mbps=1e6, latency_ms=0)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def handle(n: int) -> None:
+        async with semaphore:
+            media = BenchmarkMedia(f"loop{n}", f"LOOP{n:06d}", 64 * 1024, f"loop_{n:06d}.bin")
+            task = await handle_file(client, BenchmarkMessage(client, 20_000 + n, n, media))
+            if task:
+                await task
+
+    progress_task = asyncio.create_task(progress_reporter.run())
+    monitor = LoopLagMonitor(interval=0.01, warn_ms=float('inf'))
+    monitor_task = asyncio.create_task(monitor.run())
+    try:
+        started = time.perf_counter()
+        await asyncio.gather(*(handle(n) for n in range(messages)))
+        elapsed = time.perf_counter() - started
+    finally:
+        progress_task.cancel()
+        monitor_task.cancel()
+        await manifest_writer.flush()
+        shutil.rmtree(root, ignore_errors=True)
+        storage.shutdown()
+
+    if not client.link_times:
+        raise RuntimeError("هیچ پیامی پردازش نشد؛ نتایج معتبر نیستند")
+    link_times = sorted(client.link_times.values())
+    print(json.dumps({
+        'implementation': loop_implementation(asyncio.get_running_loop()),
+        'completed': len(client.link_times),
+        'messages_per_sec': len(client.link_times) / elapsed,
+        'p50': link_times[len(link_times) // 2] * 1000,
+        'p99': link_times[min(len(link_times) - 1, int(len(link_times) * 0.99))] * 1000,
+        'lag': monitor.stats()
+    }))
+
+def benchmark_loop(messages: int = 2000, concurrency: int = 64):
+    """
+    مقایسه توان و تأخیر پردازش پیام بین event loop پیش‌فرض asyncio و uvloop
+    هر پیاده‌سازی در یک پردازه جداگانه (با متغیر محیطی EVENT_LOOP) اجرا می‌شود
+    استفاده: python bot.py --benchmark-loop [MESSAGES] [CONCURRENCY]
+    """
+    implementations = ['asyncio']
+    if uvloop is not None:
+        implementations.append('uvloop')
+    else:
+        print("⚠️ uvloop نصب نیست، فقط event loop پیش‌فرض سنجیده می‌شود")
+
+    rows = []
+    for implementation in implementations:
+        result = subprocess.run(
+            [sys.executable, os.path.abspath(__file__), '--benchmark-loop-worker', str(messages), str(concurrency)],
+            env={**os.environ, 'EVENT_LOOP': implementation},
+            capture_output=True, text=True
+        )
+        lines = [line for line in result.stdout.splitlines() if line.startswith('{')]
+        if result.returncode or not lines:
+            print(f"❌ خطا در اجرای بنچمارک {implementation}:\n{result.stderr[-2000:]}")
+            continue
+        rows.append(json.loads(lines[-1]))
+
+    # مقایسه فقط با نتیجه معتبر همه پیاده‌سازی‌ها معنا دارد
+    if len(rows) < len(implementations):
+        raise RuntimeError("بنچمارک event loop برای همه پیاده‌سازی‌ها کامل نشد")
+
+    print(f"📏 {messages} پیام - همزمانی {concurrency}")
+    baseline = rows[0]['messages_per_sec']
+    for row in rows:
+        speedup = row['messages_per_sec'] / baseline
+        print(
+            f"🔁 {row['implementation']:>7} | {row['messages_per_sec']:.1f} پیام/s (x{speedup:.2f}) | "
+            f"لینک p50={row['p50']:.1f} ms p99={row['p99']:.1f} ms | "
+            f"loop lag p99={row['lag']['p99']:.1f} ms max={row['lag']['max']:.1f} ms"
+        )
+
+def migrate_storage_layout():
+    """
+    انتقال یکجای فایل‌های موجود به چیدمان تنظیم شده در storage_layout
+    (مثلاً از flat به hashed) همراه با بروزرسانی ایندکس‌ها و manifest
+    ربات باید هنگام اجرای این ابزار متوقف باشد
+    استفاده: python bot.py --migrate-layout
+    """
+    print(f"🚚 انتقال فایل‌ها به چیدمان {STORAGE_LAYOUT}...")
+    file_index.build()
+    dedup_index.load()
+    access_tracker.load()
+
+    # شناسه هر فایل از ایندکس حذف تکرار (file_unique_id) و در غیر این صورت از هش نام
+    file_ids = {}
+    for key, names in dedup_index.entries.items():
+        for name in names:
+            file_ids[name] = key.split(':', 1)[0]
+
+    renamed: Dict[str, str] = {}
+    created_dirs = set()
+    for entry in sorted(file_index.snapshot(), key=lambda item: item.name):
+        base_name = os.path.basename(entry.name)
+        file_id = file_ids.get(entry.name) or hashlib.sha1(base_name.encode('utf-8')).hexdigest()[:16]
+        directory = shard_dir(file_id, entry.mtime)
+        target = f"{directory}/{base_name}" if directory else base_name
+        if target == entry.name:
+            continue
+        if os.path.exists(os.path.join(DOWNLOAD_PATH, target)):
+            stem, ext = os.path.splitext(base_name)
+            target = f"{directory}/{stem}_{file_id}{ext}" if directory else f"{stem}_{file_id}{ext}"
+
+        target_dir = os.path.dirname(os.path.join(DOWNLOAD_PATH, target))
+        if target_dir not in created_dirs:
+            os.makedirs(target_dir, exist_ok=True)
+            created_dirs.add(target_dir)
+        try:
+            os.rename(os.path.join(DOWNLOAD_PATH, entry.name), os.path.join(DOWNLOAD_PATH, target))
+        except OSError as e:
+            print(f"❌ خطا در انتقال {entry.name}: {e}")
+            continue
+        thumbnail_store.move(entry.name, target)
+        prune_shard_dirs(entry.name)
+        renamed[entry.name] = target
+        if len(renamed) % 1000 == 0:
+            print(f"📦 {len(renamed)} فایل منتقل شد...")
+
+    # بروزرسانی ارجاع‌های ایندکس حذف تکرار و آمار دسترسی با مسیرهای جدید
+    dedup_index.entries = {
+        key: [renamed.get(name, name) for name in names]
+        for key, names in dedup_index.entries.items()
+    }
+    access_tracker.stats = {
+        renamed.get(name, name): value for name, value in access_tracker.stats.items()
+    }
+    file_index.build()
+    dedup_index.compact()
+    access_tracker.save()
+    manifest_writer.write_now()
+    print(f"✅ {len(renamed)} فایل به چیدمان {STORAGE_LAYOUT} منتقل شد")
+    if renamed:
+        print("⚠️ لینک‌های قبلی فایل‌های منتقل شده دیگر معتبر نیستند")
+
 async def main():
     """
     تابع اصلی اجرای ربات با مدیریت خطا
@@ -1117,17 +5346,62 @@ async def main():
         for sig in (signal.SIGTERM, signal.SIGINT):
             loop.add_signal_handler(sig, handle_signals)
         
+        # فعال‌سازی نوشتن تجمیعی files.json
+        manifest_writer.start(loop)
+        
+        # آماده‌سازی پوشه staging دانلودها
+        await storage.run(staging_store.prepare)
+        
+        # فایل‌های staging بدون رکورد ژورنال دیگر قابل ادامه نیستند
+        journal_entries = await storage.run(download_journal.load)
+        await storage.run(
+            staging_store.cleanup_orphans,
+            {entry.get('file_name') for entry in journal_entries.values()}
+        )
+        
+        # ساخت ایندکس فایل‌ها با یک پیمایش دایرکتوری
+        await storage.run(file_index.build)
+        update_config_file_list()
+        
+        # بارگذاری ایندکس حذف تکرار و حذف ارجاع‌های فایل‌های پاک شده
+        await storage.run(dedup_index.load)
+        await storage.run(dedup_index.compact)
+        
+        # بارگذاری فهرست فایل‌های lazy
+        await storage.run(lazy_registry.load)
+        if LAZY_FETCH_CONFIG.get('enabled', False) and not HTTP_SERVER_CONFIG.get('enabled', False):
+            print("⚠️ حالت lazy_fetch به سرور HTTP داخلی نیاز دارد و غیرفعال می‌ماند")
+        
+        # بارگذاری آمار دسترسی ذخیره شده از لاگ nginx
+        await storage.run(access_tracker.load)
+        
         # شروع تسک‌های پس‌زمینه
         cleanup_task = asyncio.create_task(cleanup_scheduler())
         memory_task = asyncio.create_task(memory_manager.monitor_memory())
         downloads_task = asyncio.create_task(download_manager.monitor_downloads())
+        progress_task = asyncio.create_task(progress_reporter.run())
+        loop_lag_task = asyncio.create_task(loop_lag_monitor.run())
+        access_task = asyncio.create_task(access_tracker.run())
         
         # اضافه کردن به لیست تسک‌های پس‌زمینه
-        background_tasks.update([cleanup_task, memory_task, downloads_task])
+        background_tasks.update([
+            cleanup_task, memory_task, downloads_task, progress_task, loop_lag_task, access_task
+        ])
+        
+        # سرور HTTP داخلی (جایگزین nginx در استقرار بدون وب‌سرور)
+        if HTTP_SERVER_CONFIG.get('enabled', False):
+            await file_server.start()
+        
+        # endpoint محلی متریک‌ها
+        if METRICS_CONFIG.get('enabled', False):
+            await metrics_server.start()
         
         # شروع ربات
         await bot.start()
         
+        # راه‌اندازی ربات‌های کمکی دانلود
+        await worker_pool.start()
+        
         # تنظیم دستورات در BotFather
         try:
             await bot.set_bot_commands([
@@ -1139,6 +5413,9 @@ async def main():
         
         print("✅ ربات با موفقیت راه‌اندازی شد")
         
+        # ادامه دانلودهای نیمه‌کاره قبل از راه‌اندازی مجدد
+        await resume_journaled_downloads()
+        
         # منتظر می‌مانیم تا برنامه متوقف شود
         while running:
             await asyncio.sleep(1)
@@ -1173,6 +5450,46 @@ if __name__ == "__main__":
     
     sys.excepthook = handle_uncaught_exception
     
+    # اجرای بنچمارک دانلود به جای ربات
+    if len(sys.argv) == 4 and sys.argv[1] == '--benchmark-download':
+        asyncio.get_event_loop().run_until_complete(
+            benchmark_download(int(sys.argv[2]), int(sys.argv[3]))
+        )
+        sys.exit(0)
+    
+    # بنچمارک ارائه فایل از طریق HTTP
+    if len(sys.argv) in (3, 4, 5) and sys.argv[1] == '--benchmark-http':
+        asyncio.get_event_loop().run_until_complete(
+            benchmark_http(sys.argv[2], *(int(arg) for arg in sys.argv[3:]))
+        )
+        sys.exit(0)
+    
+    # بنچمارک آفلاین با Client مصنوعی (بدون حساب تلگرام)
+    if 2 <= len(sys.argv) <= 6 and sys.argv[1] == '--benchmark-offline':
+        asyncio.get_event_loop().run_until_complete(
+            benchmark_offline(*(float(arg) if i else int(arg) for i, arg in enumerate(sys.argv[2:])))
+        )
+        sys.exit(0)
+    
+    # مقایسه پیاده‌سازی‌های event loop
+    if 2 <= len(sys.argv) <= 4 and sys.argv[1] == '--benchmark-loop':
+        benchmark_loop(*(int(arg) for arg in sys.argv[2:]))
+        sys.exit(0)
+    
+    if len(sys.argv) == 4 and sys.argv[1] == '--benchmark-loop-worker':
+        event_loop.run_until_complete(benchmark_loop_worker(int(sys.argv[2]), int(sys.argv[3])))
+        sys.exit(0)
+    
+    # انتقال فایل‌های موجود به چیدمان جدید
+    if len(sys.argv) == 2 and sys.argv[1] == '--migrate-layout':
+        migrate_storage_layout()
+        sys.exit(0)
+    
+    # اجرای بنچمارک تأخیر event loop هنگام پاکسازی
+    if len(sys.argv) == 3 and sys.argv[1] == '--benchmark-cleanup':
+        asyncio.get_event_loop().run_until_complete(benchmark_cleanup(int(sys.argv[2])))
+        sys.exit(0)
+    
     # تهیه متن وضعیت پروکسی
     proxy_text = "غیرفعال"
     if proxy_config:
@@ -1189,8 +5506,8 @@ if __name__ == "__main__":
     ]
     print("\n".join(startup_info) + "\n")
     
-    # تنظیم event loop برای لینوکس
-    loop = asyncio.get_event_loop()
+    # اجرای ربات روی event loop ساخته شده در setup_event_loop (همان loop کلاینت)
+    loop = event_loop
     
     try:
         loop.run_until_complete(main())
@@ -63,6 +63,9 @@ if [ "$1" = "--uninstall" ]; then
     print_message "Removing bot files..."
     rm -rf "$BOT_PATH"
     rm -rf "/var/www/html/dl"
+    rm -rf "/var/www/html/files"
+    rm -rf "/var/www/html/.staging"
+    rm -rf "/var/www/.tgfl-staging"
     
     print_message "✨ Bot uninstalled successfully!"
     echo
@@ -351,6 +354,16 @@ server {
         add_header Cache-Control "public";
     }
 
+    location = /files/index.json {
+        add_header Cache-Control "no-cache";
+    }
+
+    location /files/ {
+        try_files \$uri =404;
+        expires 1y;
+        add_header Cache-Control "public, immutable";
+    }
+
     location / {
         try_files \$uri \$uri/ =404;
     }